@@ -0,0 +1,202 @@
+from sqlalchemy.sql import select, distinct
+from sqlalchemy import exc
+from datetime import date, timedelta
+from models.tables import Item
+from runner import Stage, register_stage
+from utils import Checkpoint
+from config import config
+import metrics
+import hashlib
+import numpy as np
+
+PRICE_DROPS_FOUND = metrics.counter('miner_price_drops_found_total',
+                                    'Prices well below their usual level')
+
+
+class PriceHistory(object):
+    """
+    Daily prices of the products of a vendor in columnar arrays, rows are
+    sorted by product then date. A product is a (title, per) of the vendor,
+    dates are kept as ordinals.
+    """
+
+    def __init__(self, titles, pers, dates, prices):
+        self.prices = np.asarray(prices, dtype=np.float64)
+        # Much faster than converting the dates to datetime64
+        self.days = np.fromiter((day.toordinal() for day in dates),
+                                dtype=np.int32, count=len(dates))
+        titles = np.asarray(titles, dtype=object)
+        pers = np.asarray(pers, dtype=object)
+        # A product starts where the title or the per changes
+        changed = np.ones(len(self.prices), dtype=bool)
+        changed[1:] = (titles[1:] != titles[:-1]) | (pers[1:] != pers[:-1])
+        self.starts = np.flatnonzero(changed)
+        self.ends = np.append(self.starts[1:], len(self.prices)) \
+            if len(self.prices) else self.starts
+        self.titles = titles[self.starts]
+        self.pers = pers[self.starts]
+
+    def __len__(self):
+        return len(self.starts)
+
+    def latest(self):
+        """
+        @return: arrays of the latest price and date ordinal of every
+                 product
+        """
+        return self.prices[self.ends - 1], self.days[self.ends - 1]
+
+    def window(self, size):
+        """
+        Return the size prices before the latest one of every product as a
+        matrix, the most recent first, padded with NaN
+        @return: products x size array
+        """
+        product = np.repeat(np.arange(len(self)), self.ends - self.starts)
+        # 0 is the latest price, 1 the one before...
+        age = np.repeat(self.ends - 1, self.ends - self.starts) - \
+            np.arange(len(self.prices))
+        past = (age >= 1) & (age <= size)
+        matrix = np.full((len(self), size), np.nan)
+        matrix[product[past], age[past] - 1] = self.prices[past]
+        return matrix
+
+
+def quantiles(matrix, counts, qs):
+    """
+    Return the quantiles of the rows of a NaN padded matrix, interpolated
+    like numpy's percentile. np.nanpercentile falls back to a Python loop
+    over the rows when they contain NaN, sorting the whole matrix once
+    puts the NaN last in every row instead.
+    @return: list of an array of the row quantiles per q
+    """
+    ordered = np.sort(matrix, axis=1)
+    rows = np.arange(len(ordered))
+    results = []
+    for q in qs:
+        position = (counts - 1) * q
+        below = np.floor(position).astype(np.intp)
+        above = np.minimum(below + 1, counts - 1)
+        fraction = position - below
+        results.append(ordered[rows, below] * (1 - fraction) +
+                       ordered[rows, above] * fraction)
+    return results
+
+
+def price_drops(history, window, min_history, percentile, min_drop, since):
+    """
+    Find the products whose latest price, seen since the given date, is
+    below the percentile of their prices over the window before it and at
+    least min_drop below their median
+    @return: list of (index, latest price, median, drop) of the products
+    """
+    if not len(history):
+        return []
+    latest, latest_days = history.latest()
+    matrix = history.window(window)
+    counts = np.count_nonzero(~np.isnan(matrix), axis=1)
+    candidates = np.flatnonzero((counts >= max(min_history, 1)) &
+                                (latest_days >= since.toordinal()))
+    if not len(candidates):
+        return []
+    latest = latest[candidates]
+    medians, lows = quantiles(matrix[candidates], counts[candidates],
+                              (0.5, percentile / 100.0))
+    drops = 1 - latest / medians
+    found = (latest < lows) & (drops >= min_drop)
+    return zip(candidates[found], latest[found], medians[found],
+               drops[found])
+
+
+@register_stage
+class PriceDropFinder(Stage):
+    """
+    Notify prices well below the usual price of a product at a vendor.
+    Compared to the lowest price ever seen it catches real drops of
+    products which were cheaper years ago, and ignores the noise of
+    products whose price moves every day. The history is loaded and
+    analysed one vendor at a time to bound the memory.
+    """
+
+    def __init__(self, context):
+        super(PriceDropFinder, self).__init__(context)
+        self.checkpoint = Checkpoint(config.miner.price_drops_file)
+
+    def run(self):
+        miner_config = config.miner
+        today = date.today()
+        since = today - timedelta(days=miner_config.price_drop_fresh_days)
+        from_date = today - timedelta(days=miner_config.price_history_days)
+        state = self.checkpoint.load({})
+        # A product is notified once per latest price date
+        notified = {key: day for key, day in state.get('notified', {}).items()
+                    if day >= since.isoformat()}
+
+        try:
+            vendors = [vendor for vendor, in self.session.execute(
+                select([distinct(Item.vendor)]).where(
+                    Item.date >= since))]
+        except (exc.DBAPIError,exc.InvalidRequestError) as e:
+            self.logger.error(u'Failed to get vendors from db: %s', e)
+            self.session.rollback()
+            return
+
+        found = 0
+        for vendor in vendors:
+            if self.context.expired():
+                break
+            try:
+                history = self.load_history(vendor, from_date)
+            except (exc.DBAPIError,exc.InvalidRequestError) as e:
+                self.logger.error(u'Failed to get price history of %s: %s',
+                                  vendor, e)
+                self.session.rollback()
+                continue
+            drops = price_drops(history,
+                                miner_config.price_window,
+                                miner_config.price_min_history,
+                                miner_config.price_drop_percentile,
+                                miner_config.price_min_drop,
+                                since)
+            _, latest_days = history.latest()
+            for index, price, median, drop in drops:
+                title, per = history.titles[index], history.pers[index]
+                key = self.product_key(title, per, vendor)
+                latest_date = date.fromordinal(
+                    latest_days[index]).isoformat()
+                if notified.get(key) == latest_date:
+                    continue
+                notified[key] = latest_date
+                found += 1
+                self.notifier.send_message(
+                    u'Price of "{item}" at {vendor} dropped to {price:.2f} '
+                    u'({drop:.0%} below its usual {median:.2f})'.format(
+                        item=title, vendor=vendor, price=price, drop=drop,
+                        median=median))
+            self.logger.debug(u'%d products of %s analysed', len(history),
+                              vendor)
+            del history
+
+        PRICE_DROPS_FOUND.inc(found)
+        self.logger.info(u'Found %d price drops', found)
+        state['notified'] = notified
+        self.checkpoint.save(state)
+
+    @staticmethod
+    def product_key(title, per, vendor):
+        key = u'\x1f'.join((title, per or u'', vendor))
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+    def load_history(self, vendor, from_date):
+        """
+        Load the daily prices of a vendor's products since from_date
+        @return: PriceHistory
+        """
+        rows = self.session.execute(
+            select([Item.title, Item.per, Item.date, Item.price]
+                   ).where(Item.vendor == vendor
+                   ).where(Item.date >= from_date
+                   ).order_by(Item.title, Item.per, Item.date)).fetchall()
+        # Faster than zip(*rows) over the row proxies
+        return PriceHistory(*[[row[column] for row in rows]
+                              for column in range(4)])
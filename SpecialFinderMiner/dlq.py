@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+from kombu import Connection
+from retry import RetryQueues, backoff_delays
+from utils import config_logger
+from config import config
+import argparse
+import logging
+
+
+def retry_queues(connection):
+    dumper_config = config.dumper
+    retries = RetryQueues(connection, config.queue.queue.name,
+                          backoff_delays(dumper_config.retry_delay,
+                                         dumper_config.max_retries))
+    retries.declare()
+    return retries
+
+
+def preview(body, width):
+    text = body if isinstance(body, unicode) else repr(body)
+    return text if len(text) <= width else text[:width - 3] + u'...'
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Inspect the results the dumper dead-lettered, and '
+                    'replay them once the cause of the failures is fixed')
+    commands = parser.add_subparsers(dest='command')
+    list_parser = commands.add_parser('list',
+                                      help='Show the dead-lettered results')
+    list_parser.add_argument('--limit',
+                             help='Results to show',
+                             type=int,
+                             default=20)
+    list_parser.add_argument('--width',
+                             help='Characters of every result to show',
+                             type=int,
+                             default=200)
+    replay_parser = commands.add_parser('replay',
+                                        help='Send the dead-lettered results '
+                                             'back to the results queue')
+    replay_parser.add_argument('--limit',
+                               help='Results to replay, all by default',
+                               type=int,
+                               default=None)
+    commands.add_parser('purge', help='Delete the dead-lettered results')
+    args = parser.parse_args()
+
+    logger = logging.getLogger('dlq')
+    config_logger(logger)
+    with Connection(config.queue.conn) as connection:
+        retries = retry_queues(connection)
+        try:
+            if args.command == 'list':
+                count, found = retries.dead_letters(args.limit,
+                                                    config.queue.serializer)
+                print u'%d dead-lettered results in %s' % (
+                    count, retries.dead_letter_queue.name)
+                for attempt, error, body in found:
+                    print u'- attempts: %d, error: %s' % (attempt, error)
+                    print u'  %s' % preview(body, args.width)
+            elif args.command == 'replay':
+                logger.info(u'Replayed %d results',
+                            retries.replay(args.limit))
+            else:
+                logger.info(u'Purged %d results', retries.purge() or 0)
+        finally:
+            retries.close()
+
+if __name__ == '__main__':
+    main()
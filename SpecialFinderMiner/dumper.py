@@ -2,22 +2,76 @@
 from kombu.mixins import ConsumerMixin
 from kombu import Connection, Exchange, Queue
 # FIXME resolve import issues.
-from config import config
-from utils import config_logger
+from config import config, conf_path, load_config
+from utils import config_logger, LRUCache
+from schema import (item_schema, decode_msgpack, SchemaError,
+                    MSGPACK_CONTENT_TYPE)
+import metrics
 from models.tables import DataAccessLayer, Item
-from sqlalchemy import exc
+from indexer import ItemIndexer, ITEM_DOC_COLUMNS
+from notifier import AsyncNotifier
+from watchlist import WatchList
+from retry import RetryQueues, backoff_delays, attempts
+from sqlalchemy import exc, tuple_
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.sql import func
+from collections import OrderedDict
+import argparse
 import logging
+import multiprocessing
+import os
+import signal
 import sys
+import time
+
+MESSAGES_CONSUMED = metrics.counter('dumper_messages_consumed_total',
+                                    'Results received from the queue')
+MESSAGES_ACKED = metrics.counter('dumper_messages_acked_total',
+                                 'Results acked, written or dropped')
+MESSAGES_REJECTED = metrics.counter('dumper_messages_rejected_total',
+                                    'Results rejected and discarded')
+MESSAGES_REQUEUED = metrics.counter('dumper_messages_requeued_total',
+                                    'Results rejected and requeued')
+MESSAGES_RETRIED = metrics.counter('dumper_messages_retried_total',
+                                   'Results sent to a retry queue')
+MESSAGES_DEAD_LETTERED = metrics.counter('dumper_messages_dead_lettered_total',
+                                         'Results sent to the dead letter '
+                                         'queue')
+MESSAGES_RELEASED = metrics.counter('dumper_messages_released_total',
+                                    'Due retries moved back to the queue by '
+                                    'the dumper')
+RESULTS_DROPPED = metrics.counter('dumper_results_dropped_total',
+                                  'Duplicate results acked '
+                                  'without writing', ['reason'])
+RESULTS_INVALID = metrics.counter('dumper_results_invalid_total',
+                                  'Results failing the schema',
+                                  ['field', 'reason'])
+MESSAGE_LAG = metrics.histogram('dumper_message_lag_seconds',
+                                'Time from publishing to receiving a result, '
+                                'if the publisher sets the timestamp',
+                                buckets=(0.1, 0.5, 1, 5, 15, 60, 300, 900,
+                                         3600))
+BATCH_ROWS = metrics.gauge('dumper_batch_rows', 'Rows of the last batch')
+BATCH_MESSAGES = metrics.gauge('dumper_batch_messages',
+                               'Results merged into the last batch')
+FLUSH_SECONDS = metrics.histogram('dumper_flush_seconds',
+                                  'Duration of writing a batch')
+SPECIALS_MATCHED = metrics.counter('dumper_specials_matched_total',
+                                   'Written items matching a watched title')
+WATCHED_TITLES = metrics.gauge('dumper_watched_titles',
+                               'Titles of the watch list')
 
 class Dumper(ConsumerMixin):
 
-    def __init__(self, connection=None):
+    conflict_policies = ('first_write_wins', 'last_write_wins', 'lowest_price')
+
+    def __init__(self, connection=None, worker=0):
         self.logger = logging.getLogger(type(self).__name__)
         config_logger(self.logger)
 
         queue_config = config.queue
         if connection:
-            self.connection = self.connection
+            self.connection = connection
         else:
             self.connection = Connection(queue_config.conn)
 
@@ -26,16 +80,92 @@ class Dumper(ConsumerMixin):
         self.queue = Queue(queue_config.queue.name,
                            exchange=self.exchange,
                            channel=self.connection)
-        self.dal = DataAccessLayer()
-        self.dal.conn_str = config.db_conn
+        self.dal = DataAccessLayer(config.db_conn, **config.db_pool)
+
+        # Results are buffered and written with one multi-row INSERT once
+        # batch_size is reached or the oldest one waited batch_timeout.
+        self.batch_size = config.dumper.batch_size
+        self.batch_timeout = config.dumper.batch_timeout
+        self.prefetch_count = config.dumper.prefetch_count or self.batch_size
+        if self.prefetch_count < self.batch_size:
+            self.logger.warning(u'prefetch_count %d is smaller than '
+                                u'batch_size %d, batches will only be '
+                                u'flushed by timeout',
+                                self.prefetch_count, self.batch_size)
+        self.batch = OrderedDict()  # (title, date) -> [row, messages]
+        self.batch_messages = 0
+        self.batch_started = None
+
+        # How a result for an existing (title, date) is treated.
+        self.conflict_policy = config.dumper.conflict_policy
+        if self.conflict_policy not in self.conflict_policies:
+            self.logger.fatal(u'Unknown conflict policy: %s',
+                              self.conflict_policy)
+            raise SystemExit(-1)
+        # Recently written rows, to drop redelivered results early.
+        self.seen = LRUCache(config.dumper.seen_cache_size)
+
+        # Acks and rejects of results whose connection was lost fail with
+        # these, the broker redelivers the results.
+        self.queue_errors = self.connection.connection_errors + \
+            self.connection.channel_errors
 
+        # Results failing unexpectedly wait in delayed retry queues rather
+        # than being redelivered at once, the ones which keep failing end up
+        # in the dead letter queue.
+        dumper_config = config.dumper
         try:
             self.connection.connect()
+            self.retries = RetryQueues(
+                self.connection, queue_config.queue.name,
+                backoff_delays(dumper_config.retry_delay,
+                               dumper_config.max_retries))
+            self.retries.declare()
             self.dal.connect()
         except Exception,e:
             self.logger.fatal(u'Failed to connect to the db or queue')
             raise SystemError(-1)
 
+        # Written items are also sent to elasticsearch, every worker keeps
+        # its own journal.
+        self.indexer = None
+        if config.dual_write.enabled:
+            if self.dal.engine.dialect.name != 'postgresql':
+                self.logger.warning(u'Dual write needs INSERT RETURNING, '
+                                    u'disabled on %s',
+                                    self.dal.engine.dialect.name)
+            else:
+                self.indexer = ItemIndexer(
+                    os.path.join(config.dual_write.journal_dir,
+                                 'dumper_es_%d.journal' % worker),
+                    logger=self.logger)
+
+        # Written items are matched against the special titles and
+        # notified right away, rather than by the miner's searches.
+        self.watchlist = None
+        self.notifier = None
+        if config.dumper.watchlist:
+            self.watchlist = WatchList.from_config(config.miner.special_titles)
+            WATCHED_TITLES.set(len(self.watchlist))
+            self.notifier = AsyncNotifier()
+            self.watchlist_checked = time.time()
+            self.config_mtime = self._config_mtime()
+
+        # Postgres returns the rows the INSERT actually wrote, elsewhere
+        # every row of the batch counts as written.
+        self.returning = self.dal.engine.dialect.name == 'postgresql' and \
+            (self.indexer is not None or self.watchlist is not None)
+
+    def on_connection_revived(self):
+        # Buffered results came through the channel of the lost connection,
+        # they can't be acked anymore and the broker redelivers them.
+        if self.batch:
+            self.logger.warning(u'Connection to the queue revived, dropping '
+                                u'%d buffered results', self.batch_messages)
+            self.batch = OrderedDict()
+            self.batch_messages = 0
+            self.batch_started = None
+
     def on_consume_ready(self, connection, channel, consumers, **kwargs):
         self.logger.info(u'Dumper is ready for receiving result')
         super(Dumper, self).on_consume_ready(connection,
@@ -43,71 +173,488 @@ class Dumper(ConsumerMixin):
                                              consumers,
                                              **kwargs)
 
+    def on_consume_end(self, connection, channel):
+        # Don't leave buffered results unacked on shutdown. If the
+        # connection is gone they can't be acked, but they're written.
+        self.flush()
+        if self.indexer is not None:
+            self.indexer.close()
+        if self.notifier is not None:
+            self.notifier.close()
+        try:
+            self.retries.close()
+        except self.queue_errors, e:
+            self.logger.warning(u'Failed to close the retry channel: %s', e)
+        super(Dumper, self).on_consume_end(connection, channel)
+
+    def on_iteration(self):
+        # Called on every turn of the consume loop, at least once a second,
+        # so a batch which stopped growing still gets written.
+        if self.batch and \
+                time.time() - self.batch_started >= self.batch_timeout:
+            self.flush()
+        if self.indexer is not None:
+            self.indexer.retry()
+        if self.watchlist is not None:
+            self._reload_watchlist()
+        released = self.retries.release_due()
+        if released:
+            MESSAGES_RELEASED.inc(released)
+            self.logger.debug(u'Released %d due retries', released)
+
     def on_decode_error(self, message, exc):
-        self.logger.error(exc)
-        super(Dumper, self).on_decode_error(message, exc)
+        # Decoding again won't help, kept for inspection instead
+        self.logger.error(u'Failed to decode result: %s', exc)
+        self._dead_letter([message], exc)
 
     def get_consumers(self, Consumer, channel):
-        return [
-            Consumer(queues=[self.queue],
-                     callbacks=[self.dump_result],
-                     accept=config.queue.serializer
-                    )
-        ]
+        accept = config.queue.serializer
+        self.fast_msgpack = 'msgpack' in accept or \
+            MSGPACK_CONTENT_TYPE in accept
+        consumer = Consumer(queues=[self.queue],
+                            on_message=self.on_message,
+                            accept=accept
+                           )
+        consumer.qos(prefetch_count=self.prefetch_count)
+        return [consumer]
 
-    @staticmethod
-    def _extract_item(item):
-        '''
-        Scrapy puts item(s) in the list, so need extract it from the list.
-        '''
-        if isinstance(item, list) and len(item):
-            return item[0]
+    def on_message(self, message):
+        # msgpack results are decoded straight from the raw body, anything
+        # else goes through kombu's serializer registry.
+        try:
+            if self.fast_msgpack and \
+                    message.content_type == MSGPACK_CONTENT_TYPE and \
+                    'compression' not in message.headers:
+                body = decode_msgpack(message.body)
+            else:
+                body = message.decode()
+        except Exception, e:
+            self.on_decode_error(message, e)
+            return
+        self.dump_result(body, message)
+
+    def _supersedes(self, row, old_row):
+        """
+        Return True if row should replace old_row of the same (title, date)
+        according to the conflict policy
+        """
+        if self.conflict_policy == 'lowest_price':
+            return row['price'] < old_row['price']
+        elif self.conflict_policy == 'last_write_wins':
+            return row != old_row
+        return False
+
+    def _insert_statement(self, rows):
+        """
+        Return an INSERT of rows which resolves (title, date) conflicts
+        according to the conflict policy. With dual write or the watch list
+        it returns the rows it inserted or actually changed.
+        """
+        if self.dal.engine.dialect.name != 'postgresql':
+            # No ON CONFLICT, e.g. SQLite in development and benchmarks
+            return Item.__table__.insert().values(rows)
+
+        stmt = insert(Item.__table__).values(rows)
+        if self.returning:
+            stmt = stmt.returning(*[Item.__table__.c[column]
+                                    for column in ITEM_DOC_COLUMNS])
+        if self.conflict_policy == 'first_write_wins':
+            return stmt.on_conflict_do_nothing(index_elements=['title', 'date'])
+
+        columns = ('price', 'per', 'url', 'image_url', 'vendor')
+        set_ = {column: stmt.excluded[column] for column in columns}
+        set_['updated_at'] = func.now()
+        if self.conflict_policy == 'lowest_price':
+            where = Item.__table__.c.price > stmt.excluded.price
         else:
-            return item
+            # Only rows which change are updated, and returned, so a result
+            # crawled again as it was isn't notified or indexed again
+            where = tuple_(*[Item.__table__.c[column]
+                             for column in columns]).is_distinct_from(
+                tuple_(*[stmt.excluded[column] for column in columns]))
+        return stmt.on_conflict_do_update(
+            index_elements=['title', 'date'],
+            set_=set_,
+            where=where)
 
     def dump_result(self, body, message):
-        # TODO: check json schema
-        self.logger.debug(u'Received: %s', body)
+        MESSAGES_CONSUMED.inc()
+        published = message.properties.get('timestamp')
+        if published:
+            MESSAGE_LAG.observe(time.time() - published)
         try:
-            title = self._extract_item(body['title'])
-            price = self._extract_item(body['price'])
-            per = self._extract_item(body.get('per'))
-            url = self._extract_item(body['url'])
-            image_url = self._extract_item(body['image_url'])
-            date = self._extract_item(body['date'])
-            vendor = self._extract_item(body['vendor'])
-            item = Item(title=title,
-                        price=price,
-                        per=per,
-                        url=url,
-                        image_url=image_url,
-                        date=date,
-                        vendor=vendor)
-            self.dal.session.add(item)
-            self.dal.session.commit()
-        except (exc.DBAPIError,exc.InvalidRequestError), e:
-            self.logger.error(u'DB error occurred: %s', e)
-            if e.connection_invalidated:
-                self.logger.info(u'Try re-connecting to the db')
-                self.dal.connect()
-                message.reject(requeue=True)
+            row = item_schema.validate(body)
+        except SchemaError, e:
+            self.logger.error(u'Invalid result, %s', e)
+            RESULTS_INVALID.labels(e.field, e.reason).inc()
+            # Kept to be replayed once the result or the schema is fixed
+            self._dead_letter([message], e)
+            return
+
+        key = (row['title'], row['date'])
+        seen_row = self.seen.get(key)
+        if seen_row is not None and not self._supersedes(row, seen_row):
+            self.logger.debug(u'Drop duplicate result: %s', key)
+            RESULTS_DROPPED.labels('duplicate').inc()
+            MESSAGES_ACKED.inc()
+            message.ack()
+            return
+
+        if not self.batch:
+            self.batch_started = time.time()
+        # Duplicates within a batch are merged, a single INSERT can't
+        # touch the same row twice.
+        entry = self.batch.get(key)
+        if entry is None:
+            self.batch[key] = [row, [message]]
+        else:
+            if self._supersedes(row, entry[0]):
+                entry[0] = row
+            entry[1].append(message)
+        self.batch_messages += 1
+        if self.batch_messages >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Write the buffered results with a single INSERT and ack them once
+        committed. Falls back to one INSERT per result if the batch fails,
+        so a bad result doesn't take its neighbours down with it.
+        """
+        if not self.batch:
+            return
+        batch = self.batch.values()
+        BATCH_ROWS.set(len(batch))
+        BATCH_MESSAGES.set(self.batch_messages)
+        self.batch = OrderedDict()
+        self.batch_messages = 0
+
+        with FLUSH_SECONDS.time():
+            self._flush(batch)
+
+    def _flush(self, batch):
+        while True:
+            try:
+                written = self._execute([row for row, _ in batch])
+            except (exc.DBAPIError,exc.InvalidRequestError), e:
+                self.logger.error(u'DB error occurred when writing %d results: '
+                                  u'%s', len(batch), e)
+                self.dal.session.rollback()
+                if self._db_lost(e):
+                    if self._reconnect():
+                        continue  # Write the same batch again
+                    for _, messages in batch:
+                        self._reject(messages, requeue=True)
+                    return
+                for row, messages in batch:
+                    self._dump_row(row, messages)
+            except Exception, e:
+                self.logger.error(u'Error occurred when dumping the results: %s', e)
+                self.dal.session.rollback()
+                # One by one, so only the failing results are retried
+                for row, messages in batch:
+                    self._dump_row(row, messages)
             else:
+                self.logger.debug(u'Wrote %d results', len(batch))
+                for row, messages in batch:
+                    self._ack(row, messages)
+                self._written(written)
+            return
+
+    def _dump_row(self, row, messages):
+        while True:
+            try:
+                written = self._execute([row])
+            except (exc.DBAPIError,exc.InvalidRequestError), e:
+                self.logger.error(u'DB error occurred: %s', e)
+                self.dal.session.rollback()
+                if self._db_lost(e):
+                    if self._reconnect():
+                        continue
+                    self._reject(messages, requeue=True)
+                else:
+                    self._dead_letter(messages, e)  # Probably invalid result
+            except Exception, e:
+                self.logger.error(u'Error occurred when dumping the result: %s', e)
                 self.dal.session.rollback()
-                message.reject() # Probably invalid result, discard
-        except KeyError, e:
-            self.logger.error(u'Invalid result: %s', e)
-            message.ack()  # Remove invalid message
+                self._retry(messages, e)
+            else:
+                self._ack(row, messages)
+                self._written(written)
+            return
+
+    def _execute(self, rows):
+        """
+        Write rows and commit
+        @return: the rows written
+        """
+        result = self.dal.session.execute(self._insert_statement(rows))
+        if self.returning:
+            rows = result.fetchall()
+        self.dal.session.commit()
+        return rows
+
+    def _written(self, rows):
+        # The db is the source of truth, items elasticsearch missed are
+        # retried by the indexer and the messages are acked regardless.
+        if self.indexer is not None and rows:
+            self.indexer.index(rows)
+        if self.watchlist is not None and rows:
+            self._notify_specials(rows)
+
+    def _notify_specials(self, rows):
+        found = 0
+        for row in rows:
+            if self.watchlist.match(row['title']):
+                self.notifier.send_message(
+                    u'{title} is on special: {price}, {url}'.format(
+                        title=row['title'], price=row['price'],
+                        url=row['url']))
+                found += 1
+        if found:
+            SPECIALS_MATCHED.inc(found)
+            # One digest per batch, sent while the dumper carries on
+            self.notifier.flush(wait=False)
+
+    @staticmethod
+    def _config_mtime():
+        try:
+            return os.stat(conf_path).st_mtime if conf_path else None
+        except OSError:
+            return None
+
+    def _reload_watchlist(self):
+        """
+        Rebuild the watch list when the config file changed, checked every
+        dumper.watchlist_reload_interval seconds
+        """
+        now = time.time()
+        if now - self.watchlist_checked < \
+                config.dumper.watchlist_reload_interval:
+            return
+        self.watchlist_checked = now
+        mtime = self._config_mtime()
+        if mtime == self.config_mtime:
+            return
+        self.config_mtime = mtime
+        try:
+            special_titles = load_config(conf_path).miner.special_titles
+            watchlist = WatchList.from_config(special_titles)
         except Exception, e:
-            self.logger.error(u'Error occurred when dumping the result: %s', e)
-            message.reject(requeue=True)  # Requeue the message
+            self.logger.error(u'Failed to reload the watch list, keeping '
+                              u'the current one: %s', e)
+            return
+        self.watchlist = watchlist
+        WATCHED_TITLES.set(len(watchlist))
+        self.logger.info(u'Reloaded the watch list, %d titles',
+                         len(watchlist))
+
+    def _db_lost(self, e):
+        """
+        Return True if the error came from losing the db rather than from
+        the results
+        """
+        return getattr(e, 'connection_invalidated', False) or \
+            not self.dal.ping()
+
+    def _reconnect(self):
+        # The results stay unacked while waiting, requeuing them would
+        # only bounce them between the workers until the db is back.
+        self.logger.info(u'Try re-connecting to the db')
+        if self.dal.reconnect(logger=self.logger, **config.db_reconnect):
+            return True
+        self.logger.error(u'DB still unreachable, requeuing the results')
+        return False
+
+    def _ack(self, row, messages):
+        self.seen[(row['title'], row['date'])] = row
+        self._ack_messages(messages)
+
+    def _ack_messages(self, messages):
+        """
+        Ack messages, unless their channel went with the connection, the
+        broker redelivers them then
+        """
+        for message in messages:
+            try:
+                message.ack()
+            except self.queue_errors, e:
+                self.logger.warning(u'Failed to ack a result, the broker '
+                                    u'will redeliver it: %s', e)
+            else:
+                MESSAGES_ACKED.inc()
+
+    def _retry(self, messages, error):
+        """
+        Send the messages of a result to their next retry queue, or to the
+        dead letter queue once they ran out of attempts
+        """
+        for message in messages:
+            try:
+                dead = self.retries.retry(message, error)
+            except Exception, e:
+                self.logger.error(u'Failed to retry a result, requeuing it: '
+                                  u'%s', e)
+                self._reject([message], requeue=True)
+                continue
+            if dead:
+                self.logger.error(u'Result failed %d times, dead-lettered',
+                                  attempts(message) + 1)
+                MESSAGES_DEAD_LETTERED.inc()
+            else:
+                MESSAGES_RETRIED.inc()
+            self._ack_messages([message])
+
+    def _dead_letter(self, messages, error):
+        for message in messages:
+            try:
+                self.retries.dead_letter(message, error)
+            except Exception, e:
+                self.logger.error(u'Failed to dead-letter a result, '
+                                  u'discarding it: %s', e)
+                self._reject([message])
+                continue
+            MESSAGES_DEAD_LETTERED.inc()
+            self._ack_messages([message])
+
+    def _reject(self, messages, requeue=False):
+        if requeue:
+            MESSAGES_REQUEUED.inc(len(messages))
         else:
-            message.ack()
+            MESSAGES_REJECTED.inc(len(messages))
+        for message in messages:
+            try:
+                message.reject(requeue=requeue)
+            except self.queue_errors, e:
+                self.logger.warning(u'Failed to reject a result, the broker '
+                                    u'will redeliver it: %s', e)
+
+
+class DumperSupervisor(object):
+    """
+    Run Dumpers in worker processes consuming the same queue. Every worker
+    has its own broker connection, prefetch window and db engine. Workers
+    which die are restarted, SIGTERM or SIGINT stops them once they
+    drained their batches.
+    """
+
+    def __init__(self, workers=None):
+        self.logger = logging.getLogger(type(self).__name__)
+        config_logger(self.logger)
+
+        dumper_config = config.dumper
+        self.workers = workers or dumper_config.workers
+        self.shutdown_timeout = dumper_config.shutdown_timeout
+        self.restart_delay = dumper_config.restart_delay
+        self.max_restart_delay = dumper_config.max_restart_delay
+        self.processes = {}  # worker index -> (process, start time)
+        self.delays = {}  # worker index -> delay of the next restart
+        self.stopping = False
+
+    def start_worker(self, index):
+        process = multiprocessing.Process(target=_run_worker,
+                                          args=(index, ),
+                                          name='Dumper-%d' % index)
+        process.start()
+        self.processes[index] = (process, time.time())
+        self.logger.info(u'Started worker %d, pid %d', index, process.pid)
+
+    def stop(self, signum=None, frame=None):
+        self.stopping = True
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        for index in range(self.workers):
+            self.start_worker(index)
+
+        restarts = {}  # worker index -> time to restart it
+        while not self.stopping:
+            now = time.time()
+            for index, (process, started) in self.processes.items():
+                if process.is_alive():
+                    continue
+                process.join()
+                del self.processes[index]
+                # A worker which ran for a while gets restarted quickly,
+                # one which keeps crashing waits longer and longer.
+                if now - started > self.max_restart_delay:
+                    delay = self.restart_delay
+                else:
+                    delay = min(self.delays.get(index, self.restart_delay),
+                                self.max_restart_delay)
+                self.delays[index] = delay * 2
+                self.logger.error(u'Worker %d exited with %s, restarting in '
+                                  u'%.1fs', index, process.exitcode, delay)
+                restarts[index] = now + delay
+            for index, restart_at in restarts.items():
+                if restart_at <= now:
+                    del restarts[index]
+                    self.start_worker(index)
+            time.sleep(0.5)
+        self.shutdown()
+
+    def shutdown(self):
+        """
+        Ask the workers to stop and wait for them to flush their batches.
+        The messages of the ones killed after the timeout are redelivered
+        by the broker, as they were never acked.
+        """
+        processes = [process for process, _ in self.processes.values()]
+        self.logger.info(u'Stopping %d workers', len(processes))
+        for process in processes:
+            if process.is_alive():
+                process.terminate()  # SIGTERM
+        deadline = time.time() + self.shutdown_timeout
+        for process in processes:
+            process.join(max(0, deadline - time.time()))
+        for process in processes:
+            if process.is_alive():
+                self.logger.error(u'Killing %s, it did not stop in %ds',
+                                  process.name, self.shutdown_timeout)
+                os.kill(process.pid, signal.SIGKILL)
+                process.join()
+        self.processes = {}
+
+
+def _stop_on_sigterm(dumper):
+    def stop(signum, frame):
+        # The consume loop checks it at least once a second, then the
+        # buffered results are flushed.
+        dumper.should_stop = True
+    signal.signal(signal.SIGTERM, stop)
+
+
+def _run_worker(index):
+    # Ctrl-C reaches the whole process group, the supervisor decides.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    metrics.start('dumper_%d' % index, port_offset=index)
+    try:
+        dumper = Dumper(worker=index)
+        _stop_on_sigterm(dumper)
+        dumper.run()
+    finally:
+        metrics.dump()
 
 
 def main():
     reload(sys)
     sys.setdefaultencoding('utf8')
-    Dumper().run()
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers',
+                        help='Consume with N worker processes',
+                        type=int,
+                        default=config.dumper.workers)
+    args = parser.parse_args()
+
+    if args.workers > 1:
+        DumperSupervisor(args.workers).run()
+    else:
+        metrics.start('dumper')
+        dumper = Dumper()
+        _stop_on_sigterm(dumper)
+        dumper.run()
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,231 @@
+from elasticsearch import Elasticsearch, TransportError
+from elasticsearch.helpers import streaming_bulk
+from collections import deque
+from itertools import islice
+from transmitter import Transmitter
+from indices import ItemIndices
+from utils import config_logger
+from config import config
+import metrics
+import json
+import logging
+import os
+import time
+
+ITEMS_INDEXED = metrics.counter('dumper_es_items_indexed_total',
+                                'Items the dumper sent to elasticsearch')
+ITEMS_FAILED = metrics.counter('dumper_es_items_failed_total',
+                               'Items elasticsearch refused from the dumper')
+ITEMS_JOURNALED = metrics.counter('dumper_es_items_journaled_total',
+                                  'Items spilled to the journal while '
+                                  'elasticsearch was unreachable')
+PENDING_ITEMS = metrics.gauge('dumper_es_pending_items',
+                              'Items in the retry buffer')
+
+# Columns of the written rows the documents are made of
+ITEM_DOC_COLUMNS = ('id', 'title', 'url', 'price', 'per', 'vendor', 'date')
+
+
+def _retryable(result):
+    """
+    Return True if a failed bulk item may succeed later, i.e. elasticsearch
+    was unreachable, overloaded or failing rather than refusing the document
+    """
+    (_, info), = result.items()
+    status = info.get('status')
+    return not isinstance(status, int) or status == 429 or status >= 500
+
+
+class ItemIndexer(object):
+    """
+    Send the rows the dumper wrote to elasticsearch, as the same documents
+    the transmitter sends. Items which couldn't be sent wait in a bounded
+    retry buffer, the oldest are spilled to a journal file once it's full.
+    The journal is sent first when elasticsearch is back, so a document is
+    never overwritten by an older version of it.
+    """
+
+    def __init__(self, journal_path, es=None, index_name=None, logger=None):
+        self.logger = logger or logging.getLogger(type(self).__name__)
+        config_logger(self.logger)
+        self.es = es or Elasticsearch(
+            config.elasticsearch.hosts,
+            connection_class=metrics.es_connection_class())
+        self.index_name = index_name or \
+            config.elasticsearch.index.special_items
+        self.indices = ItemIndices(self.index_name,
+                                   config.elasticsearch.index_period)
+        if self.indices.time_based:
+            # The indices are created by their first items, from the
+            # template the transmitter puts too
+            try:
+                self.es.indices.put_template(
+                    name=self.index_name,
+                    body=Transmitter.items_template(self.indices))
+            except TransportError as e:
+                self.logger.error(u'Failed to put the items template: %s',
+                                  e)
+
+        dual_write_config = config.dual_write
+        self.buffer_size = dual_write_config.buffer_size
+        self.retry_delay = dual_write_config.retry_delay
+        self.max_retry_delay = dual_write_config.max_retry_delay
+        self.chunk_size = config.transmitter.chunk_size
+        self.journal_path = os.path.expanduser(journal_path)
+        self.replay_path = self.journal_path + '.replay'
+
+        self.pending = deque()  # Actions waiting to be sent
+        self.delay = self.retry_delay
+        self.retry_at = 0
+        # Left over by a previous run
+        self.journaled = os.path.exists(self.journal_path) or \
+            os.path.exists(self.replay_path)
+
+    def action(self, row):
+        """
+        Return a bulk index action of a written row, the document id is the
+        primary key like the transmitter's
+        @return: item action
+        """
+        return {
+            '_index': self.indices.index(row['date']),
+            '_type': Transmitter.es_type,
+            '_id': row['id'],
+            '_source': Transmitter.item_doc(row['title'],
+                                            row['url'],
+                                            row['price'],
+                                            row['per'],
+                                            row['vendor'],
+                                            row['date'].isoformat())
+        }
+
+    def index(self, rows):
+        """
+        Queue the rows and send everything pending, unless elasticsearch
+        failed recently
+        """
+        self.pending.extend(self.action(row) for row in rows)
+        self.send()
+
+    def retry(self):
+        """
+        Send the pending and journaled items once the retry delay passed,
+        called while the dumper is idle
+        """
+        if self.pending or self.journaled:
+            self.send()
+
+    def send(self):
+        if time.time() >= self.retry_at:
+            if self._replay() and self._send_pending():
+                self.delay = self.retry_delay
+            else:
+                self.retry_at = time.time() + self.delay
+                self.logger.warning(u'Elasticsearch unavailable, retrying '
+                                    u'in %.1fs', self.delay)
+                self.delay = min(self.delay * 2, self.max_retry_delay)
+        overflow = len(self.pending) - self.buffer_size
+        if overflow > 0:
+            self._spill([self.pending.popleft() for _ in range(overflow)])
+        PENDING_ITEMS.set(len(self.pending))
+
+    def close(self):
+        """
+        Send the pending items one last time and journal the ones left
+        """
+        self.retry_at = 0
+        self.retry()
+        if self.pending:
+            self._spill(list(self.pending))
+            self.pending.clear()
+        PENDING_ITEMS.set(0)
+
+    def _bulk(self, actions):
+        """
+        Send actions through the bulk API
+        @return: list of the actions to retry
+        """
+        retry = []
+        indexed = 0
+        for action, (ok, result) in zip(
+                actions, streaming_bulk(self.es,
+                                        actions,
+                                        chunk_size=self.chunk_size,
+                                        raise_on_error=False,
+                                        raise_on_exception=False)):
+            if ok:
+                indexed += 1
+            elif _retryable(result):
+                retry.append(action)
+            else:
+                self.logger.error(u'Failed to index item: %s', result)
+                ITEMS_FAILED.inc()
+        ITEMS_INDEXED.inc(indexed)
+        return retry
+
+    def _send_pending(self):
+        """
+        @return: True if nothing is left to retry
+        """
+        if not self.pending:
+            return True
+        self.pending = deque(self._bulk(list(self.pending)))
+        return not self.pending
+
+    def _write(self, path, actions, mode='a'):
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(path, mode) as fp:
+            for action in actions:
+                fp.write(json.dumps(action) + '\n')
+            fp.flush()
+            os.fsync(fp.fileno())
+
+    def _spill(self, actions):
+        self._write(self.journal_path, actions)
+        self.journaled = True
+        ITEMS_JOURNALED.inc(len(actions))
+        self.logger.warning(u'Journaled %d items to %s', len(actions),
+                            self.journal_path)
+
+    def _replay(self):
+        """
+        Send the journaled items. The journal is renamed while it's sent,
+        items journaled meanwhile go to a new one which is sent next. A
+        replay interrupted by a crash starts over, which is harmless as
+        documents are overwritten by id.
+        @return: True if the whole journal was sent
+        """
+        if not self.journaled:
+            return True
+        sent = 0
+        while True:
+            if not os.path.exists(self.replay_path):
+                if not os.path.exists(self.journal_path):
+                    break
+                os.rename(self.journal_path, self.replay_path)
+            with open(self.replay_path) as fp:
+                lines = iter(fp)
+                while True:
+                    chunk = [json.loads(line) for line in
+                             islice(lines, self.chunk_size)]
+                    if not chunk:
+                        break
+                    retry = self._bulk(chunk)
+                    sent += len(chunk) - len(retry)
+                    if retry:
+                        # Keep the rest in order, ahead of the journal
+                        tmp_path = self.replay_path + '.tmp'
+                        self._write(tmp_path, retry, 'w')
+                        self._write(tmp_path,
+                                    (json.loads(line) for line in lines))
+                        os.rename(tmp_path, self.replay_path)
+                        if sent:
+                            self.logger.info(u'Sent %d journaled items, '
+                                             u'the rest failed', sent)
+                        return False
+            os.remove(self.replay_path)
+        self.journaled = False
+        self.logger.info(u'Sent %d journaled items', sent)
+        return True
@@ -0,0 +1,93 @@
+from datetime import date, datetime, timedelta
+from config import config
+
+# Suffixes of the time-based item indices, they sort like the dates
+PERIOD_FORMATS = {
+    'day': '%Y.%m.%d',
+    'month': '%Y.%m',
+}
+
+
+def _next_start(start, period):
+    if period == 'day':
+        return start + timedelta(days=1)
+    return (start.replace(day=1) + timedelta(days=32)).replace(day=1)
+
+
+class ItemIndices(object):
+    """
+    Names of the item indices. Without a period the items go to a single
+    index, or alias, named after elasticsearch.index.special_items. With a
+    day or month period they go to one index per period, <name>-<period>,
+    created from a template which adds them to the read alias <name>.
+    """
+
+    def __init__(self, alias, period=None):
+        if period is not None and period not in PERIOD_FORMATS:
+            raise ValueError('Unknown index period: %s' % period)
+        self.alias = alias
+        self.period = period
+
+    @classmethod
+    def from_config(cls):
+        return cls(config.elasticsearch.index.special_items,
+                   config.elasticsearch.index_period)
+
+    @property
+    def time_based(self):
+        return self.period is not None
+
+    @property
+    def pattern(self):
+        """
+        @return: wildcard matching the time-based indices
+        """
+        return '%s-*' % self.alias
+
+    def start(self, day):
+        """
+        @return: first day of the period of a day
+        """
+        return day.replace(day=1) if self.period == 'month' else day
+
+    def index(self, day):
+        """
+        Return the index the items of a day are written to
+        @return: index name
+        """
+        if not self.time_based:
+            return self.alias
+        return '%s-%s' % (self.alias,
+                          day.strftime(PERIOD_FORMATS[self.period]))
+
+    def covering(self, from_date, to_date=None):
+        """
+        Return the indices of the items from from_date to to_date, today by
+        default. Some may not exist yet.
+        @return: list of index names
+        """
+        if not self.time_based:
+            return [self.alias]
+        to_date = to_date or date.today()
+        names = []
+        start = self.start(from_date)
+        while start <= to_date:
+            names.append(self.index(start))
+            start = _next_start(start, self.period)
+        return names
+
+    def end(self, name):
+        """
+        Return the day after the period of a time-based index
+        @return: date, None if the name isn't one of the indices
+        """
+        prefix = self.alias + '-'
+        if not self.time_based or not name.startswith(prefix):
+            return None
+        try:
+            start = datetime.strptime(name[len(prefix):],
+                                      PERIOD_FORMATS[self.period]).date()
+        except ValueError:
+            return None
+        return _next_start(start, self.period)
+
@@ -0,0 +1,468 @@
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+from bisect import bisect_left
+from elasticsearch import Urllib3HttpConnection, TransportError
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+from config import config
+import atexit
+import os
+import threading
+import time
+
+namespace = 'specialfinder'
+
+# Seconds, from a millisecond query to a slow bulk request
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _escape(value):
+    return unicode(value).replace(u'\\', u'\\\\').replace(
+        u'\n', u'\\n').replace(u'"', u'\\"')
+
+
+def _format_labels(labels):
+    if not labels:
+        return u''
+    return u'{%s}' % u','.join(u'%s="%s"' % (name, _escape(value))
+                               for name, value in labels)
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return u'+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return unicode(int(value))
+    return unicode(repr(value))
+
+
+class NullMetric(object):
+    """
+    Stands in for every metric while metrics are disabled, so the hot
+    paths pay one method call
+    """
+
+    def labels(self, *values):
+        return self
+
+    def inc(self, amount=1):
+        pass
+
+    def dec(self, amount=1):
+        pass
+
+    def set(self, value):
+        pass
+
+    def observe(self, value):
+        pass
+
+    def time(self):
+        return _null_timer
+
+
+class _NullTimer(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+_null_timer = _NullTimer()
+NULL_METRIC = NullMetric()
+
+
+class Metric(object):
+    """
+    A named metric, optionally split by labels. The values of a label
+    combination live in a child returned by labels().
+    """
+
+    type_name = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        self.children = {}
+        if not self.labelnames:
+            self.children[()] = self._child()
+
+    def _child(self):
+        raise NotImplementedError('Subclass responsibility')
+
+    def labels(self, *values):
+        if len(values) != len(self.labelnames):
+            raise ValueError(u'%s takes labels %s' % (self.name,
+                                                      self.labelnames))
+        values = tuple(unicode(value) for value in values)
+        child = self.children.get(values)
+        if child is None:
+            with self.lock:
+                child = self.children.setdefault(values, self._child())
+        return child
+
+    # Metrics without labels are used directly.
+    def inc(self, amount=1):
+        self.children[()].inc(amount)
+
+    def dec(self, amount=1):
+        self.children[()].dec(amount)
+
+    def set(self, value):
+        self.children[()].set(value)
+
+    def observe(self, value):
+        self.children[()].observe(value)
+
+    def time(self):
+        return self.children[()].time()
+
+    def samples(self):
+        """
+        @return: list of (suffix, labels, value)
+        """
+        samples = []
+        for values, child in sorted(self.children.items()):
+            labels = zip(self.labelnames, values)
+            samples.extend(child.samples(labels))
+        return samples
+
+    def render(self):
+        lines = [u'# HELP %s %s' % (self.name,
+                                    self.documentation.replace(u'\n', u' ')),
+                 u'# TYPE %s %s' % (self.name, self.type_name)]
+        for suffix, labels, value in self.samples():
+            lines.append(u'%s%s%s %s' % (self.name, suffix,
+                                         _format_labels(labels),
+                                         _format_value(value)))
+        return u'\n'.join(lines)
+
+
+class _Value(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.value = 0.0
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        with self.lock:
+            self.value -= amount
+
+    def set(self, value):
+        self.value = float(value)
+
+    def samples(self, labels):
+        return [(u'', labels, self.value)]
+
+
+class Counter(Metric):
+
+    type_name = 'counter'
+
+    def _child(self):
+        return _Value()
+
+
+class Gauge(Metric):
+
+    type_name = 'gauge'
+
+    def _child(self):
+        return _Value()
+
+
+class _Timer(object):
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.started = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.time() - self.started)
+        return False
+
+
+class _Buckets(object):
+
+    def __init__(self, bounds):
+        self.lock = threading.Lock()
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # The last one is +Inf
+        self.sum = 0.0
+
+    def observe(self, value):
+        index = bisect_left(self.bounds, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def time(self):
+        return _Timer(self)
+
+    def samples(self, labels):
+        samples = []
+        cumulative = 0
+        for bound, count in zip(self.bounds + (float('inf'), ), self.counts):
+            cumulative += count
+            samples.append((u'_bucket',
+                            labels + [('le', _format_value(float(bound)))],
+                            cumulative))
+        samples.append((u'_sum', labels, self.sum))
+        samples.append((u'_count', labels, cumulative))
+        return samples
+
+
+class Histogram(Metric):
+
+    type_name = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(),
+                 buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super(Histogram, self).__init__(name, documentation, labelnames)
+
+    def _child(self):
+        return _Buckets(self.buckets)
+
+
+class Registry(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = {}
+
+    def register(self, metric):
+        with self.lock:
+            if metric.name in self.metrics:
+                raise ValueError(u'Duplicate metric: %s' % metric.name)
+            self.metrics[metric.name] = metric
+        return metric
+
+    def render(self):
+        """
+        Return the metrics in the Prometheus text exposition format
+        """
+        return u''.join(self.metrics[name].render() + u'\n'
+                        for name in sorted(self.metrics)).encode('utf-8')
+
+
+enabled = bool(config.metrics.enabled)
+registry = Registry()
+
+
+def _metric(cls, name, documentation, labelnames=(), **kwargs):
+    if not enabled:
+        return NULL_METRIC
+    return registry.register(cls(u'%s_%s' % (namespace, name),
+                                 documentation, labelnames, **kwargs))
+
+
+def counter(name, documentation, labelnames=()):
+    """
+    Return a counter, a no-op one if metrics are disabled
+    """
+    return _metric(Counter, name, documentation, labelnames)
+
+
+def gauge(name, documentation, labelnames=()):
+    """
+    Return a gauge, a no-op one if metrics are disabled
+    """
+    return _metric(Gauge, name, documentation, labelnames)
+
+
+def histogram(name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+    """
+    Return a histogram, a no-op one if metrics are disabled
+    """
+    return _metric(Histogram, name, documentation, labelnames,
+                   buckets=buckets)
+
+
+DB_QUERY_SECONDS = histogram('db_query_seconds',
+                             'Duration of db statements')
+DB_COMMIT_SECONDS = histogram('db_commit_seconds',
+                              'Duration of db session commits, including '
+                              'the flush of pending changes')
+DB_ROLLBACKS = counter('db_rollbacks_total', 'Rolled back db sessions')
+ES_REQUEST_SECONDS = histogram('es_request_seconds',
+                               'Duration of elasticsearch requests',
+                               ['operation'])
+ES_REQUEST_ERRORS = counter('es_request_errors_total',
+                            'Failed elasticsearch requests',
+                            ['operation', 'status'])
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    conn.info.setdefault('metrics_started', []).append(time.time())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    DB_QUERY_SECONDS.observe(time.time() - conn.info['metrics_started'].pop())
+
+
+def _handle_error(context):
+    started = context.connection.info.get('metrics_started') \
+        if context.connection is not None else None
+    if started:
+        started.pop()
+
+
+def _before_commit(session):
+    session.info['metrics_commit_started'] = time.time()
+
+
+def _after_commit(session):
+    started = session.info.pop('metrics_commit_started', None)
+    if started is not None:
+        DB_COMMIT_SECONDS.observe(time.time() - started)
+
+
+def _after_rollback(session):
+    session.info.pop('metrics_commit_started', None)
+    DB_ROLLBACKS.inc()
+
+
+def es_operation(url):
+    """
+    Return the API of an elasticsearch request url, e.g. _bulk or _search
+    """
+    parts = [part for part in url.split('?', 1)[0].split('/') if part]
+    for part in reversed(parts):
+        if part.startswith('_'):
+            return part
+    return 'document' if len(parts) > 1 else 'index'
+
+
+class InstrumentedConnection(Urllib3HttpConnection):
+    """
+    Elasticsearch connection which records the duration and the failures
+    of the requests
+    """
+
+    def perform_request(self, method, url, *args, **kwargs):
+        operation = es_operation(url)
+        started = time.time()
+        try:
+            return super(InstrumentedConnection, self).perform_request(
+                method, url, *args, **kwargs)
+        except TransportError as e:
+            ES_REQUEST_ERRORS.labels(operation, e.status_code).inc()
+            raise
+        finally:
+            ES_REQUEST_SECONDS.labels(operation).observe(
+                time.time() - started)
+
+
+def es_connection_class():
+    """
+    Return the connection class elasticsearch clients should use
+    """
+    return InstrumentedConnection if enabled else Urllib3HttpConnection
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        body = registry.render()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class _HTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def start_http_server(port, address='127.0.0.1'):
+    """
+    Serve the metrics over HTTP from a background thread
+    @return: the server
+    """
+    server = _HTTPServer((address, port), _Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+_textfile_lock = threading.Lock()
+
+
+def write_textfile(path):
+    """
+    Write the metrics for the node exporter's textfile collector, the file
+    is replaced atomically so it's never read half written. Threads write
+    it in turn, processes through their own temporary file.
+    """
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    with _textfile_lock:
+        with open(tmp_path, 'w') as fp:
+            fp.write(registry.render())
+        os.rename(tmp_path, path)
+
+
+_started = False
+_textfile = None
+
+
+def start(service, port_offset=0):
+    """
+    Start collecting the metrics of a service: instrument the db, serve
+    the metrics if a port is configured and write them to the textfile
+    directory on exit, which suits the tools run by cron. Does nothing if
+    metrics are disabled. Processes of the same service serve on the port
+    plus their port_offset.
+    """
+    global _started, _textfile
+    if not enabled or _started:
+        return
+    _started = True
+    event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+    event.listen(Engine, 'handle_error', _handle_error)
+    event.listen(Session, 'before_commit', _before_commit)
+    event.listen(Session, 'after_commit', _after_commit)
+    event.listen(Session, 'after_rollback', _after_rollback)
+
+    metrics_config = config.metrics
+    if metrics_config.port:
+        start_http_server(metrics_config.port + port_offset,
+                          metrics_config.address)
+    if metrics_config.textfile_dir:
+        _textfile = os.path.join(
+            os.path.expanduser(metrics_config.textfile_dir),
+            '%s_%s.prom' % (namespace, service))
+        atexit.register(dump)
+
+
+def dump():
+    """
+    Write the metrics to the textfile directory if one is configured.
+    Called on exit, processes which leave without running the exit
+    handlers, like multiprocessing children, call it themselves.
+    """
+    if _textfile is not None:
+        write_textfile(_textfile)
@@ -1,23 +1,58 @@
 #!/usr/bin/env python
-from sqlalchemy.sql import func
+from sqlalchemy.sql import func, select, text, true
+from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy import exc
-from elasticsearch import Elasticsearch, TransportError, RequestError
-from datetime import date, timedelta
+from elasticsearch import TransportError, RequestError
+from elasticsearch.helpers import bulk
+from datetime import date, datetime, timedelta
 
-from models.tables import DataAccessLayer, Item
-from notifier import Notifier
-from utils import config_logger
+from models.tables import Item, LowestPrice
+from runner import MinerContext, MinerRunner, Stage, register_stage
+from utils import Checkpoint
 from config import config
-import logging
-
-class SpecialFinder(object):
+import analytics  # Registers PriceDropFinder
+import products  # Registers ProductMatcher and CrossVendorFinder
+import metrics
+import argparse
+import hashlib
+import threading
+# strptime imports this on first use, which isn't thread-safe in Python 2,
+# and the stages call it from the pool threads
+import _strptime
+
+SPECIALS_FOUND = metrics.counter('miner_specials_found_total',
+                                 'Specials found for the special titles')
+SPECIALS_NOTIFIED = metrics.counter('miner_specials_notified_total',
+                                    'Specials not notified before')
+LOWEST_PRICES_CHANGED = metrics.gauge('miner_lowest_prices_changed',
+                                      'Lowest prices changed since the last '
+                                      'run')
+LOWEST_PRICES_DROPPED = metrics.counter('miner_lowest_prices_dropped_total',
+                                        'Lower prices notified')
+
+@register_stage
+class SpecialFinder(Stage):
+    """
+    Notify the items matching the special titles. Every title has a mark,
+    the date of the latest special found for it, and the next run only
+    searches from that date on. The specials already notified are kept as
+    fingerprints, so the ones of the mark's date, searched again, aren't
+    notified twice.
+    """
 
     es_type = 'specialfinder_items'
 
+    def __init__(self, context):
+        super(SpecialFinder, self).__init__(context)
+        self.checkpoint = Checkpoint(config.miner.specials_file)
+        self.lock = threading.Lock()
+        self.notified = {}  # Fingerprint -> date of the special
+
     @staticmethod
     def special_query(title, operator="and", from_date='1970-01-01'):
         """
-        Return a query to find special of an item in the elasticsearch
+        Return a query to find special of an item in the elasticsearch,
+        oldest first so the pages are stable while items are added
         @return: item query
         """
         special_query = \
@@ -39,53 +74,175 @@ class SpecialFinder(object):
                      }
                  }
              }
-
-        }}
+         },
+         "sort": [{"date": "asc"}]}
         return special_query
 
+    def search_index(self, from_date):
+        """
+        Return the item indices to search for the specials since from_date,
+        only the ones of the days searched if they're time-based
+        @return: comma separated index names
+        """
+        # strptime isn't thread-safe on first use in Python 2
+        day = date(*map(int, from_date.split('-')))
+        return ','.join(self.context.item_indices.covering(day))
+
+    @staticmethod
+    def title_key(title, operator):
+        return u'%s:%s' % (operator, title)
+
+    @staticmethod
+    def fingerprint(source):
+        """
+        Return a fingerprint of a special, a new price of the same item is
+        a new special. 64 bits of a SHA-1 keep the store compact.
+        @return: hex fingerprint
+        """
+        key = u'\x1f'.join((source['title'], source['url'],
+                            repr(source['price'])))
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]
+
+    def run(self):
+        self.find_special()
+
     def find_special(self, titles=None):
 
         if titles is None:
             try:
                 titles = config.miner.special_titles
             except AttributeError as e:
-                logger.error(u'Failed to find titles in the config: %s', e)
+                self.logger.error(u'Failed to find titles in the config: %s', e)
                 return
 
-        from_date = date.today() - timedelta(days=7)  # FIXME: better way to define from_date
-
+        # Titles without a mark, new or not found for a while, are searched
+        # special_days back. Dates are ISO strings, which compare like dates.
+        floor = (date.today() -
+                 timedelta(days=config.miner.special_days)).isoformat()
+        state = self.checkpoint.load({})
+        marks = {key: mark for key, mark in state.get('marks', {}).items()
+                 if mark > floor}
+        self.notified = {fingerprint: day for fingerprint, day
+                         in state.get('notified', {}).items()
+                         if day >= floor}
+
+        entries = []
         for title_entry in titles:
             try:
-                title = title_entry.title
-                operator = title_entry.get('operator', 'and')
-                res = es.search(index=specialfinder_index,
-                                doc_type=self.es_type,
-                                body=self.special_query(title,
-                                                        operator,
-                                                        from_date))
-
-                num_special_found = res['hits']['total']
-                logger.info(u'Found %d specials for %s from %s',
-                            num_special_found, title, from_date)
-                if num_special_found > 0:
-
-                    for special in res['hits']['hits']:
-                        source = special['_source']
-                        logger.debug('Special: %s', source)
-                        msg = "{title} is on special: {price}, {url}".format(
-                            title=source['title'],
-                            price=source['price'],
-                            url=source['url']
-                        )
-                        notifier.send_message(msg)
-
+                entries.append((title_entry.title,
+                                title_entry.get('operator', 'and')))
             except AttributeError as e:
-                logger.error(u'Failed to get the title: %s', e)
-            except KeyError as e:
-                logger.error(u'Invalid response: %s', e)
+                self.logger.error(u'Failed to get the title: %s', e)
+
+        # The titles are searched with one _msearch request per chunk, the
+        # chunks in parallel.
+        chunk_size = config.miner.msearch_chunk_size
+        results = self.context.map(
+            lambda chunk: self.search_specials(chunk, marks, floor),
+            [entries[start:start + chunk_size]
+             for start in range(0, len(entries), chunk_size)])
+        for chunk_marks in results:
+            marks.update(chunk_marks)
+        self.checkpoint.save({'marks': marks, 'notified': self.notified})
+
+    def search_specials(self, entries, marks, floor):
+        """
+        Search the specials of (title, operator) entries since their marks
+        with one _msearch request and notify the new ones
+        @return: dict of the new marks of the titles searched
+        """
+        new_marks = {}
+        if self.context.expired():
+            return new_marks
+        from_dates = [marks.get(self.title_key(title, operator), floor)
+                      for title, operator in entries]
+        body = []
+        for (title, operator), from_date in zip(entries, from_dates):
+            query = self.special_query(title, operator, from_date)
+            query['size'] = config.miner.special_page_size
+            # Indices of days without items don't exist
+            body.append({'index': self.search_index(from_date),
+                         'type': self.es_type,
+                         'ignore_unavailable': True})
+            body.append(query)
+        try:
+            res = self.es.msearch(body=body)
+        except TransportError as e:
+            self.logger.error(u'Failed to search specials: %s', e)
+            return new_marks
 
+        for (title, operator), from_date, response in zip(entries, from_dates,
+                                                           res['responses']):
+            try:
+                mark = self.process_specials(title, operator, from_date,
+                                             response)
+            except TransportError as e:
+                self.logger.error(u'Failed to search specials for %s: %s',
+                                  title, e)
+            except KeyError as e:
+                self.logger.error(u'Invalid response: %s', e)
+            else:
+                if mark is not None:
+                    new_marks[self.title_key(title, operator)] = mark
+        return new_marks
 
-class LowestPriceFinder(object):
+    def process_specials(self, title, operator, from_date, response):
+        """
+        Notify the specials of a title in its search response not notified
+        before, fetching the rest of them page by page if they don't fit in
+        the first one
+        @return: the date of the latest special, None if the search failed
+        """
+        if 'error' in response:
+            self.logger.error(u'Failed to search specials for %s: %s',
+                              title, response['error'])
+            return None
+
+        num_special_found = response['hits']['total']
+        SPECIALS_FOUND.inc(num_special_found)
+        self.logger.info(u'Found %d specials for %s from %s',
+                         num_special_found, title, from_date)
+
+        hits = response['hits']['hits']
+        offset = 0
+        mark = from_date
+        notified = 0
+        while hits:
+            for special in hits:
+                source = special['_source']
+                mark = max(mark, source['date'])
+                fingerprint = self.fingerprint(source)
+                with self.lock:
+                    if fingerprint in self.notified:
+                        continue
+                    self.notified[fingerprint] = source['date']
+                notified += 1
+                self.logger.debug('Special: %s', source)
+                msg = "{title} is on special: {price}, {url}".format(
+                    title=source['title'],
+                    price=source['price'],
+                    url=source['url']
+                )
+                self.notifier.send_message(msg)
+
+            offset += len(hits)
+            if offset >= num_special_found:
+                break
+            res = self.es.search(index=self.search_index(from_date),
+                                 doc_type=self.es_type,
+                                 ignore_unavailable=True,
+                                 body=self.special_query(title,
+                                                         operator,
+                                                         from_date),
+                                 from_=offset,
+                                 size=config.miner.special_page_size)
+            hits = res['hits']['hits']
+        SPECIALS_NOTIFIED.inc(notified)
+        return mark
+
+
+@register_stage
+class LowestPriceFinder(Stage):
 
     lowest_price_mapping = {
         'properties': {
@@ -110,6 +267,13 @@ class LowestPriceFinder(object):
 
     es_type = 'lowest_price'
 
+    def __init__(self, context):
+        super(LowestPriceFinder, self).__init__(context)
+        self.checkpoint = Checkpoint(config.miner.checkpoint_file)
+
+    def run(self):
+        self.update_lowest_price()
+
     @staticmethod
     def lowest_price_doc(title, price, per, vendor):
         """
@@ -125,29 +289,25 @@ class LowestPriceFinder(object):
         return lowest_price_doc
 
     @staticmethod
-    def lowest_price_query(title, per, vendor):
+    def lowest_price_id(title, per, vendor):
         """
-        Return a query to find the lowest price of an item in the elasticsearch
-        @return: lowest price query
+        Return the id of the lowest price document of an item
+        @return: document id
         """
-        lowest_price_query = \
-        {"query":
-             {
-               "bool": {
-                  "must": [
-                    { "term": {"title": title} },
-                    { "term": {"per": per} },
-                    { "term": {"vendor": vendor} }
-                   ]
-                }
-             }
-        }
-        if per is None:  # Remove term of 'per' if it's None
-            del lowest_price_query["query"]["bool"]["must"][1]
-
-        logger.debug(u'Query: %s', lowest_price_query)
-        return lowest_price_query
+        key = u'\x1f'.join((title, per or u'', vendor))
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()
 
+    def lowest_price_action(self, title, price, per, vendor):
+        """
+        Return a bulk index action of a lowest price document
+        @return: lowest price action
+        """
+        return {
+            '_index': self.context.lowest_price_index,
+            '_type': self.es_type,
+            '_id': self.lowest_price_id(title, per, vendor),
+            '_source': self.lowest_price_doc(title, price, per, vendor)
+        }
 
     def create_index_mapping(self):
         """
@@ -155,105 +315,228 @@ class LowestPriceFinder(object):
         """
         try:
             # Even fine if the index is existed.
-            es.indices.create(lowest_price_index, ignore=[400])
-            es.indices.put_mapping(doc_type=self.es_type,
-                                   body=self.lowest_price_mapping,
-                                   index=lowest_price_index)
+            self.es.indices.create(self.context.lowest_price_index,
+                                   ignore=[400])
+            self.es.indices.put_mapping(doc_type=self.es_type,
+                                        body=self.lowest_price_mapping,
+                                        index=self.context.lowest_price_index)
+        except TransportError as e:
+            self.logger.error(u'Failed to create index or mapping: %s', e)
+            return False
+        return True
+
+    def reset_index(self):
+        """
+        Delete the lowest price index and flag every lowest price as
+        changed, so the next run writes them all again under their current
+        document ids. Recorded prices which aren't found are written without
+        a notification.
+        @return: True if it succeeded
+        """
+        try:
+            self.es.indices.delete(self.context.lowest_price_index,
+                                   ignore=[404])
+            reset = self.session.query(LowestPrice).update(
+                {'changed': True}, synchronize_session=False)
+            self.session.commit()
         except TransportError as e:
-            logger.error(u'Failed to create index or mapping: %s', e)
+            self.logger.error(u'Failed to delete the lowest price index: %s',
+                              e)
+            return False
+        except (exc.DBAPIError,exc.InvalidRequestError) as e:
+            self.logger.error(u'Failed to flag the lowest prices: %s', e)
+            self.session.rollback()
             return False
+        self.logger.info(u'Deleted the lowest price index, %d lowest prices '
+                         u'will be written again', reset)
         return True
 
+    def refresh_lowest_prices(self):
+        """
+        Fold the items updated since the last run into the lowest_prices
+        table. Groups whose lowest price dropped are flagged as changed.
+        """
+        state = self.checkpoint.load({})
+        watermark = self.session.query(func.max(Item.updated_at)).scalar()
+        if watermark is None:
+            return
+
+        per = func.coalesce(Item.per, u'')
+        groups = select([Item.title,
+                         per,
+                         Item.vendor,
+                         func.min(Item.price),
+                         true()]
+                       ).where(Item.updated_at <= watermark
+                       ).group_by(Item.title, per, Item.vendor)
+        if state.get('updated_at'):
+            since = datetime.strptime(state['updated_at'],
+                                      Checkpoint.datetime_format)
+            # Rows committed late may carry an older updated_at, folding
+            # them in again is harmless.
+            overlap = timedelta(seconds=config.miner.checkpoint_overlap)
+            groups = groups.where(Item.updated_at > since - overlap)
+
+        table = LowestPrice.__table__
+        stmt = insert(table).from_select(
+            ['title', 'per', 'vendor', 'price', 'changed'], groups)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=['title', 'per', 'vendor'],
+            set_={'price': stmt.excluded.price, 'changed': True},
+            where=table.c.price > stmt.excluded.price)
+        self.session.execute(stmt)
+        self.session.commit()
+
+        state['updated_at'] = watermark.strftime(Checkpoint.datetime_format)
+        self.checkpoint.save(state)
+
     def update_lowest_price(self):
         """
-        Get the lowest prices from database and compare with the ones
-        recorded in the Elasticsearch. If found lower prices, then update.
+        Get the lowest prices changed since the last run from database and
+        compare with the ones recorded in the Elasticsearch. If found lower
+        prices, then update.
         """
 
         res = self.create_index_mapping()
         if not res:
-            logger.error(u'Failed to update lowest prices')
+            self.logger.error(u'Failed to update lowest prices')
             return
 
         try:
-            lowest_prices = dal.session.query(Item.title,
-                                              Item.per,
-                                              Item.vendor,
-                                              func.min(Item.price),
-                                             ).group_by(Item.title,
-                                                        Item.per,
-                                                        Item.vendor).all()
+            self.refresh_lowest_prices()
+            lowest_prices = self.session.query(LowestPrice.title,
+                                               LowestPrice.per,
+                                               LowestPrice.vendor,
+                                               LowestPrice.price,
+                                              ).filter(LowestPrice.changed).all()
         except (exc.DBAPIError,exc.InvalidRequestError) as e:
-            logger.error(u'Failed to get lowest prices from db: %s', e)
+            self.logger.error(u'Failed to get lowest prices from db: %s', e)
+            self.session.rollback()
             return
 
-        lowest_prices_dict = {(title, per, vendor): float(price)
-                              for title, per, vendor, price in
-                              lowest_prices}
+        lowest_prices = [((title, per or None, vendor), float(price))
+                         for title, per, vendor, price in lowest_prices]
+        self.logger.info(u'Lowest prices of %d items changed',
+                         len(lowest_prices))
+        LOWEST_PRICES_CHANGED.set(len(lowest_prices))
+
+        # Fetch the recorded lowest prices in chunks with mget, compare
+        # them in memory and send the new ones back in bulk.
+        chunk_size = config.miner.mget_chunk_size
+        results = self.context.map(self.compare_lowest_prices,
+                                   [lowest_prices[start:start + chunk_size]
+                                    for start in range(0, len(lowest_prices),
+                                                       chunk_size)])
+        synced = all(fetched for fetched, _ in results)
+        actions = [action for _, chunk_actions in results
+                   for action in chunk_actions]
+
+        if actions:
+            updated, errors = bulk(self.es, actions,
+                                   chunk_size=chunk_size,
+                                   raise_on_error=False,
+                                   raise_on_exception=False)
+            self.logger.info(u'Updated %d lowest prices', updated)
+            for error in errors:
+                self.logger.error(u'Error occurred when updating lowest price: %s',
+                                  error)
+                synced = False
+
+        if not synced:  # Keep the flags, so they are retried next run
+            return
+        try:
+            self.session.query(LowestPrice).filter(LowestPrice.changed).update(
+                {'changed': False}, synchronize_session=False)
+            self.session.commit()
+        except (exc.DBAPIError,exc.InvalidRequestError) as e:
+            self.logger.error(u'Failed to clear changed lowest prices: %s', e)
+            self.session.rollback()
 
+    def compare_lowest_prices(self, lowest_prices):
+        """
+        Compare ((title, per, vendor), price) pairs with the lowest prices
+        recorded in the elasticsearch and notify the lower ones
+        @return: whether the recorded prices were fetched, and the actions
+                 to record the new lowest prices
+        """
+        actions = []
+        if self.context.expired():
+            return False, actions
+        try:
+            res = self.es.mget(index=self.context.lowest_price_index,
+                               doc_type=self.es_type,
+                               body={'ids': [self.lowest_price_id(*t)
+                                             for t, _ in lowest_prices]})
+        except TransportError as e:
+            self.logger.error(u'Failed to get lowest prices: %s', e)
+            return False, actions
+
+        for (t, p), doc in zip(lowest_prices, res['docs']):
+            if not doc.get('found'):  # The item is not existed
+                self.logger.info(u'Lower price of %s found at the first time: %f',
+                                 t[0], p)
+                actions.append(self.lowest_price_action(t[0], p, t[1], t[2]))
+            elif p < float(doc['_source']['price']):
+                # If lower price of the item is found
+                msg = u'Lower price of "{item}" found at {vendor}: {price}'.format(
+                    item=t[0], price=p, vendor=t[2])
+                self.logger.info(msg)
+                self.notifier.send_message(msg)  # Send notification
+                LOWEST_PRICES_DROPPED.inc()
+                actions.append(self.lowest_price_action(t[0], p, t[1], t[2]))
+        return True, actions
+
+
+@register_stage
+class ItemPartitions(Stage):
+    """
+    Create the monthly partitions of the items table ahead of the dates
+    the crawlers send, rows without a partition end up in items_default
+    """
+
+    def run(self):
+        if self.session.bind.dialect.name != 'postgresql':
+            return
+        try:
+            if self.session.scalar(text(
+                    "SELECT to_regproc('create_items_partitions')")) is None:
+                return  # The items table is not partitioned
+            created = self.session.scalar(
+                text("SELECT create_items_partitions(current_date, "
+                     "(current_date + :months * interval '1 month')::date)"),
+                {'months': config.miner.partition_months_ahead})
+            self.session.commit()
+        except (exc.DBAPIError, exc.InvalidRequestError) as e:
+            self.logger.error(u'Failed to create items partitions: %s', e)
+            self.session.rollback()
+            return
+        if created:
+            self.logger.info(u'Created %d items partitions', created)
 
-        for t, p in lowest_prices_dict.items():
-            try:
-                logger.debug(u'Search entry %s', t)
-                res = es.search(index=lowest_price_index,
-                                doc_type=self.es_type,
-                                body=self.lowest_price_query(t[0], t[1], t[2]))
-
-                if not res['hits']['hits']:  # The item is not existed
-                    logger.info(u'Lower price of %s found at the first time: %f',
-                                t[0], p)
-                    es.create(index=lowest_price_index,
-                              doc_type=self.es_type,
-                              body=self.lowest_price_doc(t[0], p, t[1], t[2]))
-                else:
-                    item = res['hits']['hits'][0]
-                    price = float(item['_source']['price'])
-                    title = item['_source']['title']
-                    if p < price: # If lower price of the item is found
-                        msg = u'Lower price of "{item}" found at {vendor}: {price}'.format(
-                            item=t[0], price=p, vendor=t[2])
-                        logger.info(msg)
-                        notifier.send_message(msg)  # Send notification
-                        es.update(index=lowest_price_index,
-                                  doc_type=self.es_type,
-                                  id=item['_id'],
-                                  body={"doc": {"price": p}})
-                        logger.info(u'Updated item %s with price %f',
-                                 item['_id'], p)
-            except TransportError as e:
-                logger.error(u'Error occurred when updating lowest price: %s',
-                            e)
-def init():
-    global es, dal, logger, notifier, specialfinder_index, lowest_price_index
-    try:
-        logger = logging.getLogger(__file__)
-
-        # Configure db
-        dal = DataAccessLayer()
-        config_logger(logger)
-        dal.conn_str = config.db_conn
-        dal.connect()
-
-        # Configure elasticsearch
-        es = Elasticsearch(config.elasticsearch.hosts)
-        specialfinder_index = config.elasticsearch.index.special_items
-        lowest_price_index = config.elasticsearch.index.lowest_price
-        # Notifier
-        notifier = Notifier()
-    except AttributeError as e:
-        logger.fatal(u'Incomplete configuration: %s', e)
-        raise SystemExit(-1)
-    except (exc.DBAPIError,exc.InvalidRequestError) as e:
-        logger.fatal(u'Failed to connect to the db: %s', e)
-        raise SystemExit(-1)
-    except Exception as e:
-        logger.fatal(u'Failed to connect to the db')
-        raise SystemExit(-1)
 
 def main():
-    init()
-    LowestPriceFinder().update_lowest_price()
-    SpecialFinder().find_special()
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--reset-lowest-prices',
+                        help='Delete the lowest price index and write every '
+                             'lowest price again, once after upgrading from '
+                             'random document ids',
+                        action='store_true')
+    args = parser.parse_args()
+
+    metrics.start('miner')
+    context = MinerContext()
+    try:
+        if args.reset_lowest_prices:
+            finder = LowestPriceFinder(context)
+            finder.session = context.dal.Session()
+            try:
+                if not finder.reset_index():
+                    raise SystemExit(-1)
+            finally:
+                context.dal.Session.remove()
+        MinerRunner(context).run()
+    finally:
+        context.close()
 
 if __name__ == '__main__':
     main()
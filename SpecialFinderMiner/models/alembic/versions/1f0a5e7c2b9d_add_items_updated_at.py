@@ -0,0 +1,29 @@
+"""add items.updated_at
+
+Revision ID: 1f0a5e7c2b9d
+Revises: 4ddb3945194c
+Create Date: 2026-10-18 11:30:12.481902
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '1f0a5e7c2b9d'
+down_revision = '4ddb3945194c'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('items', sa.Column('updated_at', sa.DateTime(),
+                                     server_default=sa.text('now()'),
+                                     nullable=False))
+    op.create_index(op.f('ix_items_updated_at'), 'items', ['updated_at'],
+                    unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_items_updated_at'), table_name='items')
+    op.drop_column('items', 'updated_at')
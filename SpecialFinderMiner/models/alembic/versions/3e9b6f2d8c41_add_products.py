@@ -0,0 +1,81 @@
+"""add products
+
+Revision ID: 3e9b6f2d8c41
+Revises: 5b7e0c9d3a21
+Create Date: 2026-10-18 11:52:37.190263
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3e9b6f2d8c41'
+down_revision = '5b7e0c9d3a21'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table('products',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('title', sa.Unicode(length=255), nullable=False),
+    sa.Column('per', sa.String(length=25), server_default='', nullable=False),
+    sa.Column('signature', sa.LargeBinary(), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_table('product_titles',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('title', sa.Unicode(length=255), nullable=False),
+    sa.Column('per', sa.String(length=25), server_default='', nullable=False),
+    sa.Column('product_id', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['product_id'], ['products.id'], ),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('title', 'per')
+    )
+    op.create_index(op.f('ix_product_titles_product_id'), 'product_titles',
+                    ['product_id'], unique=False)
+    op.create_table('product_buckets',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('bucket', sa.BigInteger(), nullable=False),
+    sa.Column('product_id', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['product_id'], ['products.id'], ),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('bucket', 'product_id')
+    )
+    op.create_table('product_lowest_prices',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('product_id', sa.Integer(), nullable=False),
+    sa.Column('title', sa.Unicode(length=255), nullable=False),
+    sa.Column('vendor', sa.Unicode(length=50), nullable=False),
+    sa.Column('price', sa.Float(), nullable=False),
+    sa.Column('changed', sa.Boolean(), server_default=sa.false(),
+              nullable=False),
+    sa.ForeignKeyConstraint(['product_id'], ['products.id'], ),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('product_id')
+    )
+    op.create_index(op.f('ix_product_lowest_prices_changed'),
+                    'product_lowest_prices', ['changed'], unique=False)
+
+    # Added to every partition of items
+    op.add_column('items', sa.Column('product_id', sa.Integer(),
+                                     nullable=True))
+    op.create_foreign_key('items_product_id_fkey', 'items', 'products',
+                          ['product_id'], ['id'])
+    op.create_index(op.f('ix_items_product_id'), 'items', ['product_id'],
+                    unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_items_product_id'), table_name='items')
+    op.drop_constraint('items_product_id_fkey', 'items', type_='foreignkey')
+    op.drop_column('items', 'product_id')
+    op.drop_index(op.f('ix_product_lowest_prices_changed'),
+                  table_name='product_lowest_prices')
+    op.drop_table('product_lowest_prices')
+    op.drop_table('product_buckets')
+    op.drop_index(op.f('ix_product_titles_product_id'),
+                  table_name='product_titles')
+    op.drop_table('product_titles')
+    op.drop_table('products')
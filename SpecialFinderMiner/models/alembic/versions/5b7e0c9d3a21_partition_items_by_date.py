@@ -0,0 +1,136 @@
+"""partition items by date
+
+Revision ID: 5b7e0c9d3a21
+Revises: 8c3d2a91e4f7
+Create Date: 2026-10-18 11:44:02.613518
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '5b7e0c9d3a21'
+down_revision = '8c3d2a91e4f7'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+# Requires PostgreSQL 11: unique constraints, ON CONFLICT and indexes on a
+# partitioned table, default partitions and covering indexes.
+
+COLUMNS = 'id, title, price, per, url, image_url, date, vendor, updated_at'
+
+# Monthly partitions covering from_date to to_date. Rows of a month that
+# went to the default partition are moved to the new partition, otherwise
+# attaching it would fail.
+CREATE_PARTITIONS_FUNCTION = """
+CREATE OR REPLACE FUNCTION create_items_partitions(from_date date,
+                                                   to_date date)
+RETURNS integer AS $$
+DECLARE
+    month_start date := date_trunc('month', from_date);
+    month_end date;
+    partition_name text;
+    created integer := 0;
+BEGIN
+    WHILE month_start <= to_date LOOP
+        month_end := month_start + interval '1 month';
+        partition_name := 'items_' || to_char(month_start, '"y"YYYY"m"MM');
+        IF to_regclass(partition_name) IS NULL THEN
+            EXECUTE format('CREATE TABLE %I (LIKE items INCLUDING DEFAULTS)',
+                           partition_name);
+            EXECUTE format('WITH moved AS (DELETE FROM items_default '
+                           'WHERE date >= %L AND date < %L RETURNING *) '
+                           'INSERT INTO %I SELECT * FROM moved',
+                           month_start, month_end, partition_name);
+            EXECUTE format('ALTER TABLE items ATTACH PARTITION %I '
+                           'FOR VALUES FROM (%L) TO (%L)',
+                           partition_name, month_start, month_end);
+            created := created + 1;
+        END IF;
+        month_start := month_end;
+    END LOOP;
+    RETURN created;
+END;
+$$ LANGUAGE plpgsql
+"""
+
+
+def upgrade():
+    op.execute('ALTER TABLE items RENAME TO items_unpartitioned')
+    op.execute('ALTER TABLE items_unpartitioned '
+               'DROP CONSTRAINT items_pkey, '
+               'DROP CONSTRAINT items_title_date_key')
+    op.drop_index('ix_items_title', table_name='items_unpartitioned')
+    op.drop_index('ix_items_updated_at', table_name='items_unpartitioned')
+
+    # The partition key has to be part of the primary key.
+    op.execute("""
+        CREATE TABLE items (
+            id integer NOT NULL DEFAULT nextval('items_id_seq'),
+            title varchar(255) NOT NULL,
+            price double precision NOT NULL,
+            per varchar(25),
+            url varchar(255),
+            image_url varchar(255),
+            date date NOT NULL,
+            vendor varchar(50) NOT NULL,
+            updated_at timestamp without time zone NOT NULL DEFAULT now(),
+            CONSTRAINT items_pkey PRIMARY KEY (id, date),
+            CONSTRAINT items_title_date_key UNIQUE (title, date)
+        ) PARTITION BY RANGE (date)
+    """)
+    # Catches the dates no partition was created for yet.
+    op.execute('CREATE TABLE items_default PARTITION OF items DEFAULT')
+    op.create_index('ix_items_title', 'items', ['title'])
+    op.create_index('ix_items_date', 'items', ['date'])
+    op.create_index('ix_items_updated_at', 'items', ['updated_at'])
+    # Lets the lowest price aggregation run as an index-only scan
+    op.execute('CREATE INDEX ix_items_lowest_price '
+               'ON items (title, per, vendor, price) INCLUDE (updated_at)')
+
+    op.execute(CREATE_PARTITIONS_FUNCTION)
+    op.execute("SELECT create_items_partitions("
+               "coalesce((SELECT min(date) FROM items_unpartitioned), "
+               "current_date), (current_date + interval '3 months')::date)")
+
+    op.execute('INSERT INTO items (%s) SELECT %s FROM items_unpartitioned'
+               % (COLUMNS, COLUMNS))
+    op.execute('ALTER SEQUENCE items_id_seq OWNED BY items.id')
+    op.drop_table('items_unpartitioned')
+    op.execute('ANALYZE items')
+
+
+def downgrade():
+    op.execute('ALTER TABLE items RENAME TO items_partitioned')
+    op.execute('ALTER TABLE items_partitioned '
+               'DROP CONSTRAINT items_pkey, '
+               'DROP CONSTRAINT items_title_date_key')
+    op.drop_index('ix_items_lowest_price', table_name='items_partitioned')
+    op.drop_index('ix_items_updated_at', table_name='items_partitioned')
+    op.drop_index('ix_items_date', table_name='items_partitioned')
+    op.drop_index('ix_items_title', table_name='items_partitioned')
+
+    op.create_table('items',
+    sa.Column('id', sa.Integer(), nullable=False,
+              server_default=sa.text("nextval('items_id_seq')")),
+    sa.Column('title', sa.Unicode(length=255), nullable=False),
+    sa.Column('price', sa.Float(), nullable=False),
+    sa.Column('per', sa.String(length=25), nullable=True),
+    sa.Column('url', sa.String(length=255), nullable=True),
+    sa.Column('image_url', sa.String(length=255), nullable=True),
+    sa.Column('date', sa.Date(), nullable=False),
+    sa.Column('vendor', sa.Unicode(length=50), nullable=False),
+    sa.Column('updated_at', sa.DateTime(), server_default=sa.text('now()'),
+              nullable=False),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('title', 'date')
+    )
+    op.create_index('ix_items_title', 'items', ['title'])
+    op.create_index('ix_items_updated_at', 'items', ['updated_at'])
+
+    op.execute('INSERT INTO items (%s) SELECT %s FROM items_partitioned'
+               % (COLUMNS, COLUMNS))
+    op.execute('ALTER SEQUENCE items_id_seq OWNED BY items.id')
+    op.execute('DROP TABLE items_partitioned')  # With its partitions
+    op.execute('DROP FUNCTION create_items_partitions(date, date)')
@@ -0,0 +1,37 @@
+"""add lowest_prices
+
+Revision ID: 8c3d2a91e4f7
+Revises: 1f0a5e7c2b9d
+Create Date: 2026-10-18 11:41:53.018274
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '8c3d2a91e4f7'
+down_revision = '1f0a5e7c2b9d'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table('lowest_prices',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('title', sa.Unicode(length=255), nullable=False),
+    sa.Column('per', sa.String(length=25), server_default='', nullable=False),
+    sa.Column('vendor', sa.Unicode(length=50), nullable=False),
+    sa.Column('price', sa.Float(), nullable=False),
+    sa.Column('changed', sa.Boolean(), server_default=sa.false(),
+              nullable=False),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('title', 'per', 'vendor')
+    )
+    op.create_index(op.f('ix_lowest_prices_changed'), 'lowest_prices',
+                    ['changed'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_lowest_prices_changed'), table_name='lowest_prices')
+    op.drop_table('lowest_prices')
@@ -1,19 +1,129 @@
-from sqlalchemy import (Column, Integer, String, Unicode,
-                        Float, Date, create_engine, UniqueConstraint)
-from sqlalchemy.orm import sessionmaker, Session
+from sqlalchemy import (Column, Integer, BigInteger, String, Unicode, Float,
+                        Date, DateTime, Boolean, LargeBinary, ForeignKey,
+                        create_engine, UniqueConstraint, Index, event, exc,
+                        select)
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.sql import func, false
+from sqlalchemy.orm import sessionmaker, scoped_session, Session
 from sqlalchemy.ext.declarative import declarative_base
+from contextlib import contextmanager
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())  # Callers pass their own
+
+_engines = {}
+_engines_lock = threading.Lock()
+
+
+def _ping_connection(connection, branch):
+    """
+    Test a connection when it's checked out from the pool, a stale one is
+    replaced before the statement fails on it. The pre-ping recipe of the
+    SQLAlchemy docs, for versions before pool_pre_ping.
+    """
+    if branch:
+        return
+    save_should_close_with_result = connection.should_close_with_result
+    connection.should_close_with_result = False
+    try:
+        connection.scalar(select([1]))
+    except exc.DBAPIError as err:
+        # The whole pool was invalidated, this runs again on a new one
+        if err.connection_invalidated:
+            connection.scalar(select([1]))
+        else:
+            raise
+    finally:
+        connection.should_close_with_result = save_should_close_with_result
+
+
+def get_engine(conn_str, pre_ping=True, **options):
+    """
+    Return the engine of a db url, created once per process so the pool
+    is shared by every DataAccessLayer. Forked processes get their own.
+    @return: engine
+    """
+    if make_url(conn_str).get_backend_name() == 'sqlite':
+        options = {}  # SQLite doesn't use a QueuePool
+    key = (os.getpid(), conn_str, pre_ping, tuple(sorted(options.items())))
+    with _engines_lock:
+        engine = _engines.get(key)
+        if engine is None:
+            engine = create_engine(conn_str, **options)
+            if pre_ping:
+                event.listen(engine, 'engine_connect', _ping_connection)
+            _engines[key] = engine
+    return engine
+
 
 class DataAccessLayer(object):
 
-    def __init__(self):
+    def __init__(self, conn_str=None, pre_ping=True, **engine_options):
         self.engine = None
-        self.conn_str = None
+        self.conn_str = conn_str
+        self.pre_ping = pre_ping
+        # pool_size, max_overflow, pool_timeout, pool_recycle...
+        self.engine_options = engine_options
+        self.Session = None
 
     def connect(self):
-        self.engine = create_engine(self.conn_str)
-        self.Session = sessionmaker(bind=self.engine)
-        self.session = self.Session()
-        self.engine.connect()
+        self.engine = get_engine(self.conn_str, self.pre_ping,
+                                 **self.engine_options)
+        # Sessions are per thread, Session() returns the one of the caller.
+        self.Session = scoped_session(sessionmaker(bind=self.engine))
+        self.engine.connect().close()
+
+    @property
+    def session(self):
+        return self.Session()
+
+    @contextmanager
+    def session_scope(self):
+        """
+        Provide a session for a unit of work, committed if the block
+        succeeds, rolled back if it raises, and closed in any case
+        """
+        session = self.Session()
+        try:
+            yield session
+            session.commit()
+        except:
+            session.rollback()
+            raise
+        finally:
+            self.Session.remove()
+
+    def ping(self):
+        """
+        Return True if the db can be reached
+        """
+        try:
+            self.engine.connect().close()
+        except exc.DBAPIError:
+            return False
+        return True
+
+    def reconnect(self, timeout=None, delay=0.5, max_delay=30, logger=logger):
+        """
+        Drop the session of the thread and wait for the db to be reachable,
+        retrying with exponential backoff. The pooled connections broken by
+        an outage are replaced on checkout.
+        @return: True once the db is reachable, False if timeout seconds
+                 passed first
+        """
+        self.Session.remove()
+        deadline = time.time() + timeout if timeout is not None else None
+        while not self.ping():
+            if deadline is not None and time.time() + delay > deadline:
+                return False
+            logger.warning(u'DB unreachable, retrying in %.1fs', delay)
+            time.sleep(delay)
+            delay = min(delay * 2, max_delay)
+        return True
 
 class Base(object):
     id = Column(Integer, primary_key=True)
@@ -22,12 +132,78 @@ Base = declarative_base(cls=Base)
 
 class Item(Base):
     __tablename__ = 'items'
-    __table_args__ = (UniqueConstraint('title', 'date'), )
+    # On PostgreSQL the table is partitioned by month of date, see the
+    # partition_items_by_date migration, which also adds updated_at as an
+    # INCLUDE column of ix_items_lowest_price.
+    __table_args__ = (UniqueConstraint('title', 'date'),
+                      Index('ix_items_lowest_price',
+                            'title', 'per', 'vendor', 'price'), )
 
     title = Column(Unicode(255), nullable=False, index=True)
     price = Column(Float, nullable=False)
     per = Column(String(25), nullable=True)
     url = Column(String(255), nullable=True)
     image_url = Column(String(255), nullable=True)
-    date = Column(Date, nullable=False)
+    date = Column(Date, nullable=False, index=True)
     vendor = Column(Unicode(50), nullable=False)
+    updated_at = Column(DateTime, nullable=False, index=True,
+                        server_default=func.now())
+    # Assigned by the miner's ProductMatcher, NULL until then.
+    product_id = Column(Integer, ForeignKey('products.id'), nullable=True,
+                        index=True)
+
+class LowestPrice(Base):
+    __tablename__ = 'lowest_prices'
+    __table_args__ = (UniqueConstraint('title', 'per', 'vendor'), )
+
+    title = Column(Unicode(255), nullable=False)
+    # Empty rather than NULL, so (title, per, vendor) stays unique.
+    per = Column(String(25), nullable=False, server_default='')
+    vendor = Column(Unicode(50), nullable=False)
+    price = Column(Float, nullable=False)
+    # Price dropped but not yet synced to the elasticsearch.
+    changed = Column(Boolean, nullable=False, index=True,
+                     server_default=false())
+
+class Product(Base):
+    """
+    A product sold under similar titles, possibly by several vendors
+    """
+    __tablename__ = 'products'
+
+    title = Column(Unicode(255), nullable=False)  # The first title seen
+    per = Column(String(25), nullable=False, server_default='')
+    # MinHash of the normalised title, see products.py
+    signature = Column(LargeBinary, nullable=False)
+
+class ProductTitle(Base):
+    __tablename__ = 'product_titles'
+    __table_args__ = (UniqueConstraint('title', 'per'), )
+
+    title = Column(Unicode(255), nullable=False)
+    per = Column(String(25), nullable=False, server_default='')
+    product_id = Column(Integer, ForeignKey('products.id'), nullable=False,
+                        index=True)
+
+class ProductBucket(Base):
+    """
+    The LSH buckets of a product, products sharing one are candidates for
+    the same product
+    """
+    __tablename__ = 'product_buckets'
+    __table_args__ = (UniqueConstraint('bucket', 'product_id'), )
+
+    bucket = Column(BigInteger, nullable=False)
+    product_id = Column(Integer, ForeignKey('products.id'), nullable=False)
+
+class ProductLowestPrice(Base):
+    __tablename__ = 'product_lowest_prices'
+
+    product_id = Column(Integer, ForeignKey('products.id'), nullable=False,
+                        unique=True)
+    title = Column(Unicode(255), nullable=False)
+    vendor = Column(Unicode(50), nullable=False)
+    price = Column(Float, nullable=False)
+    # Price dropped but not notified yet.
+    changed = Column(Boolean, nullable=False, index=True,
+                     server_default=false())
@@ -1,9 +1,31 @@
 import telepot
 from config import config
+from utils import config_logger
+import metrics
+from collections import OrderedDict
+from itertools import izip_longest
+from Queue import Queue
+import logging
+import threading
+import time
+
+MESSAGES_SENT = metrics.counter('notifier_messages_sent_total',
+                                'Notifications sent')
+SEND_FAILURES = metrics.counter('notifier_send_failures_total',
+                                'Failed attempts to send a notification')
+
+class TelegramTransport(object):
+    def __init__(self, bot_id=None):
+        self.bot = telepot.Bot(bot_id or config.telegram_bot_id)
+
+    def send(self, chat_id, msg):
+        self.bot.sendMessage(chat_id, msg)
+
 
 class Notifier(object):
-    def __init__(self, receivers=None):
-        self.bot = telepot.Bot(config.telegram_bot_id)
+    def __init__(self, receivers=None, transport=None):
+        # Anything with a send(chat_id, msg) method, e.g. a fake bot in tests
+        self.transport = transport or TelegramTransport()
         if receivers:
             self.receivers = receivers
         else:
@@ -13,4 +35,139 @@ class Notifier(object):
         if receivers is None:
             receivers = self.receivers
         for name, no in receivers.items():
-            self.bot.sendMessage(no['telegram'], msg)
+            self.transport.send(no['telegram'], msg)
+
+    def close(self):
+        pass
+
+
+class AsyncNotifier(Notifier):
+    """
+    Notifier which sends messages from a pool of background threads, so
+    callers never wait for the Telegram round trip. In digest mode the
+    messages are held until flush() and coalesced into as few messages per
+    receiver as possible. Messages to a chat are at least chat_interval
+    seconds apart, and any two messages at least global_interval apart.
+    """
+
+    max_message_length = 4096  # Telegram limit
+
+    def __init__(self, receivers=None, transport=None):
+        super(AsyncNotifier, self).__init__(receivers, transport)
+        self.logger = logging.getLogger(type(self).__name__)
+        config_logger(self.logger)
+
+        notification_config = config.notification
+        self.digest = notification_config.digest
+        self.chat_interval = notification_config.chat_interval
+        self.global_interval = notification_config.global_interval
+        self.retries = notification_config.retries
+
+        self.lock = threading.Lock()
+        self.pending = OrderedDict()  # chat id -> messages for the digest
+        self.chats = {}  # chat id -> [lock, time of the last message]
+        self.rate_lock = threading.Lock()
+        self.last_sent = 0
+
+        self.queue = Queue()
+        self.workers = []
+        for _ in range(notification_config.workers):
+            worker = threading.Thread(target=self._work)
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def send_message(self, msg, receivers=None):
+        if receivers is None:
+            receivers = self.receivers
+        for name, no in receivers.items():
+            if self.digest:
+                with self.lock:
+                    self.pending.setdefault(no['telegram'], []).append(msg)
+            else:
+                self.queue.put((no['telegram'], msg))
+
+    def flush(self, wait=True):
+        """
+        Queue the digests and, unless wait is False, block until every
+        queued message is sent
+        """
+        with self.lock:
+            pending, self.pending = self.pending, OrderedDict()
+        # Take turns between the chats, so the workers aren't all held up
+        # by the rate limit of one chat.
+        digests = [[(chat_id, msg) for msg in self.digest_messages(msgs)]
+                   for chat_id, msgs in pending.items()]
+        for jobs in izip_longest(*digests):
+            for job in jobs:
+                if job is not None:
+                    self.queue.put(job)
+        if wait:
+            self.queue.join()
+
+    def close(self):
+        self.flush()
+        for _ in self.workers:
+            self.queue.put(None)
+        for worker in self.workers:
+            worker.join()
+
+    @classmethod
+    def digest_messages(cls, msgs):
+        """
+        Join messages with newlines into as few messages as the Telegram
+        length limit allows
+        @return: list of messages
+        """
+        digests = []
+        digest = u''
+        for msg in msgs:
+            msg = msg[:cls.max_message_length]
+            if digest and \
+                    len(digest) + 1 + len(msg) > cls.max_message_length:
+                digests.append(digest)
+                digest = u''
+            digest = digest + u'\n' + msg if digest else msg
+        if digest:
+            digests.append(digest)
+        return digests
+
+    def _work(self):
+        while True:
+            job = self.queue.get()
+            try:
+                if job is None:
+                    return
+                self._send(*job)
+            finally:
+                self.queue.task_done()
+
+    def _wait(self, last_sent, interval):
+        delay = last_sent + interval - time.time()
+        if delay > 0:
+            time.sleep(delay)
+
+    def _send(self, chat_id, msg):
+        with self.lock:
+            chat = self.chats.setdefault(chat_id, [threading.Lock(), 0])
+        with chat[0]:  # One message at a time per chat, in order
+            self._wait(chat[1], self.chat_interval)
+            for attempt in range(self.retries + 1):
+                with self.rate_lock:
+                    self._wait(self.last_sent, self.global_interval)
+                    self.last_sent = time.time()
+                try:
+                    self.transport.send(chat_id, msg)
+                    MESSAGES_SENT.inc()
+                    break
+                except Exception as e:
+                    self.logger.error(u'Failed to send message to %s: %s',
+                                      chat_id, e)
+                    SEND_FAILURES.inc()
+                    if attempt < self.retries:
+                        time.sleep(self.chat_interval * 2 ** attempt)
+            else:
+                self.logger.error(u'Gave up sending message to %s after %d '
+                                  u'attempts: %s', chat_id, self.retries + 1,
+                                  msg)
+            chat[1] = time.time()
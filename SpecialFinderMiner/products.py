@@ -0,0 +1,412 @@
+from sqlalchemy.sql import select, func, exists, and_, tuple_
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy import exc
+from datetime import date, timedelta
+from models.tables import (Item, Product, ProductTitle, ProductBucket,
+                           ProductLowestPrice)
+from runner import Stage, register_stage
+from config import config
+import metrics
+import hashlib
+import random
+import re
+import struct
+import zlib
+import numpy as np
+
+PRODUCTS_CREATED = metrics.counter('miner_products_created_total',
+                                   'Products created for unmatched titles')
+TITLES_MATCHED = metrics.counter('miner_product_titles_matched_total',
+                                 'Titles matched to an existing product')
+CROSS_VENDOR_DROPPED = metrics.counter(
+    'miner_cross_vendor_prices_dropped_total',
+    'Lower prices of a product across vendors notified')
+
+STOPWORDS = frozenset([u'a', u'and', u'for', u'in', u'of', u'the', u'with'])
+_SIZE = re.compile(r'(?:(\d+)\s*x\s*)?(\d+(?:\.\d+)?)\s*'
+                   r'(kg|g|ml|l|pk|pack)\b', re.UNICODE)
+_TOKEN = re.compile(r'(?:\d+x)?\d+(?:\.\d+)?[a-z]+|[^\W_]+', re.UNICODE)
+_DIGIT = re.compile(r'\d')
+_UNITS = {u'g': (u'kg', 1000), u'ml': (u'l', 1000), u'pack': (u'pk', None)}
+
+# Changing the seed or the number of permutations invalidates the
+# signatures stored in the products table.
+SEED = 20160501
+NUM_PERM = 64
+
+
+def _size(match):
+    count, value, unit = match.groups()
+    value = float(value)
+    bigger, factor = _UNITS.get(unit, (unit, None))
+    if factor is None:
+        unit = bigger
+    elif value >= factor:
+        value, unit = value / factor, bigger
+    if count:  # A multipack like "24 x 375ml"
+        return u'%sx%g%s' % (count, value, unit)
+    return u'%g%s' % (value, unit)
+
+
+def normalize_title(title):
+    """
+    Split a title into lowercase tokens, sizes like "1000 g" become "1kg"
+    and "24 x 375mL" becomes "24x375ml". Tokens with digits, sizes or
+    model numbers, are returned apart as titles only match if they agree
+    on them.
+    @return: list of the words, frozenset of the tokens with digits
+    """
+    text = _SIZE.sub(lambda match: u' %s ' % _size(match), title.lower())
+    words = []
+    numbers = set()
+    for token in _TOKEN.findall(text):
+        if _DIGIT.search(token):
+            numbers.add(token)
+        elif token not in STOPWORDS:
+            words.append(token)
+    return words, frozenset(numbers)
+
+
+def shingles(words, numbers):
+    """
+    Return the hashes of the words and numbers, and of the character
+    trigrams of the words, which make titles with typos or plurals similar
+    @return: list of 32 bit hashes
+    """
+    features = set(words) | numbers
+    for word in words:
+        padded = u'^%s$' % word
+        features.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return [zlib.crc32(feature.encode('utf-8')) & 0xffffffff
+            for feature in features]
+
+
+def _permutations(num_perm, seed):
+    rng = random.Random(seed)
+    # Multiply-shift hashing, wrapping around 2**64 is part of the scheme
+    a = np.array([rng.getrandbits(64) | 1 for _ in range(num_perm)],
+                 dtype=np.uint64)
+    b = np.array([rng.getrandbits(64) for _ in range(num_perm)],
+                 dtype=np.uint64)
+    return a, b
+
+_A, _B = _permutations(NUM_PERM, SEED)
+_SHIFT = np.uint64(32)
+
+
+def minhash(hashes):
+    """
+    Return the MinHash signature of a set of hashes, the share of equal
+    values of two signatures estimates the Jaccard similarity of the sets
+    @return: array of NUM_PERM uint32
+    """
+    x = np.asarray(hashes, dtype=np.uint64)
+    if not len(x):
+        return np.zeros(NUM_PERM, dtype=np.uint32)
+    with np.errstate(over='ignore'):
+        values = (np.outer(_A, x) + _B[:, None]) >> _SHIFT
+    return values.min(axis=1).astype(np.uint32)
+
+
+def similarity(signature, other):
+    return np.count_nonzero(signature == other) / float(len(signature))
+
+
+def buckets(signature, bands):
+    """
+    Return the LSH buckets of a signature, one per band of rows. Titles
+    sharing a bucket are likely similar, the more bands the lower the
+    similarity they catch.
+    @return: list of 60 bit bucket ids
+    """
+    rows = len(signature) // bands
+    return [int(hashlib.md5(struct.pack('<B', band) +
+                            signature[band * rows:(band + 1) * rows]
+                            .tobytes()).hexdigest()[:15], 16)
+            for band in range(bands)]
+
+
+def encode_signature(signature):
+    return signature.astype('<u4').tobytes()
+
+
+def decode_signature(data):
+    return np.frombuffer(bytes(data), dtype='<u4')
+
+
+class ProductIndex(object):
+    """
+    Match titles to products through the LSH buckets of their signatures.
+    A title goes to the most similar candidate with the same per and
+    numbers, or to a new product if none is similar enough.
+    """
+
+    def __init__(self, session, bands, threshold):
+        self.session = session
+        self.bands = bands
+        self.threshold = threshold
+        self.buckets = {}  # bucket -> set of product ids
+        self.products = {}  # product id -> (per, numbers, signature)
+
+    def load(self, bucket_ids):
+        """
+        Load the products of the buckets which aren't known yet
+        """
+        missing = [bucket for bucket in bucket_ids
+                   if bucket not in self.buckets]
+        for bucket in missing:
+            self.buckets[bucket] = set()
+        if not missing:
+            return
+        rows = self.session.execute(
+            select([ProductBucket.bucket, ProductBucket.product_id]
+                   ).where(ProductBucket.bucket.in_(missing))).fetchall()
+        for bucket, product_id in rows:
+            self.buckets[bucket].add(product_id)
+        product_ids = set(product_id for _, product_id in rows
+                          if product_id not in self.products)
+        if not product_ids:
+            return
+        for product_id, title, per, signature in self.session.execute(
+                select([Product.id, Product.title, Product.per,
+                        Product.signature]
+                       ).where(Product.id.in_(product_ids))):
+            self.products[product_id] = (per, normalize_title(title)[1],
+                                         decode_signature(signature))
+
+    def find(self, per, numbers, signature, bucket_ids):
+        """
+        @return: id of the most similar product, None if none is similar
+                 enough
+        """
+        candidates = set()
+        for bucket in bucket_ids:
+            candidates.update(self.buckets[bucket])
+        best, best_similarity = None, self.threshold
+        for product_id in candidates:
+            product_per, product_numbers, product_signature = \
+                self.products[product_id]
+            if product_per != per or product_numbers != numbers:
+                continue
+            candidate_similarity = similarity(signature, product_signature)
+            if candidate_similarity >= best_similarity:
+                best, best_similarity = product_id, candidate_similarity
+        return best
+
+    def add(self, product_id, per, numbers, signature, bucket_ids):
+        for bucket in bucket_ids:
+            self.buckets[bucket].add(product_id)
+        self.products[product_id] = (per, numbers, signature)
+
+    def match(self, titles):
+        """
+        Match (title, per) pairs to products, creating the products of the
+        titles matching none. Titles are matched to the products created
+        before them too. The caller commits.
+        @return: list of the product ids, number of products created
+        """
+        entries = []
+        for title, per in titles:
+            words, numbers = normalize_title(title)
+            signature = minhash(shingles(words, numbers))
+            entries.append((title, per, numbers, signature,
+                            buckets(signature, self.bands)))
+        self.load(set(bucket for entry in entries for bucket in entry[4]))
+
+        matches = []
+        new = []
+        for entry in entries:
+            title, per, numbers, signature, bucket_ids = entry
+            product_id = self.find(per, numbers, signature, bucket_ids)
+            if product_id is None:
+                # Negative until the product is inserted
+                product_id = -1 - len(new)
+                new.append(entry)
+                self.add(product_id, per, numbers, signature, bucket_ids)
+            matches.append(product_id)
+
+        ids = self.create(new)
+        return [ids.get(product_id, product_id)
+                for product_id in matches], len(new)
+
+    def create(self, entries):
+        """
+        Insert the products of new titles with a single INSERT
+        @return: dict of the temporary ids to the product ids
+        """
+        if not entries:
+            return {}
+        products = Product.__table__
+        rows = self.session.execute(
+            products.insert().values([
+                {'title': title, 'per': per,
+                 'signature': encode_signature(signature)}
+                for title, per, _, signature, _ in entries]
+            ).returning(products.c.id, products.c.title,
+                        products.c.per)).fetchall()
+        created = {(title, per): product_id
+                   for product_id, title, per in rows}
+
+        ids = {}
+        bucket_rows = []
+        for index, (title, per, numbers, signature, bucket_ids) in \
+                enumerate(entries):
+            product_id = created[(title, per)]
+            ids[-1 - index] = product_id
+            for bucket in bucket_ids:
+                self.buckets[bucket].discard(-1 - index)
+            self.add(product_id, per, numbers, signature, bucket_ids)
+            del self.products[-1 - index]
+            bucket_rows.extend({'bucket': bucket, 'product_id': product_id}
+                               for bucket in set(bucket_ids))
+        self.session.execute(ProductBucket.__table__.insert(), bucket_rows)
+        return ids
+
+
+@register_stage
+class ProductMatcher(Stage):
+    """
+    Assign the items without a product to one. Titles seen before keep
+    their product, new ones are matched by similarity, so the same product
+    sold by several vendors or under slightly different titles gets one id.
+    """
+
+    def run(self):
+        # Products are inserted with INSERT ... RETURNING
+        if self.session.bind.dialect.name != 'postgresql':
+            self.logger.warning(u'ProductMatcher needs Postgres')
+            return
+        try:
+            index = ProductIndex(self.session, config.miner.product_bands,
+                                 config.miner.product_threshold)
+            while not self.context.expired():
+                titles = self.unmatched_titles(
+                    config.miner.product_chunk_size)
+                if not titles:
+                    break
+                self.match_titles(index, titles)
+            self.assign_products()
+        except (exc.DBAPIError,exc.InvalidRequestError) as e:
+            self.logger.error(u'Failed to match products: %s', e)
+            self.session.rollback()
+
+    @staticmethod
+    def title_matched():
+        """
+        @return: condition of a product title matching an item
+        """
+        return and_(ProductTitle.title == Item.title,
+                    ProductTitle.per == func.coalesce(Item.per, u''))
+
+    def unmatched_titles(self, limit):
+        """
+        @return: list of (title, per) never matched to a product
+        """
+        per = func.coalesce(Item.per, u'')
+        return self.session.execute(
+            select([Item.title, per]
+                   ).where(Item.product_id.is_(None)
+                   ).where(~exists().where(self.title_matched())
+                   ).group_by(Item.title, per
+                   ).limit(limit)).fetchall()
+
+    def match_titles(self, index, titles):
+        product_ids, created = index.match(titles)
+        self.session.execute(ProductTitle.__table__.insert(),
+                             [{'title': title, 'per': per,
+                               'product_id': product_id}
+                              for (title, per), product_id in
+                              zip(titles, product_ids)])
+        self.session.commit()
+        PRODUCTS_CREATED.inc(created)
+        TITLES_MATCHED.inc(len(titles) - created)
+        self.logger.info(u'Matched %d titles, %d new products',
+                         len(titles), created)
+
+    def assign_products(self):
+        """
+        Set the product of the items without one from their title
+        """
+        matched = self.title_matched()
+        stmt = Item.__table__.update().values(
+            product_id=select([ProductTitle.product_id]
+                              ).where(matched).as_scalar()
+        ).where(Item.product_id.is_(None)).where(exists().where(matched))
+        assigned = self.session.execute(stmt).rowcount
+        self.session.commit()
+        self.logger.info(u'Assigned the products of %d items', assigned)
+
+
+@register_stage
+class CrossVendorFinder(Stage):
+    """
+    Track the lowest recent price of every product across the vendors and
+    notify when it drops. Runs after ProductMatcher, so the items it just
+    matched are compared in the same run.
+    """
+
+    after = ('ProductMatcher', )
+
+    def run(self):
+        if self.session.bind.dialect.name != 'postgresql':
+            self.logger.warning(u'CrossVendorFinder needs Postgres')
+            return
+        fresh = date.today() - timedelta(days=config.miner.cross_vendor_days)
+        try:
+            changed = self.refresh_lowest_prices(fresh)
+        except (exc.DBAPIError,exc.InvalidRequestError) as e:
+            self.logger.error(u'Failed to refresh the lowest prices of the '
+                              u'products: %s', e)
+            self.session.rollback()
+            return
+
+        for title, vendor, price in changed:
+            self.notifier.send_message(
+                u'Lowest price of "{item}" across vendors dropped to '
+                u'{price:.2f} at {vendor}'.format(item=title, price=price,
+                                              vendor=vendor))
+        CROSS_VENDOR_DROPPED.inc(len(changed))
+        self.logger.info(u'Lowest prices of %d products dropped',
+                         len(changed))
+
+    def refresh_lowest_prices(self, fresh):
+        """
+        Replace the lowest price of every product seen since fresh by its
+        cheapest item since then, the price may go up as cheap offers age
+        out. A product's first price is recorded without a notification.
+        Products without fresh items keep their last price until they're
+        seen again.
+        @return: list of (title, vendor, price) which dropped
+        """
+        # DISTINCT ON keeps the cheapest row of every product
+        cheapest = select([Item.product_id,
+                           Item.title,
+                           Item.vendor,
+                           Item.price]
+                         ).distinct(Item.product_id
+                         ).where(Item.product_id.isnot(None)
+                         ).where(Item.date >= fresh
+                         ).order_by(Item.product_id, Item.price)
+        table = ProductLowestPrice.__table__
+        stmt = insert(table).from_select(
+            ['product_id', 'title', 'vendor', 'price'], cheapest)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=['product_id'],
+            set_={'title': stmt.excluded.title,
+                  'vendor': stmt.excluded.vendor,
+                  'price': stmt.excluded.price,
+                  'changed': table.c.price > stmt.excluded.price},
+            where=tuple_(table.c.title, table.c.vendor,
+                         table.c.price).is_distinct_from(
+                tuple_(stmt.excluded.title, stmt.excluded.vendor,
+                       stmt.excluded.price)))
+        self.session.execute(stmt)
+        changed = self.session.query(ProductLowestPrice.title,
+                                     ProductLowestPrice.vendor,
+                                     ProductLowestPrice.price
+                                    ).filter(ProductLowestPrice.changed).all()
+        self.session.query(ProductLowestPrice).filter(
+            ProductLowestPrice.changed).update({'changed': False},
+                                               synchronize_session=False)
+        self.session.commit()
+        return changed
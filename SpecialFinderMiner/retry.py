@@ -0,0 +1,209 @@
+from kombu import Exchange, Producer, Queue
+import time
+
+# Headers of the results sent to the retry and dead letter queues
+ATTEMPTS_HEADER = 'x-attempts'
+ERROR_HEADER = 'x-error'
+RETRY_AT_HEADER = 'x-retry-at'
+# Added by RabbitMQ when a retry expires, it'd only grow
+DEATH_HEADER = 'x-death'
+
+# Queues are addressed by name through the default exchange
+DEFAULT_EXCHANGE = Exchange('')
+
+
+def backoff_delays(delay, retries):
+    """
+    @return: list of the delays in seconds before every retry, doubled
+             every time
+    """
+    return [delay * 2 ** attempt for attempt in range(retries)]
+
+
+def attempts(message):
+    """
+    @return: number of times a result was retried
+    """
+    return int(message.headers.get(ATTEMPTS_HEADER) or 0)
+
+
+class RetryQueues(object):
+    """
+    Delayed retries of the results which failed unexpectedly, and a dead
+    letter queue for the ones which ran out of attempts or can't be written.
+
+    Every retry has its own queue, named after its delay. On RabbitMQ the
+    queue's message TTL holds the results back and dead-letters them to the
+    results queue once expired. Other transports, like the in-memory one,
+    ignore these arguments, the dumper moves the due results back itself.
+    """
+
+    def __init__(self, connection, queue_name, delays):
+        """
+        @param connection: kombu connection
+        @param queue_name: name of the results queue
+        @param delays: seconds before every retry
+        """
+        self.connection = connection
+        self.queue_name = queue_name
+        self.delays = delays
+        self.channel = connection.channel()
+        self.producer = Producer(self.channel, exchange=DEFAULT_EXCHANGE)
+        self.broker_delay = connection.transport.driver_type == 'amqp'
+
+        self.retry_queues = []
+        for delay in delays:
+            ttl = int(delay * 1000)
+            self.retry_queues.append(Queue(
+                '%s.retry.%d' % (queue_name, ttl),
+                exchange=DEFAULT_EXCHANGE,
+                queue_arguments={
+                    'x-message-ttl': ttl,
+                    'x-dead-letter-exchange': '',
+                    'x-dead-letter-routing-key': queue_name,
+                },
+                durable=True))
+        self.dead_letter_queue = Queue('%s.dead' % queue_name,
+                                       exchange=DEFAULT_EXCHANGE,
+                                       durable=True)
+
+    def declare(self):
+        for queue in self.retry_queues + [self.dead_letter_queue]:
+            queue(self.channel).declare()
+
+    def close(self):
+        self.channel.close()
+
+    def publish(self, message, queue_name, headers):
+        """
+        Publish the raw body of a consumed message to a queue, the body is
+        neither decoded nor serialized again
+        """
+        self.producer.publish(message.body,
+                              routing_key=queue_name,
+                              content_type=message.content_type,
+                              content_encoding=message.content_encoding,
+                              headers=headers,
+                              delivery_mode=2,
+                              timestamp=message.properties.get('timestamp'),
+                              retry=True)
+
+    def retry(self, message, error):
+        """
+        Send a result to the retry queue of its next attempt, or to the dead
+        letter queue once it ran out of them. The caller acks it.
+        @return: True if it was dead-lettered
+        """
+        attempt = attempts(message)
+        if attempt >= len(self.delays):
+            self.dead_letter(message, error)
+            return True
+        headers = dict(message.headers)
+        headers.pop(DEATH_HEADER, None)
+        headers[ATTEMPTS_HEADER] = attempt + 1
+        headers[ERROR_HEADER] = unicode(error)[:1000]
+        headers[RETRY_AT_HEADER] = time.time() + self.delays[attempt]
+        self.publish(message, self.retry_queues[attempt].name, headers)
+        return False
+
+    def dead_letter(self, message, error):
+        """
+        Send a result to the dead letter queue. The caller acks it.
+        """
+        headers = dict(message.headers)
+        headers.pop(DEATH_HEADER, None)
+        headers.pop(RETRY_AT_HEADER, None)
+        headers[ERROR_HEADER] = unicode(error)[:1000]
+        self.publish(message, self.dead_letter_queue.name, headers)
+
+    def _rotate(self, queue, func, accept=None):
+        """
+        Get every message of a queue once, func returns True to take it
+        out, the others are put back at the end. A full pass leaves them in
+        their order. They're published again rather than requeued, kombu's
+        virtual transports lose requeued messages of the default exchange.
+        @return: number of messages taken out
+        """
+        bound = queue(self.channel)
+        _, count, _ = bound.queue_declare(passive=True)
+        taken = 0
+        for _ in range(count):
+            message = bound.get(no_ack=False, accept=accept)
+            if message is None:
+                break
+            if func(message):
+                taken += 1
+            else:
+                self.publish(message, queue.name, message.headers)
+            message.ack()
+        return taken
+
+    def release_due(self):
+        """
+        Move the results whose retry is due back to the results queue, for
+        the transports which don't expire them
+        @return: number of results released
+        """
+        if self.broker_delay:
+            return 0
+        now = time.time()
+
+        def release(message):
+            if message.headers.get(RETRY_AT_HEADER, 0) > now:
+                return False
+            self.publish(message, self.queue_name, message.headers)
+            return True
+
+        return sum(self._rotate(queue, release)
+                   for queue in self.retry_queues)
+
+    def dead_letters(self, limit=None, accept=None):
+        """
+        Return the dead-lettered results, left in the queue. Bodies which
+        can't be decoded with the accepted content types are returned raw.
+        @return: total number of results, list of (attempts, error, body) of
+                 the first limit ones
+        """
+        found = []
+
+        def inspect(message):
+            if limit is None or len(found) < limit:
+                try:
+                    body = message.decode()
+                except Exception:
+                    body = message.body
+                found.append((attempts(message),
+                              message.headers.get(ERROR_HEADER),
+                              body))
+            return False
+
+        bound = self.dead_letter_queue(self.channel)
+        _, count, _ = bound.queue_declare(passive=True)
+        self._rotate(self.dead_letter_queue, inspect, accept)
+        return count, found
+
+    def replay(self, limit=None):
+        """
+        Send the dead-lettered results back to the results queue with their
+        attempts reset, once the cause of the failures is fixed
+        @return: number of results replayed
+        """
+        replayed = [0]
+
+        def replay(message):
+            if limit is not None and replayed[0] >= limit:
+                return False
+            headers = dict(message.headers)
+            for name in (ATTEMPTS_HEADER, ERROR_HEADER, RETRY_AT_HEADER):
+                headers.pop(name, None)
+            self.publish(message, self.queue_name, headers)
+            replayed[0] += 1
+            return True
+
+        return self._rotate(self.dead_letter_queue, replay)
+
+    def purge(self):
+        """
+        @return: number of dead-lettered results deleted
+        """
+        return self.dead_letter_queue(self.channel).purge()
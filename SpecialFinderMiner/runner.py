@@ -0,0 +1,236 @@
+from elasticsearch import Elasticsearch
+from sqlalchemy import exc
+from multiprocessing.pool import ThreadPool
+from models.tables import DataAccessLayer
+from notifier import AsyncNotifier
+from indices import ItemIndices
+from utils import config_logger
+from config import config
+import metrics
+import logging
+import threading
+import time
+
+STAGE_SECONDS = metrics.histogram('miner_stage_seconds',
+                                  'Duration of the finder stages', ['stage'],
+                                  buckets=(1, 5, 15, 30, 60, 120, 300, 600,
+                                           1800, 3600))
+STAGE_FAILURES = metrics.counter('miner_stage_failures_total',
+                                 'Finder stages which raised', ['stage'])
+STAGES_LATE = metrics.counter('miner_stages_late_total',
+                              'Finder stages which missed the deadline',
+                              ['stage'])
+
+STAGES = []
+
+
+def register_stage(stage):
+    """
+    Class decorator which registers a finder stage with the MinerRunner
+    """
+    STAGES.append(stage)
+    return stage
+
+
+class MinerContext(object):
+    """
+    Connections shared by the finder stages of a miner run. The
+    elasticsearch client and the notifier are thread-safe, stages open
+    their own db sessions.
+    """
+
+    def __init__(self, dal=None, es=None, notifier=None, concurrency=None):
+        self.logger = logging.getLogger(type(self).__name__)
+        config_logger(self.logger)
+        try:
+            # Configure db
+            if dal is None:
+                dal = DataAccessLayer(config.db_conn, **config.db_pool)
+                dal.connect()
+            self.dal = dal
+
+            # Configure elasticsearch
+            self.es = es or Elasticsearch(
+                config.elasticsearch.hosts,
+                connection_class=metrics.es_connection_class())
+            self.specialfinder_index = config.elasticsearch.index.special_items
+            self.lowest_price_index = config.elasticsearch.index.lowest_price
+            self.item_indices = ItemIndices(
+                self.specialfinder_index, config.elasticsearch.index_period)
+            # Notifier
+            self.notifier = notifier or AsyncNotifier()
+        except AttributeError as e:
+            self.logger.fatal(u'Incomplete configuration: %s', e)
+            raise SystemExit(-1)
+        except (exc.DBAPIError,exc.InvalidRequestError) as e:
+            self.logger.fatal(u'Failed to connect to the db: %s', e)
+            raise SystemExit(-1)
+        except Exception as e:
+            self.logger.fatal(u'Failed to connect to the db')
+            raise SystemExit(-1)
+
+        self.pool = ThreadPool(concurrency or config.miner.concurrency)
+        self.deadline = None
+
+    def map(self, func, iterable):
+        """
+        Call func on every element from the thread pool shared by the stages
+        @return: list of the results
+        """
+        return self.pool.map(func, iterable)
+
+    def expired(self):
+        """
+        Return True once the deadline of the run has passed, long running
+        stages should check it and give up
+        """
+        return self.deadline is not None and time.time() >= self.deadline
+
+    def close(self):
+        self.notifier.close()  # Wait for the notifications to be sent
+        self.pool.close()
+
+
+class Stage(object):
+    """
+    A finder stage of the miner, subclasses implement run()
+    """
+
+    enabled_by_default = True
+    # Names of the stages this one waits for, when they're part of the run
+    after = ()
+
+    def __init__(self, context):
+        self.context = context
+        self.es = context.es
+        self.notifier = context.notifier
+        self.session = None
+        self.logger = logging.getLogger(type(self).__name__)
+        config_logger(self.logger)
+
+    def __call__(self):
+        # Sessions can't be shared between threads, so every run gets one.
+        self.session = self.context.dal.Session()
+        try:
+            self.run()
+        finally:
+            self.context.dal.Session.remove()
+
+    def run(self):
+        raise NotImplementedError('Subclass responsibility')
+
+
+class MinerRunner(object):
+    """
+    Run the registered finder stages in parallel, giving up on them once
+    the deadline has passed. A stage starts once the stages it comes after
+    have finished.
+    """
+
+    def __init__(self, context, stages=None, deadline=None):
+        self.logger = logging.getLogger(type(self).__name__)
+        config_logger(self.logger)
+        self.context = context
+        self.stages = stages if stages is not None else self.enabled_stages()
+        self.deadline = deadline or config.miner.deadline
+        self.pool = None
+
+    @staticmethod
+    def enabled_stages():
+        """
+        Return the stages named in the config, or the ones enabled by
+        default if there's none
+        @return: list of stage classes
+        """
+        names = config.miner.stages
+        if names is None:
+            return [stage for stage in STAGES if stage.enabled_by_default]
+        stages = {stage.__name__: stage for stage in STAGES}
+        try:
+            return [stages[name] for name in names]
+        except KeyError as e:
+            raise ValueError(u'Unknown stage: %s' % e)
+
+    def join(self):
+        """
+        Wait for the stages still running after the deadline of the run
+        """
+        if self.pool is not None:
+            self.pool.join()
+
+    def ordered_stages(self):
+        """
+        Return the stages after the ones they wait for, the pool starts
+        them in this order so a waiting stage never holds up the ones it
+        waits for
+        @return: list of stage classes
+        """
+        names = set(stage.__name__ for stage in self.stages)
+        ordered = []
+        pending = list(self.stages)
+        while pending:
+            done = set(stage.__name__ for stage in ordered)
+            ready = [stage for stage in pending
+                     if names & set(stage.after) <= done]
+            if not ready:
+                raise ValueError(u'Stages wait for each other: %s' %
+                                 u', '.join(stage.__name__
+                                            for stage in pending))
+            ordered.extend(ready)
+            pending = [stage for stage in pending if stage not in ready]
+        return ordered
+
+    def run(self):
+        """
+        Run the stages until they finish or the deadline passes
+        @return: True if every stage finished in time
+        """
+        if not self.stages:
+            return True
+        stages = self.ordered_stages()
+        finished_stages = {stage.__name__: threading.Event()
+                           for stage in stages}
+        self.context.deadline = time.time() + self.deadline
+        pool = self.pool = ThreadPool(min(len(stages),
+                                          config.miner.concurrency))
+        results = [(stage, pool.apply_async(self.run_stage,
+                                            (stage, finished_stages)))
+                   for stage in stages]
+        pool.close()
+
+        finished = True
+        for stage, result in results:
+            result.wait(max(0, self.context.deadline - time.time()))
+            if not result.ready():
+                self.logger.error(u'%s did not finish before the deadline',
+                                  stage.__name__)
+                STAGES_LATE.labels(stage.__name__).inc()
+                finished = False
+        return finished
+
+    def run_stage(self, stage, finished_stages):
+        try:
+            for name in stage.after:
+                if name not in finished_stages:
+                    continue
+                remaining = max(0, self.context.deadline - time.time())
+                if not finished_stages[name].wait(remaining):
+                    self.logger.error(u'%s gave up waiting for %s',
+                                      stage.__name__, name)
+                    return
+            self._run_stage(stage)
+        finally:
+            finished_stages[stage.__name__].set()
+
+    def _run_stage(self, stage):
+        started = time.time()
+        try:
+            stage(self.context)()
+        except Exception:
+            self.logger.exception(u'%s failed', stage.__name__)
+            STAGE_FAILURES.labels(stage.__name__).inc()
+        else:
+            self.logger.info(u'%s finished in %.2fs', stage.__name__,
+                             time.time() - started)
+        finally:
+            STAGE_SECONDS.labels(stage.__name__).observe(time.time() - started)
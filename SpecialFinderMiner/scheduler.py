@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+from runner import MinerContext, MinerRunner
+from transmitter import Transmitter, LAST_SUCCESS
+from utils import config_logger
+from config import config
+import miner  # Registers the finder stages
+import metrics
+import argparse
+import logging
+import random
+import signal
+import threading
+import time
+
+JOB_SECONDS = metrics.histogram('scheduler_job_seconds',
+                                'Duration of the scheduled jobs', ['job'],
+                                buckets=(0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0,
+                                         300.0, 600.0, 1800.0, 3600.0))
+JOB_RUNS = metrics.counter('scheduler_job_runs_total',
+                           'Runs of the scheduled jobs by result: ok, '
+                           'failed, or skipped as the last one still ran',
+                           ['job', 'result'])
+JOB_LAST_SUCCESS = metrics.gauge(
+    'scheduler_job_last_success_timestamp_seconds',
+    'Time of the last successful run of a job', ['job'])
+JOB_LAST_SECONDS = metrics.gauge('scheduler_job_last_seconds',
+                                 'Duration of the last run of a job', ['job'])
+
+JOBS = ('transmitter', 'miner', 'retention')
+
+
+class Job(object):
+    """
+    A function run every interval seconds from its own thread, plus a random
+    jitter of up to jitter times the interval so the runs of several
+    daemons drift apart. The function returns True if it succeeded. A run
+    due while the previous one is still going is skipped.
+    """
+
+    def __init__(self, name, func, interval, jitter=0.0):
+        self.logger = logging.getLogger(type(self).__name__)
+        config_logger(self.logger)
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.jitter = jitter
+        self.thread = None
+        self.next_run = time.time()
+        self.last_seconds = None
+
+    def schedule(self, now):
+        self.next_run = now + self.interval * \
+            (1 + random.uniform(0, self.jitter))
+
+    @property
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self, now):
+        self.schedule(now)
+        if self.running:
+            self.logger.warning(u'Skipping %s, the last run is still going',
+                                self.name)
+            JOB_RUNS.labels(self.name, 'skipped').inc()
+            return
+        self.thread = threading.Thread(target=self.run, name=self.name)
+        self.thread.daemon = True  # Don't outlive the shutdown timeout
+        self.thread.start()
+
+    def run(self):
+        started = time.time()
+        try:
+            ok = self.func()
+        except Exception:
+            self.logger.exception(u'%s failed', self.name)
+            ok = False
+        self.last_seconds = time.time() - started
+        JOB_SECONDS.labels(self.name).observe(self.last_seconds)
+        JOB_LAST_SECONDS.labels(self.name).set(self.last_seconds)
+        JOB_RUNS.labels(self.name, 'ok' if ok else 'failed').inc()
+        if ok:
+            JOB_LAST_SUCCESS.labels(self.name).set(time.time())
+        self.logger.info(u'%s %s in %.2fs, next run in %.0fs', self.name,
+                         'finished' if ok else 'failed', self.last_seconds,
+                         max(0, self.next_run - time.time()))
+        # The textfile collector sees every run, not only the last one
+        metrics.dump()
+
+    def join(self, timeout=None):
+        if self.thread is not None:
+            self.thread.join(timeout)
+
+
+class Scheduler(object):
+    """
+    Run the transmitter and the miner on intervals from one long running
+    process. The db pools, the elasticsearch clients and the notifier are
+    created once and stay warm between runs, so they can run every few
+    minutes. SIGTERM or SIGINT stops it once the running jobs finished.
+    """
+
+    def __init__(self, jobs=None):
+        self.logger = logging.getLogger(type(self).__name__)
+        config_logger(self.logger)
+
+        scheduler_config = config.scheduler
+        self.jitter = scheduler_config.jitter
+        self.shutdown_timeout = scheduler_config.shutdown_timeout
+        self.stopping = threading.Event()
+        self.transmitter = None
+        self.context = None
+        self.jobs = []
+
+        for name in jobs or JOBS:
+            interval = scheduler_config.get('%s_interval' % name)
+            if interval is None:
+                continue
+            self.jobs.append(Job(name, getattr(self, 'run_%s' % name),
+                                 interval, self.jitter))
+        names = set(job.name for job in self.jobs)
+        if names & set(['transmitter', 'retention']):
+            self.transmitter = Transmitter()
+            if self.transmitter.indices.time_based:
+                if not self.transmitter.create_index_mapping():
+                    raise SystemExit(-1)
+            elif 'retention' in names:
+                self.logger.error(u'Retention needs '
+                                  u'elasticsearch.index_period')
+                raise SystemExit(-1)
+        if 'miner' in names:
+            self.context = MinerContext()
+
+    def run_transmitter(self):
+        transmitter_config = config.transmitter
+        try:
+            _, failed = self.transmitter.transmit_incremental(
+                transmitter_config.chunk_size,
+                transmitter_config.max_chunk_bytes)
+        finally:
+            # Give the connection of this run's thread back to the pool
+            self.transmitter.dal.Session.remove()
+        if not failed:
+            LAST_SUCCESS.set(time.time())
+        return not failed
+
+    def run_miner(self):
+        if self.stopping.is_set():
+            return False  # The deadline of the shutdown isn't reset
+        runner = MinerRunner(self.context)
+        finished = runner.run()
+        if not finished:
+            # The job stays running, and the next runs are skipped, until
+            # the stages which missed the deadline gave up. They share the
+            # context's deadline with the next run's stages.
+            self.logger.warning(u'Waiting for the late miner stages')
+            runner.join()
+        self.context.notifier.flush()
+        return finished
+
+    def run_retention(self):
+        return self.transmitter.drop_old_indices(
+            config.transmitter.retention_days) is not None
+
+    def stop(self, signum=None, frame=None):
+        self.stopping.set()
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        if not self.jobs:
+            self.logger.error(u'No jobs to run')
+            return
+        self.logger.info(u'Scheduling %s', u', '.join(
+            u'%s every %ds' % (job.name, job.interval) for job in self.jobs))
+
+        while not self.stopping.is_set():
+            now = time.time()
+            for job in self.jobs:
+                if job.next_run <= now:
+                    job.start(now)
+            # Short waits, so the signals are handled promptly
+            delay = min(job.next_run for job in self.jobs) - time.time()
+            self.stopping.wait(min(max(delay, 0), 1))
+        self.shutdown()
+
+    def shutdown(self):
+        """
+        Wait for the running jobs, the miner stages are told to give up
+        """
+        self.logger.info(u'Stopping')
+        if self.context is not None:
+            self.context.deadline = time.time()
+        deadline = time.time() + self.shutdown_timeout
+        for job in self.jobs:
+            job.join(max(0, deadline - time.time()))
+            if job.running:
+                self.logger.error(u'%s did not stop in %ds', job.name,
+                                  self.shutdown_timeout)
+        if self.context is not None:
+            self.context.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--jobs',
+                        help='Comma separated jobs to run among %s' %
+                             ', '.join(JOBS),
+                        type=lambda value: value.split(','),
+                        default=None)
+    args = parser.parse_args()
+    unknown = set(args.jobs or ()) - set(JOBS)
+    if unknown:
+        parser.error('Unknown jobs: %s' % ', '.join(sorted(unknown)))
+
+    metrics.start('scheduler')
+    Scheduler(args.jobs).run()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,134 @@
+from datetime import date, datetime
+from msgpack import unpackb
+import math
+
+MSGPACK_CONTENT_TYPE = 'application/x-msgpack'
+
+
+class SchemaError(ValueError):
+    """
+    A crawl result doesn't match the schema, field and reason tell why
+    """
+
+    def __init__(self, field, reason, value=None):
+        super(SchemaError, self).__init__(u'%s: %s' % (field, reason))
+        self.field = field
+        self.reason = reason
+        self.value = value
+
+    def __str__(self):
+        return '%s: %s (%s)' % (self.field, self.reason,
+                                repr(self.value)[:100])
+
+
+def text(max_length):
+    """
+    Return a coercion of a value to unicode of at most max_length
+    characters, blank text is None
+    """
+    def coerce(value):
+        if isinstance(value, str):
+            value = value.decode('utf-8')
+        elif not isinstance(value, unicode):
+            raise SchemaError(None, 'invalid_type', value)
+        value = value.strip()
+        if not value:
+            return None
+        if len(value) > max_length:
+            raise SchemaError(None, 'too_long', value)
+        return value
+    return coerce
+
+
+def price(value):
+    """
+    Coerce a number or a price text like "$1,299.00" to a float
+    """
+    if isinstance(value, bool):
+        raise SchemaError(None, 'invalid_type', value)
+    if isinstance(value, basestring):
+        value = value.strip().lstrip(u'$').replace(u',', u'')
+    elif not isinstance(value, (int, long, float)):
+        raise SchemaError(None, 'invalid_type', value)
+    value = float(value)
+    if math.isnan(value) or math.isinf(value) or value < 0:
+        raise SchemaError(None, 'out_of_range', value)
+    return value
+
+
+def day(value):
+    """
+    Coerce a date, a datetime or a YYYY-MM-DD text to a date
+    """
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    if not isinstance(value, basestring):
+        raise SchemaError(None, 'invalid_type', value)
+    # strptime is by far the slowest step of the validation
+    if len(value) == 10 and value[4] == value[7] == '-':
+        return date(int(value[:4]), int(value[5:7]), int(value[8:]))
+    return datetime.strptime(value, '%Y-%m-%d').date()
+
+
+class Schema(object):
+    """
+    Validates and normalises crawl results. Scrapy wraps every field in a
+    list, the single items are unwrapped before the coercion.
+
+    The fields are (name, required, coercion) tuples, the coercions raise
+    SchemaError, TypeError or ValueError for a bad value.
+    """
+
+    def __init__(self, fields):
+        self.fields = tuple(fields)
+
+    def validate(self, body):
+        """
+        Return the normalised row of a crawl result
+        @return: dict of the field values
+        """
+        if not isinstance(body, dict):
+            raise SchemaError(None, 'not_a_mapping', type(body).__name__)
+        row = {}
+        for name, required, coerce in self.fields:
+            value = body.get(name)
+            if type(value) is list:
+                value = value[0] if value else None
+            if value is None:
+                if required:
+                    raise SchemaError(name, 'missing')
+                row[name] = None
+                continue
+            try:
+                value = coerce(value)
+            except SchemaError as e:
+                e.field = name
+                raise
+            except (TypeError, ValueError):
+                raise SchemaError(name, 'invalid_value', value)
+            if value is None and required:
+                raise SchemaError(name, 'empty')
+            row[name] = value
+        return row
+
+
+# A row of the items table
+item_schema = Schema([
+    ('title', True, text(255)),
+    ('price', True, price),
+    ('per', False, text(25)),
+    ('url', False, text(255)),
+    ('image_url', False, text(255)),
+    ('date', True, day),
+    ('vendor', True, text(50)),
+])
+
+
+def decode_msgpack(body):
+    """
+    Decode a msgpack message body the way kombu's msgpack serializer does,
+    without the serializer registry lookups
+    """
+    return unpackb(body, encoding='utf-8')
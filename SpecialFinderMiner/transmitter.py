@@ -1,12 +1,29 @@
 #!/usr/bin/env python
 from elasticsearch import Elasticsearch, TransportError, RequestError
+from elasticsearch.helpers import streaming_bulk, expand_action
 from sqlalchemy import exc
+from sqlalchemy.sql import func
 from models.tables import DataAccessLayer, Item
-from datetime import date, timedelta
-from utils import config_logger
+from datetime import date, datetime, timedelta
+from utils import config_logger, Checkpoint
+from indices import ItemIndices
 from config import config
+import metrics
 import logging
 import argparse
+import multiprocessing
+import time
+
+ITEMS_INDEXED = metrics.counter('transmitter_items_indexed_total',
+                                'Items sent to elasticsearch')
+ITEMS_FAILED = metrics.counter('transmitter_items_failed_total',
+                               'Items elasticsearch failed to index')
+BULK_ITEMS = metrics.histogram('transmitter_bulk_chunk_items',
+                               'Items per bulk request',
+                               buckets=(10, 50, 100, 250, 500, 1000, 2500,
+                                        5000))
+LAST_SUCCESS = metrics.gauge('transmitter_last_success_timestamp_seconds',
+                             'Time of the last run without failed items')
 
 class Transmitter(object):
 
@@ -44,12 +61,15 @@ class Transmitter(object):
         try:
             self.logger = logging.getLogger(type(self).__name__)
             config_logger(self.logger)
-            self.dal = DataAccessLayer()
-            self.dal.conn_str = config.db_conn
+            self.dal = DataAccessLayer(config.db_conn, **config.db_pool)
 
             # Configure elasticsearch
-            self.es = Elasticsearch(config.elasticsearch.hosts)
+            self.es = Elasticsearch(
+                config.elasticsearch.hosts,
+                connection_class=metrics.es_connection_class())
             self.index_name = config.elasticsearch.index.special_items
+            self.indices = ItemIndices.from_config()
+            self.checkpoint = Checkpoint(config.transmitter.checkpoint_file)
             self.dal.connect()
         except AttributeError as e:
             logger.fatal(u'Incomplete configuration: %s', e)
@@ -58,13 +78,43 @@ class Transmitter(object):
             self.logger.fatal(u'Failed to connect to the db')
             raise SystemError(-1)
 
+    @classmethod
+    def items_template(cls, indices):
+        """
+        Return the template the time-based indices are created from, it
+        adds them to the read alias
+        @return: template body
+        """
+        return {
+            'template': indices.pattern,
+            'settings': {'index': {
+                'refresh_interval': config.transmitter.refresh_interval,
+                'number_of_replicas': config.transmitter.number_of_replicas,
+            }},
+            'mappings': {cls.es_type: cls.items_mapping},
+            'aliases': {indices.alias: {}},
+        }
+
     def create_index_mapping(self):
         """
-        Create index and mapping in the elasticsearch
+        Create index and mapping in the elasticsearch, or the template of
+        the time-based indices
         """
         try:
+            if self.indices.time_based:
+                if self.es.indices.exists(self.index_name) and \
+                        not self.es.indices.exists_alias(name=self.index_name):
+                    # The template couldn't add the indices to the alias
+                    self.logger.error(u'Index %s holds the name of the '
+                                      u'alias, rebuild it without '
+                                      u'index_period first', self.index_name)
+                    return False
+                self.es.indices.put_template(
+                    name=self.index_name,
+                    body=self.items_template(self.indices))
+                return True
             # Even fine if the index is existed.
-            self.es.indices.create('specialfinder', ignore=[400])
+            self.es.indices.create(self.index_name, ignore=[400])
             self.es.indices.put_mapping(doc_type=self.es_type,
                                         body=self.items_mapping,
                                         index=self.index_name)
@@ -73,6 +123,15 @@ class Transmitter(object):
             return False
         return True
 
+    def item_index(self, day):
+        """
+        Return the index the items of a day are sent to
+        @return: index name
+        """
+        if self.indices.time_based:
+            return self.indices.index(day)
+        return self.index_name
+
     @staticmethod
     def item_doc(title, url, price, per, vendor, date):
         """
@@ -89,37 +148,393 @@ class Transmitter(object):
         }
         return item_doc
 
+    def item_action(self, item):
+        """
+        Return a bulk index action of an item row. The document id is the
+        primary key of the row so sending it again overwrites the document.
+        @return: item action
+        """
+        return {
+            '_index': self.item_index(item.date),
+            '_type': self.es_type,
+            '_id': item.id,
+            '_source': self.item_doc(item.title,
+                                     item.url,
+                                     item.price,
+                                     item.per,
+                                     item.vendor,
+                                     item.date)
+        }
+
+    @staticmethod
+    def id_ranges(first_id, last_id, count):
+        """
+        Split the ids from first_id to last_id into at most count ranges
+        @return: list of (first id, last id) of the ranges
+        """
+        step = max(1, (last_id - first_id + count) // count)
+        return [(lo, min(lo + step - 1, last_id))
+                for lo in range(first_id, last_id + 1, step)]
+
+    def items_query(self, days=1, id_range=None):
+        """
+        Return the query of items to transmit, -1 days means all items.
+        id_range limits the items to the ids within (first id, last id).
+        @return: items query
+        """
+        items = self.dal.session.query(Item.id,
+                                       Item.title,
+                                       Item.url,
+                                       Item.price,
+                                       Item.per,
+                                       Item.vendor,
+                                       Item.date,
+                                       Item.updated_at)
+        if days != -1:
+            date_of_data = date.today() - timedelta(days)
+            self.logger.info(u'Going to import data of %s', date_of_data)
+            items = items.filter(Item.date==date_of_data)
+        if id_range is not None:
+            items = items.filter(Item.id.between(*id_range))
+        return items
+
     def transmit(self, days=1):
         """
-        Transmit data from db to elasticsearch
+        Transmit data from db to elasticsearch, stops at the first failure
+        @return: numbers of indexed and failed items
         """
+        counter = failed = 0
         try:
-            items = self.dal.session.query(Item.title,
-                                           Item.url,
-                                           Item.price,
-                                           Item.per,
-                                           Item.vendor,
-                                           Item.date)
-            if days != -1:
-                date_of_data = date.today() - timedelta(days)
-                self.logger.info(u'Going to import data of %s', date_of_data)
-                items = items.filter(Item.date==date_of_data)
-
-            counter = 0
+            items = self.items_query(days)
+
             for item in items:
                 self.logger.debug(u'Add item: %s', item)
-                self.es.create(index=self.index_name,
-                               doc_type=self.es_type,
-                               body=self.item_doc(item[0],
-                                                  item[1],
-                                                  item[2],
-                                                  item[3],
-                                                  item[4],
-                                                  item[5]))
+                self.es.index(index=self.item_index(item.date),
+                              doc_type=self.es_type,
+                              id=item.id,
+                              body=self.item_doc(item.title,
+                                                 item.url,
+                                                 item.price,
+                                                 item.per,
+                                                 item.vendor,
+                                                 item.date))
                 counter += 1
             self.logger.info(u'Add %d items', counter)
         except TransportError as e:
             self.logger.error(u'Failed to transmit data: %s', e)
+            failed = 1
+        ITEMS_INDEXED.inc(counter)
+        ITEMS_FAILED.inc(failed)
+        return counter, failed
+
+    def bulk_chunks(self, items, chunk_size, max_chunk_bytes):
+        """
+        Split item rows into bulk requests of at most chunk_size items and
+        max_chunk_bytes, the way streaming_bulk splits its actions. The
+        documents are serialized once, here, so the size of every request
+        is known.
+        @return: generator of lists of (item, action)
+        """
+        serializer = self.es.transport.serializer
+        chunk = []
+        size = 0
+        for item in items:
+            action = self.item_action(item)
+            action['_source'] = serializer.dumps(action['_source'])
+            # Both lines of the action, and their newlines
+            action_size = len(serializer.dumps(expand_action(action)[0])) + \
+                len(action['_source']) + 2
+            if chunk and (len(chunk) == chunk_size or
+                          size + action_size > max_chunk_bytes):
+                yield chunk
+                chunk = []
+                size = 0
+            chunk.append((item, action))
+            size += action_size
+        if chunk:
+            yield chunk
+
+    def bulk_index(self, items, chunk_size=500,
+                   max_chunk_bytes=10 * 1024 * 1024):
+        """
+        Send item rows to elasticsearch through the bulk API
+        @return: numbers of indexed and failed items, and the updated_at of
+                 the last item sent before the first failure
+        """
+        indexed = failed = 0
+        watermark = None
+        for chunk in self.bulk_chunks(items, chunk_size, max_chunk_bytes):
+            BULK_ITEMS.observe(len(chunk))
+            # One request, the chunk already fits the limits. Results come
+            # back in the order of the actions.
+            results = streaming_bulk(self.es,
+                                     [action for _, action in chunk],
+                                     chunk_size=len(chunk),
+                                     max_chunk_bytes=max_chunk_bytes,
+                                     raise_on_error=False,
+                                     raise_on_exception=False)
+            for (item, _), (ok, result) in zip(chunk, results):
+                if ok:
+                    indexed += 1
+                    if not failed:
+                        watermark = item.updated_at
+                else:
+                    failed += 1
+                    self.logger.error(u'Failed to index item: %s', result)
+        ITEMS_INDEXED.inc(indexed)
+        ITEMS_FAILED.inc(failed)
+        return indexed, failed, watermark
+
+    def transmit_bulk(self, days=1, chunk_size=500,
+                      max_chunk_bytes=10 * 1024 * 1024, id_range=None):
+        """
+        Transmit data from db to elasticsearch through the bulk API. Rows
+        are streamed from a server-side cursor so memory use stays flat.
+        @return: numbers of indexed and failed items
+        """
+        indexed = failed = 0
+        try:
+            items = self.items_query(days, id_range).yield_per(chunk_size)
+            indexed, failed, _ = self.bulk_index(items,
+                                                 chunk_size,
+                                                 max_chunk_bytes)
+        except (exc.DBAPIError,exc.InvalidRequestError) as e:
+            self.logger.error(u'Failed to read items from db: %s', e)
+        self.logger.info(u'Indexed %d items, %d failed', indexed, failed)
+        return indexed, failed
+
+    def transmit_incremental(self, chunk_size=500,
+                             max_chunk_bytes=10 * 1024 * 1024):
+        """
+        Transmit items added or updated since the last run. The updated_at
+        of the last transmitted item is kept in the checkpoint file.
+        @return: numbers of indexed and failed items
+        """
+        indexed = failed = 0
+        state = self.checkpoint.load({})
+        try:
+            items = self.items_query(-1)
+            if state.get('updated_at'):
+                since = datetime.strptime(state['updated_at'],
+                                          Checkpoint.datetime_format)
+                newer = self.dal.session.query(Item.id).filter(
+                    Item.updated_at > since).first()
+                if newer is None:
+                    self.logger.info(u'No items updated since %s', since)
+                    return indexed, failed
+                # Rows committed late may carry an older updated_at, send
+                # them again, documents are overwritten by id.
+                overlap = timedelta(seconds=config.transmitter.checkpoint_overlap)
+                items = items.filter(Item.updated_at > since - overlap)
+            items = items.order_by(Item.updated_at).yield_per(chunk_size)
+            indexed, failed, watermark = self.bulk_index(items,
+                                                         chunk_size,
+                                                         max_chunk_bytes)
+        except (exc.DBAPIError,exc.InvalidRequestError) as e:
+            self.logger.error(u'Failed to read items from db: %s', e)
+            return indexed, failed
+
+        if watermark is not None:
+            state['updated_at'] = watermark.strftime(Checkpoint.datetime_format)
+            self.checkpoint.save(state)
+        self.logger.info(u'Indexed %d items, %d failed, checkpoint at %s',
+                         indexed, failed, state.get('updated_at'))
+        return indexed, failed
+
+    def transmit_parallel(self, days=1, workers=2, chunk_size=500,
+                          max_chunk_bytes=10 * 1024 * 1024):
+        """
+        Transmit data from db to elasticsearch with a pool of worker
+        processes. The items are split into id ranges and each worker uses
+        its own db engine and elasticsearch client.
+        @return: numbers of indexed and failed items
+        """
+        indexed = failed = 0
+        try:
+            first_id, last_id = self.items_query(days).with_entities(
+                func.min(Item.id), func.max(Item.id)).one()
+        except (exc.DBAPIError,exc.InvalidRequestError) as e:
+            self.logger.error(u'Failed to read items from db: %s', e)
+            return indexed, failed
+        if first_id is None:
+            self.logger.info(u'No items to transmit')
+            return indexed, failed
+
+        # More ranges than workers, so a worker which got a sparse range
+        # picks up another one instead of idling.
+        id_ranges = self.id_ranges(first_id, last_id, workers * 4)
+        tasks = [(days, id_range, chunk_size, max_chunk_bytes)
+                 for id_range in id_ranges]
+
+        # Forked workers mustn't share the pooled connections.
+        self.dal.session.close()
+        self.dal.engine.dispose()
+
+        started = time.time()
+        pool = multiprocessing.Pool(workers, initializer=_init_worker,
+                                    initargs=(self.index_name, ))
+        try:
+            for done, (shard_indexed, shard_failed) in enumerate(
+                    pool.imap_unordered(_transmit_shard, tasks), 1):
+                indexed += shard_indexed
+                failed += shard_failed
+                # The workers' own metrics die with them.
+                ITEMS_INDEXED.inc(shard_indexed)
+                ITEMS_FAILED.inc(shard_failed)
+                self.logger.info(u'%d/%d ranges done, %d indexed, %d failed, '
+                                 u'%.1f items/s', done, len(tasks), indexed,
+                                 failed, indexed / (time.time() - started))
+            pool.close()
+        except KeyboardInterrupt:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+        self.logger.info(u'Indexed %d items, %d failed in %.1fs with %d '
+                         u'workers', indexed, failed, time.time() - started,
+                         workers)
+        return indexed, failed
+
+    def versioned_index_name(self):
+        """
+        Return the name of a new index to rebuild the alias into
+        @return: index name
+        """
+        return '%s_%s' % (self.index_name,
+                          datetime.utcnow().strftime('%Y%m%d%H%M%S'))
+
+    def alias_swap_actions(self, new_index):
+        """
+        Return the update_aliases actions pointing the alias to new_index
+        and the indices it pointed to before
+        @return: list of actions, list of old index names
+        """
+        old_indices = []
+        if self.es.indices.exists_alias(name=self.index_name):
+            old_indices = sorted(
+                self.es.indices.get_alias(name=self.index_name))
+        actions = [{'remove': {'index': index, 'alias': self.index_name}}
+                   for index in old_indices]
+        actions.append({'add': {'index': new_index,
+                                'alias': self.index_name}})
+        return actions, old_indices
+
+    def rebuild(self, workers=1, chunk_size=500,
+                max_chunk_bytes=10 * 1024 * 1024):
+        """
+        Rebuild the index from all items without touching the live one:
+        load a new versioned index with refresh and replicas off, restore
+        the settings, force-merge it and atomically swap the alias readers
+        use over to it. A failed load leaves the alias untouched.
+        @return: numbers of indexed and failed items
+        """
+        alias = self.index_name
+        new_index = self.versioned_index_name()
+        try:
+            # Items updated during the load are sent again by the next
+            # incremental run.
+            watermark = self.dal.session.query(
+                func.max(Item.updated_at)).scalar()
+            self.es.indices.create(new_index, body={
+                'settings': {'index': {'refresh_interval': '-1',
+                                       'number_of_replicas': 0}},
+                'mappings': {self.es_type: self.items_mapping},
+            })
+        except (exc.DBAPIError,exc.InvalidRequestError) as e:
+            self.logger.error(u'Failed to read items from db: %s', e)
+            return 0, 0
+        except TransportError as e:
+            self.logger.error(u'Failed to create index %s: %s', new_index, e)
+            return 0, 0
+        self.logger.info(u'Rebuilding %s into %s', alias, new_index)
+
+        self.index_name = new_index
+        try:
+            if workers > 1:
+                indexed, failed = self.transmit_parallel(-1, workers,
+                                                         chunk_size,
+                                                         max_chunk_bytes)
+            else:
+                indexed, failed = self.transmit_bulk(-1, chunk_size,
+                                                     max_chunk_bytes)
+        finally:
+            self.index_name = alias
+        if failed:
+            self.logger.error(u'%d items failed, %s keeps its indices',
+                              failed, alias)
+            self.es.indices.delete(new_index, ignore=[404])
+            return indexed, failed
+
+        try:
+            self.es.indices.put_settings(index=new_index, body={'index': {
+                'refresh_interval': config.transmitter.refresh_interval,
+                'number_of_replicas': config.transmitter.number_of_replicas,
+            }})
+            self.es.indices.refresh(index=new_index)
+            self.es.indices.forcemerge(index=new_index, max_num_segments=1)
+
+            actions, old_indices = self.alias_swap_actions(new_index)
+            if not old_indices and self.es.indices.exists(alias):
+                # An index predating the aliases holds the name, it has
+                # to go before the alias can take it.
+                self.logger.warning(u'Deleting index %s to replace it with '
+                                    u'an alias', alias)
+                self.es.indices.delete(alias)
+            self.es.indices.update_aliases(body={'actions': actions})
+            self.logger.info(u'%s now points to %s', alias, new_index)
+        except TransportError as e:
+            # None of the items reach the readers
+            self.logger.error(u'Failed to swap %s to %s: %s', alias,
+                              new_index, e)
+            self.es.indices.delete(new_index, ignore=[404])
+            return 0, indexed
+
+        if not config.transmitter.keep_old_indices:
+            for index in old_indices:
+                self.logger.info(u'Deleting old index %s', index)
+                self.es.indices.delete(index, ignore=[404])
+        if watermark is not None:
+            state = self.checkpoint.load({})
+            state['updated_at'] = watermark.strftime(Checkpoint.datetime_format)
+            self.checkpoint.save(state)
+        return indexed, failed
+
+    def drop_old_indices(self, days):
+        """
+        Delete the time-based indices whose items are all older than days.
+        Whole indices go in one request, far cheaper than deleting their
+        documents.
+        @return: list of the deleted indices, None if it failed
+        """
+        cutoff = date.today() - timedelta(days=days)
+        try:
+            names = self.es.indices.get_settings(index=self.indices.pattern,
+                                                 ignore=[404])
+            old = sorted(name for name in names
+                         if self.indices.end(name) is not None and
+                         self.indices.end(name) <= cutoff)
+            if old:
+                self.es.indices.delete(index=','.join(old))
+        except TransportError as e:
+            self.logger.error(u'Failed to delete old indices: %s', e)
+            return None
+        self.logger.info(u'Deleted %d indices of items before %s: %s',
+                         len(old), cutoff, u', '.join(old))
+        return old
+
+
+def _init_worker(index_name):
+    global worker_transmitter
+    worker_transmitter = Transmitter()
+    worker_transmitter.index_name = index_name
+
+
+def _transmit_shard(task):
+    days, id_range, chunk_size, max_chunk_bytes = task
+    return worker_transmitter.transmit_bulk(days,
+                                            chunk_size,
+                                            max_chunk_bytes,
+                                            id_range)
 
 def main():
     parser = argparse.ArgumentParser()
@@ -127,10 +542,66 @@ def main():
                         help='Transfer x days of data, -1 means all data',
                         type=int,
                         default=1)
+    parser.add_argument('--bulk',
+                        help='Transfer through the bulk API',
+                        action='store_true')
+    parser.add_argument('--chunk-size',
+                        help='Items per bulk request',
+                        type=int,
+                        default=config.transmitter.chunk_size)
+    parser.add_argument('--max-chunk-bytes',
+                        help='Maximum size of a bulk request in bytes',
+                        type=int,
+                        default=config.transmitter.max_chunk_bytes)
+    parser.add_argument('--workers',
+                        help='Transfer with N worker processes, '
+                             'implies --bulk',
+                        type=int,
+                        default=1)
+    parser.add_argument('--incremental',
+                        help='Transfer items updated since the last '
+                             'incremental run, implies --bulk',
+                        action='store_true')
+    parser.add_argument('--rebuild',
+                        help='Rebuild the index from all items into a new '
+                             'one and swap the alias over to it, implies '
+                             '--bulk',
+                        action='store_true')
+    parser.add_argument('--retention',
+                        help='Delete the time-based indices of items older '
+                             'than transmitter.retention_days',
+                        action='store_true')
     args = parser.parse_args()
+    if config.elasticsearch.index_period is None:
+        if args.retention:
+            parser.error('--retention needs elasticsearch.index_period')
+    elif args.rebuild:
+        parser.error('--rebuild needs a single index, unset '
+                     'elasticsearch.index_period')
 
+    metrics.start('transmitter')
     t = Transmitter()
-    t.transmit(args.days)
+    if args.retention:
+        t.drop_old_indices(config.transmitter.retention_days)
+        return
+    if t.indices.time_based and not t.create_index_mapping():
+        raise SystemExit(-1)
+    if args.rebuild:
+        _, failed = t.rebuild(args.workers, args.chunk_size,
+                              args.max_chunk_bytes)
+    elif args.incremental:
+        _, failed = t.transmit_incremental(args.chunk_size,
+                                           args.max_chunk_bytes)
+    elif args.workers > 1:
+        _, failed = t.transmit_parallel(args.days, args.workers,
+                                        args.chunk_size, args.max_chunk_bytes)
+    elif args.bulk:
+        _, failed = t.transmit_bulk(args.days, args.chunk_size,
+                                    args.max_chunk_bytes)
+    else:
+        _, failed = t.transmit(args.days)
+    if not failed:
+        LAST_SUCCESS.set(time.time())
 
 if __name__ == '__main__':
     main()
@@ -1,8 +1,15 @@
 from config import config
+from collections import OrderedDict
+import errno
+import json
 import logging
+import os
 import sys
 
 def config_logger(logger):
+    if logger.handlers:  # Already configured
+        return
+
     # Set logging level
     logger.setLevel(config.log_level)
 
@@ -12,3 +19,62 @@ def config_logger(logger):
     stdout_handler.setFormatter(formatter)
 
     logger.addHandler(stdout_handler)
+
+
+class LRUCache(object):
+    """
+    Dict-like cache which keeps only the `capacity` most recently used keys
+    """
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self._data = OrderedDict()
+
+    def get(self, key, default=None):
+        try:
+            value = self._data.pop(key)
+        except KeyError:
+            return default
+        self._data[key] = value  # Mark as the most recently used
+        return value
+
+    def __setitem__(self, key, value):
+        if self.capacity <= 0:
+            return
+        self._data.pop(key, None)
+        self._data[key] = value
+        if len(self._data) > self.capacity:
+            self._data.popitem(last=False)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+
+class Checkpoint(object):
+    """
+    JSON state kept between runs, the file is replaced atomically on save
+    """
+    datetime_format = '%Y-%m-%d %H:%M:%S.%f'
+
+    def __init__(self, path):
+        self.path = os.path.expanduser(path)
+
+    def load(self, default=None):
+        try:
+            with open(self.path) as fp:
+                return json.load(fp)
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return default
+
+    def save(self, state):
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as fp:
+            json.dump(state, fp)
+        os.rename(tmp_path, self.path)
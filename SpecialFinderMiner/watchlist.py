@@ -0,0 +1,77 @@
+from collections import defaultdict
+import re
+
+# Close to what elasticsearch's standard analyzer makes of the titles, so
+# the matches are the ones SpecialFinder's match queries find.
+_TOKEN = re.compile(r"\w+(?:['.]\w+)*", re.UNICODE)
+
+
+def tokenize(text):
+    """
+    @return: set of the lowercase tokens of a text
+    """
+    return set(_TOKEN.findall(text.lower()))
+
+
+class WatchList(object):
+    """
+    Matches titles against the watched titles of the special_titles config.
+    An "and" title matches titles with all of its tokens, an "or" title
+    titles with any of them, like SpecialFinder's match queries.
+
+    The watched titles are kept in an inverted index of their tokens: "or"
+    titles under every token, "and" titles only under their token watched
+    the least, and checked for the rest of their tokens once that one is
+    found. A match costs about the number of tokens of the title whatever
+    the number of watched titles.
+    """
+
+    def __init__(self, entries):
+        """
+        @param entries: (title, operator) of the watched titles
+        """
+        self.titles = []  # (title, operator, tokens)
+        for title, operator in entries:
+            tokens = frozenset(tokenize(title))
+            if tokens:
+                self.titles.append((title, operator, tokens))
+
+        frequency = defaultdict(int)
+        for _, _, tokens in self.titles:
+            for token in tokens:
+                frequency[token] += 1
+
+        self.any_index = defaultdict(list)  # token -> "or" title indexes
+        self.all_index = defaultdict(list)  # token -> "and" title indexes
+        for index, (_, operator, tokens) in enumerate(self.titles):
+            if operator == 'or':
+                for token in tokens:
+                    self.any_index[token].append(index)
+            else:
+                anchor = min(tokens, key=lambda token: (frequency[token],
+                                                        token))
+                self.all_index[anchor].append(index)
+
+    @classmethod
+    def from_config(cls, special_titles):
+        """
+        Build the watch list of the special_titles of the miner config
+        """
+        return cls([(entry.title, entry.get('operator', 'and'))
+                    for entry in special_titles or []])
+
+    def __len__(self):
+        return len(self.titles)
+
+    def match(self, title):
+        """
+        @return: list of the watched titles matching a title
+        """
+        tokens = tokenize(title)
+        matches = set()
+        for token in tokens:
+            matches.update(self.any_index.get(token, ()))
+            for index in self.all_index.get(token, ()):
+                if self.titles[index][2] <= tokens:
+                    matches.add(index)
+        return [self.titles[index][0] for index in sorted(matches)]
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+"""
+Per-message cost of decoding and validating a crawl result in the dumper.
+
+Compares kombu's serializer registry followed by the field by field
+extraction the dumper used before the schema, with the raw msgpack decode
+and the item schema.
+
+    python benchmarks/bench_schema.py -n 100000
+"""
+import os
+import sys
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, os.pardir, 'SpecialFinderMiner'))
+
+from kombu.serialization import dumps, loads
+from datetime import datetime
+import argparse
+import timeit
+
+from schema import item_schema, decode_msgpack, SchemaError, \
+    MSGPACK_CONTENT_TYPE
+
+RESULT = {
+    'title': [u'Acme coffee beans 1kg'],
+    'price': [u'$21.50'],
+    'per': [u'kg'],
+    'url': [u'https://coles.example.com/p/1'],
+    'image_url': [u'https://coles.example.com/i/1.jpg'],
+    'date': [u'2016-05-01'],
+    'vendor': [u'coles'],
+}
+INVALID_RESULT = dict(RESULT, date=[u'yesterday'])
+ACCEPT = [MSGPACK_CONTENT_TYPE]
+
+
+def _extract_item(item):
+    if isinstance(item, list) and len(item):
+        return item[0]
+    return item
+
+
+def legacy_extract_row(body):
+    """
+    The extraction of the dumper before the schema, it didn't coerce the
+    price
+    """
+    date = _extract_item(body['date'])
+    if isinstance(date, basestring):
+        date = datetime.strptime(date, '%Y-%m-%d').date()
+    return {
+        'title': _extract_item(body['title']),
+        'price': _extract_item(body['price']),
+        'per': _extract_item(body.get('per')),
+        'url': _extract_item(body['url']),
+        'image_url': _extract_item(body['image_url']),
+        'date': date,
+        'vendor': _extract_item(body['vendor']),
+    }
+
+
+def legacy(payload):
+    return legacy_extract_row(loads(payload, MSGPACK_CONTENT_TYPE, 'binary',
+                                    ACCEPT))
+
+
+def schema(payload):
+    return item_schema.validate(decode_msgpack(payload))
+
+
+def rejected(func, payload):
+    def call():
+        try:
+            func(payload)
+        except (SchemaError, KeyError, ValueError):
+            pass
+    return call
+
+
+def measure(func, number, repeat):
+    """
+    @return: best time per call in microseconds
+    """
+    return min(timeit.repeat(func, number=number, repeat=repeat)) \
+        / number * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('-n', '--number',
+                        help='Messages per measurement',
+                        type=int,
+                        default=50000)
+    parser.add_argument('-r', '--repeat',
+                        help='Measurements, the best one is reported',
+                        type=int,
+                        default=5)
+    args = parser.parse_args()
+
+    _, _, payload = dumps(RESULT, serializer='msgpack')
+    _, _, invalid_payload = dumps(INVALID_RESULT, serializer='msgpack')
+    cases = [
+        ('decode, registry', lambda: loads(payload, MSGPACK_CONTENT_TYPE,
+                                           'binary', ACCEPT)),
+        ('decode, raw', lambda: decode_msgpack(payload)),
+        ('legacy extraction', lambda: legacy(payload)),
+        ('schema', lambda: schema(payload)),
+        ('legacy, invalid date', rejected(legacy, invalid_payload)),
+        ('schema, invalid date', rejected(schema, invalid_payload)),
+    ]
+    for name, func in cases:
+        print '%-24s %8.2f us/message' % (name, measure(func, args.number,
+                                                        args.repeat))
+
+if __name__ == '__main__':
+    main()
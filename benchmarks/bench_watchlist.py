@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+"""
+Per-item cost of matching an ingested title against the watched titles.
+
+Compares a scan checking every watched title in turn with the inverted
+index of the watch list, for thousands of watched titles.
+
+    python benchmarks/bench_watchlist.py -w 1000 5000 20000
+"""
+import os
+import sys
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, os.pardir, 'SpecialFinderMiner'))
+
+import argparse
+import random
+import timeit
+
+from watchlist import WatchList, tokenize
+
+# Made up brand names, a catalogue has hundreds of brands
+BRANDS = [prefix + suffix
+          for prefix in (u'Ac', u'Glo', u'Ini', u'Umb', u'Hoo', u'Sta', u'Way',
+                         u'Won', u'Tyr', u'Cyb', u'Soy', u'Van', u'Kra',
+                         u'Nes', u'Bel', u'Mor', u'Pal', u'Zen', u'Ori',
+                         u'Lum')
+          for suffix in (u'me', u'bex', u'tech', u'rella', u'li', u'rk',
+                         u'ne', u'ka', u'rell', u'dyne', u'lent', u'delay',
+                         u'ft', u'tle', u'la', u'go', u'mo', u'ra', u'vo',
+                         u'x', u'za', u'ti', u'do', u'na', u'ko')]
+PRODUCTS = [u'coffee beans', u'ground coffee', u'green tea', u'milk',
+            u'butter', u'cheddar cheese', u'olive oil', u'pasta', u'rice',
+            u'dishwasher tablets', u'laundry liquid', u'toilet paper',
+            u'shampoo', u'toothpaste', u'dark chocolate', u'potato chips',
+            u'orange juice', u'sparkling water', u'dog food', u'cat litter']
+VARIANTS = [u'organic', u'light', u'extra', u'original', u'family pack',
+            u'value', u'premium', u'classic', u'double', u'free range']
+SIZES = [u'100g', u'250g', u'500g', u'1kg', u'2kg', u'1l', u'2l', u'6 pack',
+         u'12 pack', u'24 pack']
+
+
+def random_title(rng):
+    return u' '.join([rng.choice(BRANDS), rng.choice(VARIANTS),
+                      rng.choice(PRODUCTS), rng.choice(SIZES)])
+
+
+def watched_titles(rng, count):
+    """
+    Watched titles like the special_titles config ones, mostly a product of
+    a brand, some products of any listed brand
+    """
+    entries = []
+    for _ in range(count):
+        if rng.random() < 0.1:
+            entries.append((u' '.join(rng.sample(BRANDS, 3)) + u' ' +
+                            rng.choice(PRODUCTS), 'or'))
+        else:
+            words = random_title(rng).split()
+            entries.append((u' '.join(rng.sample(words, 3)), 'and'))
+    return entries
+
+
+class Scan(object):
+    """
+    Checks every watched title in turn
+    """
+
+    def __init__(self, entries):
+        self.titles = [(title, operator, frozenset(tokenize(title)))
+                       for title, operator in entries]
+
+    def match(self, title):
+        tokens = tokenize(title)
+        return [watched for watched, operator, watched_tokens in self.titles
+                if (watched_tokens & tokens if operator == 'or'
+                    else watched_tokens <= tokens)]
+
+
+def measure(func, titles, repeat):
+    """
+    @return: best time per title in microseconds
+    """
+    def run():
+        for title in titles:
+            func(title)
+    return min(timeit.repeat(run, number=1, repeat=repeat)) \
+        / len(titles) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('-w', '--watched',
+                        help='Numbers of watched titles',
+                        type=int,
+                        nargs='+',
+                        default=[1000, 5000, 20000])
+    parser.add_argument('-n', '--number',
+                        help='Ingested titles per measurement',
+                        type=int,
+                        default=2000)
+    parser.add_argument('-r', '--repeat',
+                        help='Measurements, the best one is reported',
+                        type=int,
+                        default=3)
+    args = parser.parse_args()
+
+    rng = random.Random(42)
+    titles = [random_title(rng) for _ in range(args.number)]
+    for count in args.watched:
+        entries = watched_titles(rng, count)
+        scan = Scan(entries)
+        watchlist = WatchList(entries)
+        # Both find the same matches
+        assert all(sorted(scan.match(title)) ==
+                   sorted(watchlist.match(title)) for title in titles[:100])
+        for name, matcher in [('scan', scan), ('watch list', watchlist)]:
+            print '%6d watched, %-12s %10.2f us/item' % (
+                count, name, measure(matcher.match, titles, args.repeat))
+
+if __name__ == '__main__':
+    main()
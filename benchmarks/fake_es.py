@@ -0,0 +1,392 @@
+"""
+In-memory stand-in for the parts of the Elasticsearch 2.x HTTP API used by
+the transmitter and the miner, so they can be benchmarked offline.
+
+Run it on its own with `python fake_es.py PORT`, or start it in-process
+with serve().
+"""
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+from urlparse import urlparse, parse_qs
+import itertools
+import json
+import re
+import sys
+import threading
+
+
+class Store(object):
+    """
+    Indices, aliases and templates of the fake cluster
+    """
+
+    def __init__(self):
+        self.indices = {}  # name -> {'docs': {(type, id): source}, ...}
+        self.aliases = {}  # alias -> set of index names
+        self.templates = {}
+        self.ids = itertools.count(1)
+        self.lock = threading.RLock()
+
+    @staticmethod
+    def _pattern(pattern):
+        return re.compile('^' + re.escape(pattern).replace('\\*', '.*') + '$')
+
+    def resolve(self, names):
+        """
+        Return the index names matching comma separated names, aliases or
+        wildcards
+        """
+        indices = []
+        for name in (names or '_all').split(','):
+            if name in self.aliases:
+                indices.extend(self.aliases[name])
+            elif name == '_all':
+                indices.extend(self.indices)
+            elif '*' in name:
+                pattern = self._pattern(name)
+                indices.extend(i for i in self.indices if pattern.match(i))
+            else:
+                indices.append(name)
+        return indices
+
+    def index(self, name, body=None):
+        """
+        Return the index, creating it from the matching templates
+        """
+        if name not in self.indices:
+            index = {'docs': {}, 'settings': {}, 'mappings': {}}
+            for template in self.templates.values():
+                if self._pattern(template.get('template', '')).match(name):
+                    index['settings'].update(template.get('settings', {}))
+                    index['mappings'].update(template.get('mappings', {}))
+                    for alias in template.get('aliases', {}):
+                        self.aliases.setdefault(alias, set()).add(name)
+            self.indices[name] = index
+        if body:
+            self.indices[name]['settings'].update(body.get('settings', {}))
+            self.indices[name]['mappings'].update(body.get('mappings', {}))
+        return self.indices[name]
+
+    def get(self, names, doc_type, doc_id):
+        for name in self.resolve(names):
+            if name in self.indices:
+                source = self.indices[name]['docs'].get((doc_type, doc_id))
+                if source is not None:
+                    return name, source
+        return None, None
+
+    def delete_index(self, name):
+        self.indices.pop(name, None)
+        for indices in self.aliases.values():
+            indices.discard(name)
+
+
+_tokens = {}
+
+
+def tokenize(text):
+    """
+    Return the set of lower cased words of text, memoized as the same
+    documents are matched over and over
+    """
+    tokens = _tokens.get(text)
+    if tokens is None:
+        tokens = _tokens[text] = frozenset(
+            re.findall(r'\w+', text.lower(), re.UNICODE))
+    return tokens
+
+
+def compile_query(query):
+    """
+    Return a predicate telling whether a document source matches the
+    query, only the queries used by the miner are supported
+    """
+    if not query or 'match_all' in query:
+        return lambda source: True
+    if 'filtered' in query:
+        clauses = [compile_query(query['filtered'].get('query')),
+                   compile_query(query['filtered'].get('filter'))]
+        return lambda source: all(clause(source) for clause in clauses)
+    if 'bool' in query:
+        must = [compile_query(c) for c in query['bool'].get('must', []) +
+                query['bool'].get('filter', [])]
+        must_not = [compile_query(c)
+                    for c in query['bool'].get('must_not', [])]
+        return lambda source: all(clause(source) for clause in must) and \
+            not any(clause(source) for clause in must_not)
+    if 'term' in query:
+        (field, value), = query['term'].items()
+        return lambda source: source.get(field) == value
+    if 'terms' in query:
+        (field, values), = query['terms'].items()
+        return lambda source: source.get(field) in values
+    if 'match' in query:
+        (field, match), = query['match'].items()
+        if not isinstance(match, dict):
+            match = {'query': match}
+        wanted = tokenize(match['query'])
+        if match.get('operator', 'or') == 'and':
+            return lambda source: wanted <= tokenize(source.get(field) or u'')
+        return lambda source: bool(wanted & tokenize(source.get(field) or u''))
+    if 'range' in query:
+        (field, bounds), = query['range'].items()
+        checks = [(accept, bounds[key])
+                  for key, accept in (('from', lambda v, b: v >= b),
+                                      ('gte', lambda v, b: v >= b),
+                                      ('gt', lambda v, b: v > b),
+                                      ('to', lambda v, b: v <= b),
+                                      ('lte', lambda v, b: v <= b),
+                                      ('lt', lambda v, b: v < b))
+                  if bounds.get(key) is not None]
+
+        def in_range(source):
+            value = source.get(field)
+            return value is not None and \
+                all(accept(value, bound) for accept, bound in checks)
+        return in_range
+    raise ValueError('Unsupported query: %r' % query)
+
+
+class Handler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'  # Keep-alive, like a real node
+
+    def log_message(self, *args):
+        pass
+
+    def do_request(self):
+        url = urlparse(self.path)
+        params = {k: v[0] for k, v in parse_qs(url.query).items()}
+        parts = [part for part in url.path.split('/') if part]
+        length = int(self.headers.get('Content-Length') or 0)
+        raw = self.rfile.read(length) if length else ''
+        with self.server.store.lock:
+            try:
+                status, body = self.route(parts, raw, params)
+            except Exception as e:
+                status, body = 500, {'error': repr(e)}
+        data = json.dumps(body)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(data)
+
+    do_HEAD = do_GET = do_POST = do_PUT = do_DELETE = do_request
+
+    def route(self, parts, raw, params):
+        store = self.server.store
+        method = self.command
+        body = json.loads(raw) if raw and parts[-1:] not in \
+            (['_bulk'], ['_msearch']) else {}
+        if not parts:
+            return 200, {'version': {'number': '2.3.0'}}
+
+        endpoint = parts[-1]
+        index = parts[0] if not parts[0].startswith('_') else None
+        doc_type = parts[1] if len(parts) > 2 and \
+            not parts[1].startswith('_') else None
+        if endpoint == '_bulk':
+            return 200, self.bulk(raw, index, doc_type)
+        if endpoint == '_msearch':
+            return 200, self.msearch(raw, index, doc_type)
+        if endpoint == '_search':
+            return 200, self.search(index, doc_type, body, params)
+        if endpoint == '_mget':
+            return 200, self.mget(index, doc_type, body)
+        if parts[0] == '_template':
+            store.templates[parts[1]] = body
+            return 200, {'acknowledged': True}
+        if parts[0] == '_aliases':
+            for action in body['actions']:
+                (op, spec), = action.items()
+                if op == 'add':
+                    store.aliases.setdefault(spec['alias'], set()).add(
+                        spec['index'])
+                else:
+                    store.aliases.get(spec['alias'], set()).discard(
+                        spec['index'])
+            return 200, {'acknowledged': True}
+        if '_alias' in parts:
+            name = parts[-1] if endpoint != '_alias' else None
+            found = {}
+            for alias, indices in store.aliases.items():
+                for i in indices:
+                    if (name is None or alias == name) and \
+                            (index is None or i in store.resolve(index)):
+                        found.setdefault(i, {'aliases': {}})['aliases'][
+                            alias] = {}
+            return (200 if found else 404), found
+
+        if len(parts) == 1:
+            if method == 'PUT':
+                if index in store.indices:
+                    return 400, {'error': 'index_already_exists_exception'}
+                store.index(index, body)
+                return 200, {'acknowledged': True}
+            names = [i for i in store.resolve(index) if i in store.indices]
+            if method == 'DELETE':
+                for name in names:
+                    store.delete_index(name)
+                return (200 if names else 404), {'acknowledged': True}
+            return (200 if names else 404), {
+                name: {'settings': {'index': store.indices[name]['settings']},
+                       'mappings': store.indices[name]['mappings']}
+                for name in names}
+        if parts[1] == '_settings':
+            names = store.resolve(index)
+            if method == 'GET':
+                return 200, {name: {'settings': {
+                    'index': store.indices[name]['settings']}}
+                    for name in names if name in store.indices}
+            for name in names:
+                store.index(name)['settings'].update(body.get('index', body))
+            return 200, {'acknowledged': True}
+        if parts[1] == '_mapping':
+            store.index(index)['mappings'][parts[2]] = body
+            return 200, {'acknowledged': True}
+        if parts[1] in ('_refresh', '_flush', '_forcemerge', '_optimize'):
+            return 200, {'_shards': {'total': 1, 'successful': 1}}
+        return self.document(method, index, parts[1], parts[2:], body,
+                             params)
+
+    def document(self, method, index, doc_type, rest, body, params):
+        store = self.server.store
+        docs = store.index(index)['docs'] if method != 'GET' else None
+        if not rest:  # POST /index/type with a generated id
+            doc_id = str(next(store.ids))
+            docs[(doc_type, doc_id)] = body
+            return 201, {'_id': doc_id, 'created': True}
+        doc_id = rest[0]
+        if method == 'GET':
+            name, source = store.get(index, doc_type, doc_id)
+            if source is None:
+                return 404, {'_id': doc_id, 'found': False}
+            return 200, {'_index': name, '_type': doc_type, '_id': doc_id,
+                         'found': True, '_source': source}
+        if method == 'DELETE':
+            found = docs.pop((doc_type, doc_id), None) is not None
+            return (200 if found else 404), {'found': found}
+        if rest[1:] == ['_update']:
+            if (doc_type, doc_id) not in docs:
+                return 404, {'error': 'document_missing_exception'}
+            docs[(doc_type, doc_id)].update(body['doc'])
+            return 200, {'_id': doc_id}
+        created = (doc_type, doc_id) not in docs
+        if not created and (rest[1:] == ['_create'] or
+                            params.get('op_type') == 'create'):
+            return 409, {'error': 'document_already_exists_exception'}
+        docs[(doc_type, doc_id)] = body
+        return (201 if created else 200), {'_id': doc_id, 'created': created}
+
+    def search(self, index, doc_type, body, params):
+        store = self.server.store
+        matches = compile_query(body.get('query'))
+        found = []
+        for name in store.resolve(index):
+            if name not in store.indices:
+                continue
+            for (t, doc_id), source in store.indices[name]['docs'].iteritems():
+                if (doc_type is None or t == doc_type) and \
+                        matches(source):
+                    found.append((name, t, doc_id, source))
+        for sort in reversed(body.get('sort', [])):
+            (field, order), = sort.items() if isinstance(sort, dict) \
+                else [(sort, 'asc')]
+            if isinstance(order, dict):
+                order = order.get('order', 'asc')
+            found.sort(key=lambda hit: hit[3].get(field),
+                       reverse=order == 'desc')
+        start = int(body.get('from', params.get('from', 0)))
+        size = int(body.get('size', params.get('size', 10)))
+        hits = [{'_index': name, '_type': t, '_id': doc_id, '_score': 1.0,
+                 '_source': source}
+                for name, t, doc_id, source in found[start:start + size]]
+        return {'took': 1, 'timed_out': False,
+                'hits': {'total': len(found), 'max_score': 1.0,
+                         'hits': hits}}
+
+    def msearch(self, raw, index, doc_type):
+        lines = [line for line in raw.split('\n') if line.strip()]
+        responses = []
+        for header, body in zip(lines[::2], lines[1::2]):
+            header = json.loads(header)
+            names = header.get('index', index)
+            if isinstance(names, list):
+                names = ','.join(names)
+            responses.append(self.search(names, header.get('type', doc_type),
+                                         json.loads(body), {}))
+        return {'responses': responses}
+
+    def mget(self, index, doc_type, body):
+        docs = []
+        for doc_id in body['ids']:
+            name, source = self.server.store.get(index, doc_type, doc_id)
+            doc = {'_index': name or index, '_type': doc_type,
+                   '_id': doc_id, 'found': source is not None}
+            if source is not None:
+                doc['_source'] = source
+            docs.append(doc)
+        return {'docs': docs}
+
+    def bulk(self, raw, index, doc_type):
+        store = self.server.store
+        lines = iter(line for line in raw.split('\n') if line.strip())
+        items = []
+        for line in lines:
+            (op, meta), = json.loads(line).items()
+            source = json.loads(next(lines)) if op != 'delete' else None
+            docs = store.index(meta.get('_index', index))['docs']
+            key = (meta.get('_type', doc_type),
+                   str(meta.get('_id') or next(store.ids)))
+            status = 200 if key in docs else 201
+            if op == 'delete':
+                status = 200 if docs.pop(key, None) is not None else 404
+            elif op == 'update':
+                if key in docs:
+                    docs[key].update(source.get('doc', {}))
+                else:
+                    status = 404
+            elif op == 'create' and key in docs:
+                status = 409
+            else:
+                docs[key] = source
+            item = {'_index': meta.get('_index', index), '_type': key[0],
+                    '_id': key[1], 'status': status}
+            if status >= 300:
+                item['error'] = {'type': 'fake_error'}
+            items.append({op: item})
+        return {'took': 1,
+                'errors': any('error' in i.values()[0] for i in items),
+                'items': items}
+
+
+class FakeElasticsearch(ThreadingMixIn, HTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, address):
+        HTTPServer.__init__(self, address, Handler)
+        self.store = Store()
+
+    @property
+    def host(self):
+        return '%s:%d' % self.server_address
+
+
+def serve(port=0):
+    """
+    Start a fake elasticsearch in a background thread
+    @return: the server, its `host` is the address to connect to
+    """
+    server = FakeElasticsearch(('127.0.0.1', port))
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+if __name__ == '__main__':
+    server = FakeElasticsearch(('127.0.0.1', int(sys.argv[1])))
+    server.serve_forever()
@@ -0,0 +1,145 @@
+import os
+import sys
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, 'SpecialFinderMiner'))
+
+from config import config
+from notifier import AsyncNotifier
+
+RECEIVERS = {'alice': {'telegram': 1}, 'bob': {'telegram': 2}}
+
+
+class FakeTransport(object):
+    """
+    Records the messages sent, the first failures sends fail
+    """
+
+    def __init__(self, failures=0):
+        self.failures = failures
+        self.lock = threading.Lock()
+        self.calls = []  # (chat id, message, time)
+
+    def send(self, chat_id, msg):
+        with self.lock:
+            self.calls.append((chat_id, msg, time.time()))
+            if self.failures:
+                self.failures -= 1
+                raise IOError('bot unreachable')
+
+    def sent(self, chat_id=None):
+        return [msg for chat, msg, _ in self.calls
+                if chat_id is None or chat == chat_id]
+
+
+class AsyncNotifierTest(unittest.TestCase):
+
+    def setUp(self):
+        self.notification_config = dict(config['notification'])
+        config['notification']['chat_interval'] = 0
+        config['notification']['global_interval'] = 0
+        self.notifiers = []
+
+    def tearDown(self):
+        for notifier in self.notifiers:
+            notifier.close()
+        config['notification'].update(self.notification_config)
+
+    def notifier(self, transport, receivers=RECEIVERS, **notification):
+        config['notification'].update(notification)
+        notifier = AsyncNotifier(receivers, transport)
+        self.notifiers.append(notifier)
+        return notifier
+
+    def test_digest_per_receiver(self):
+        transport = FakeTransport()
+        notifier = self.notifier(transport, digest=True)
+        for msg in [u'coffee is on special', u'tea is on special',
+                    u'milk is on special']:
+            notifier.send_message(msg)
+        self.assertEqual(transport.calls, [])
+        notifier.flush()
+        digest = u'coffee is on special\ntea is on special\n' \
+                 u'milk is on special'
+        self.assertEqual(transport.sent(1), [digest])
+        self.assertEqual(transport.sent(2), [digest])
+
+    def test_digest_length_limit(self):
+        msgs = [u'x' * 3000, u'y' * 3000, u'z' * 5000]
+        self.assertEqual(AsyncNotifier.digest_messages(msgs),
+                         [u'x' * 3000, u'y' * 3000, u'z' * 4096])
+
+    def test_chat_interval(self):
+        transport = FakeTransport()
+        notifier = self.notifier(transport, {'alice': {'telegram': 1}},
+                                 digest=False, workers=3, chat_interval=0.1)
+        for index in range(4):
+            notifier.send_message(u'special %d' % index)
+        notifier.flush()
+        # In order, and apart, whatever the number of workers
+        self.assertEqual(transport.sent(1),
+                         [u'special %d' % index for index in range(4)])
+        times = [sent for _, _, sent in transport.calls]
+        for previous, sent in zip(times, times[1:]):
+            self.assertGreaterEqual(sent - previous, 0.09)
+
+    def test_global_interval(self):
+        transport = FakeTransport()
+        receivers = {str(chat_id): {'telegram': chat_id}
+                     for chat_id in range(5)}
+        notifier = self.notifier(transport, receivers, digest=False,
+                                 workers=5, global_interval=0.05)
+        notifier.send_message(u'special')
+        notifier.flush()
+        self.assertEqual(len(transport.calls), 5)
+        times = sorted(sent for _, _, sent in transport.calls)
+        for previous, sent in zip(times, times[1:]):
+            self.assertGreaterEqual(sent - previous, 0.045)
+
+    def test_failed_send_is_retried(self):
+        transport = FakeTransport(failures=2)
+        notifier = self.notifier(transport, {'alice': {'telegram': 1}},
+                                 digest=False, retries=3,
+                                 chat_interval=0.01)
+        notifier.send_message(u'special')
+        notifier.flush()
+        self.assertEqual(transport.sent(1), [u'special'] * 3)
+
+    def test_no_backoff_after_the_last_attempt(self):
+        transport = FakeTransport(failures=10)
+        notifier = self.notifier(transport, {'alice': {'telegram': 1}},
+                                 digest=False, retries=2, chat_interval=0.1)
+        started = time.time()
+        notifier.send_message(u'special')
+        notifier.flush()
+        # Backs off 0.1s then 0.2s, not another 0.4s once it gave up
+        self.assertEqual(len(transport.calls), 3)
+        self.assertLess(time.time() - started, 0.55)
+
+    def test_flush_without_waiting(self):
+        transport = FakeTransport()
+        notifier = self.notifier(transport, digest=True)
+        notifier.send_message(u'special')
+        notifier.flush(wait=False)
+        notifier.queue.join()
+        self.assertEqual(sorted(chat for chat, _, _ in transport.calls),
+                         [1, 2])
+
+    def test_close_sends_everything_queued(self):
+        transport = FakeTransport()
+        notifier = self.notifier(transport, digest=True, chat_interval=0.05)
+        notifier.send_message(u'coffee is on special')
+        notifier.flush(wait=False)
+        notifier.send_message(u'tea is on special')
+        notifier.close()
+        self.notifiers.remove(notifier)
+        self.assertEqual(transport.sent(1), [u'coffee is on special',
+                                             u'tea is on special'])
+        self.assertEqual(transport.sent(2), [u'coffee is on special',
+                                             u'tea is on special'])
+
+if __name__ == '__main__':
+    unittest.main()
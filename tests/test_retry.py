@@ -0,0 +1,182 @@
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, 'SpecialFinderMiner'))
+
+from kombu import Connection, Producer
+from config import config
+from models.tables import Base, Item
+from retry import ATTEMPTS_HEADER, backoff_delays
+
+MAX_RETRIES = 3
+
+
+def result(title, price=1.5):
+    return {'title': [title], 'price': [price], 'url': [u'http://vendor/1'],
+            'image_url': [None], 'date': [u'2016-05-01'],
+            'vendor': [u'vendor']}
+
+
+class RetryTest(unittest.TestCase):
+    """
+    A dumper consuming from kombu's in-memory transport and writing to a
+    temporary SQLite db, the dumper moves the due retries back itself
+    """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        config['db_conn'] = 'sqlite:///%s' % os.path.join(self.tmp_dir,
+                                                          'items.db')
+        self.queue_config = dict(config['queue'], queue=dict(
+            config['queue']['queue']))
+        self.dumper_config = dict(config['dumper'])
+        config['queue']['conn'] = 'memory://'
+        # The in-memory queues live as long as the process
+        config['queue']['queue']['name'] = 'retry_test_%s' % id(self)
+        config['queue']['serializer'] = ['json']
+        config['dumper']['retry_delay'] = 0.01
+        config['dumper']['max_retries'] = MAX_RETRIES
+        import dumper
+        self.dumper = dumper.Dumper()
+        self.dumper.batch_size = 1
+        # Polls the in-memory queues every second otherwise, the consuming
+        # connection is a clone of this one
+        self.dumper.connection.transport_options['polling_interval'] = 0.01
+        Base.metadata.create_all(self.dumper.dal.engine)
+        self.retries = self.dumper.retries
+
+        execute = dumper.Dumper._execute
+        self.poisoned = True
+
+        def poisoned_execute(rows):
+            if self.poisoned and \
+                    any(row['title'] == u'poison' for row in rows):
+                raise RuntimeError('poisoned')
+            return execute(self.dumper, rows)
+
+        self.dumper._execute = poisoned_execute
+
+        # The queues the results were moved to, besides the results one and
+        # the undue retries put back where they were
+        self.moves = []
+        publish = self.retries.publish
+
+        def recording_publish(message, queue_name, headers):
+            if queue_name not in (self.retries.queue_name,
+                                  message.delivery_info['routing_key']):
+                self.moves.append(queue_name)
+            return publish(message, queue_name, headers)
+
+        self.retries.publish = recording_publish
+
+        self.connection = Connection('memory://')
+        self.dumper.queue(self.connection.default_channel).declare()
+        self.producer = Producer(self.connection.default_channel,
+                                 exchange=self.dumper.exchange,
+                                 serializer='json')
+
+    def tearDown(self):
+        self.dumper.on_consume_end(None, None)
+        self.connection.close()
+        self.dumper.dal.Session.remove()
+        shutil.rmtree(self.tmp_dir)
+        config['queue'].update(self.queue_config)
+        config['dumper'].update(self.dumper_config)
+
+    def publish(self, body):
+        self.producer.publish(body)
+
+    def consume(self):
+        try:
+            for _ in self.dumper.consume(timeout=0.1, safety_interval=0.05):
+                pass
+        except socket.timeout:
+            pass
+        time.sleep(0.02)  # Past the retry delays
+
+    def consume_until_dead_lettered(self, count, deadline=5):
+        deadline += time.time()
+        while self.retries.dead_letters()[0] < count and \
+                time.time() < deadline:
+            self.consume()
+
+    def titles(self):
+        return sorted(title for title, in
+                      self.dumper.dal.session.query(Item.title))
+
+    def queued(self, queue):
+        _, count, _ = queue(self.retries.channel).queue_declare(passive=True)
+        return count
+
+    def test_backoff_delays(self):
+        self.assertEqual(backoff_delays(5, 4), [5, 10, 20, 40])
+        self.assertEqual([queue.name for queue in self.retries.retry_queues],
+                         ['%s.retry.%d' % (self.retries.queue_name, ms)
+                          for ms in (10, 20, 40)])
+
+    def test_poison_result_retried_then_dead_lettered(self):
+        self.publish(result(u'coffee'))
+        self.publish(result(u'poison'))
+        self.publish(result(u'tea'))
+        self.consume_until_dead_lettered(1)
+        self.assertEqual(self.titles(), [u'coffee', u'tea'])
+        self.assertEqual(self.moves,
+                         [queue.name for queue in self.retries.retry_queues] +
+                         [self.retries.queue_name + '.dead'])
+        self.assertEqual([self.queued(queue)
+                          for queue in self.retries.retry_queues],
+                         [0] * MAX_RETRIES)
+        count, found = self.retries.dead_letters(accept=['json'])
+        self.assertEqual(count, 1)
+        attempts, error, body = found[0]
+        self.assertEqual(attempts, MAX_RETRIES)
+        self.assertEqual(error, u'poisoned')
+        self.assertEqual(body['title'], [u'poison'])
+        self.assertEqual(self.dumper.dal.session.query(Item).count(), 2)
+
+        # Back to the results queue, with its attempts reset, once fixed
+        self.poisoned = False
+        self.assertEqual(self.retries.replay(), 1)
+        self.assertEqual(self.retries.dead_letters()[0], 0)
+        self.consume()
+        self.assertEqual(self.titles(), [u'coffee', u'poison', u'tea'])
+
+    def test_invalid_result_dead_lettered_at_once(self):
+        self.publish(result(u'coffee', price=u'abc'))
+        self.consume()
+        self.assertEqual(self.titles(), [])
+        self.assertEqual([self.queued(queue)
+                          for queue in self.retries.retry_queues],
+                         [0] * MAX_RETRIES)
+        count, found = self.retries.dead_letters(accept=['json'])
+        self.assertEqual(count, 1)
+        attempts, error, body = found[0]
+        self.assertEqual(attempts, 0)
+        self.assertEqual(error, u"price: invalid_value (u'abc')")
+        self.assertEqual(self.moves, [self.retries.queue_name + '.dead'])
+
+    def test_purge(self):
+        self.publish(result(u'coffee', price=u'abc'))
+        self.publish(result(u'tea', price=u''))
+        self.consume()
+        self.assertEqual(self.retries.dead_letters()[0], 2)
+        self.assertEqual(self.retries.purge(), 2)
+        self.assertEqual(self.retries.dead_letters(), (0, []))
+
+    def test_replay_resets_the_headers(self):
+        self.publish(result(u'coffee', price=u'abc'))
+        self.consume()
+        self.retries.replay()
+        message = self.dumper.queue(self.retries.channel).get()
+        self.assertNotIn(ATTEMPTS_HEADER, message.headers)
+        self.assertEqual(message.decode()['title'], [u'coffee'])
+        message.ack()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,103 @@
+import os
+import sys
+import unittest
+from datetime import date, datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, 'SpecialFinderMiner'))
+
+from kombu.serialization import dumps, loads, prepare_accept_content
+from schema import SchemaError, decode_msgpack, item_schema
+
+
+def result(**fields):
+    body = {'title': [u'Acme coffee beans 1kg'], 'price': [u'$1,299.00'],
+            'per': [u'kg'], 'url': [u'http://vendor/1'],
+            'image_url': [u'http://vendor/1.jpg'], 'date': [u'2016-05-01'],
+            'vendor': [u'vendor']}
+    body.update(fields)
+    return body
+
+
+class ItemSchemaTest(unittest.TestCase):
+
+    def assertSchemaError(self, body, field, reason):
+        with self.assertRaises(SchemaError) as raised:
+            item_schema.validate(body)
+        self.assertEqual((raised.exception.field, raised.exception.reason),
+                         (field, reason))
+
+    def test_valid_result(self):
+        self.assertEqual(item_schema.validate(result()), {
+            'title': u'Acme coffee beans 1kg',
+            'price': 1299.0,
+            'per': u'kg',
+            'url': u'http://vendor/1',
+            'image_url': u'http://vendor/1.jpg',
+            'date': date(2016, 5, 1),
+            'vendor': u'vendor',
+        })
+
+    def test_unwrapped_values(self):
+        row = item_schema.validate(result(title=u' coffee ', price=2,
+                                          date=datetime(2016, 5, 1, 12)))
+        self.assertEqual((row['title'], row['price'], row['date']),
+                         (u'coffee', 2.0, date(2016, 5, 1)))
+
+    def test_missing_required_fields(self):
+        for field in ('title', 'price', 'date', 'vendor'):
+            body = result()
+            del body[field]
+            self.assertSchemaError(body, field, 'missing')
+        self.assertSchemaError(result(vendor=[]), 'vendor', 'missing')
+        self.assertSchemaError(result(title=[u'  ']), 'title', 'empty')
+
+    def test_optional_fields(self):
+        body = result(per=None, url=[u' '], image_url=[])
+        row = item_schema.validate(body)
+        self.assertEqual((row['per'], row['url'], row['image_url']),
+                         (None, None, None))
+        del body['url'], body['image_url']
+        row = item_schema.validate(body)
+        self.assertEqual((row['url'], row['image_url']), (None, None))
+
+    def test_invalid_prices(self):
+        for value in (u'', u'abc', u'1.2.3'):
+            self.assertSchemaError(result(price=[value]), 'price',
+                                   'invalid_value')
+        self.assertSchemaError(result(price=[True]), 'price', 'invalid_type')
+        self.assertSchemaError(result(price=[u'nan']), 'price',
+                               'out_of_range')
+        self.assertSchemaError(result(price=[-1]), 'price', 'out_of_range')
+
+    def test_invalid_dates(self):
+        self.assertSchemaError(result(date=[u'2016-13-01']), 'date',
+                               'invalid_value')
+        self.assertSchemaError(result(date=[u'2016-02-30']), 'date',
+                               'invalid_value')
+        self.assertSchemaError(result(date=[u'01/05/2016']), 'date',
+                               'invalid_value')
+        self.assertSchemaError(result(date=[20160501]), 'date',
+                               'invalid_type')
+
+    def test_too_long_text(self):
+        self.assertSchemaError(result(vendor=[u'v' * 51]), 'vendor',
+                               'too_long')
+
+    def test_not_a_mapping(self):
+        self.assertSchemaError([u'coffee'], None, 'not_a_mapping')
+
+
+class DecodeMsgpackTest(unittest.TestCase):
+
+    def test_matches_kombu(self):
+        body = {'title': [u'Caf\xe9 beans'], 'price': [1.5],
+                'date': [u'2016-05-01'], 'tags': [], 'per': None}
+        content_type, content_encoding, payload = dumps(body, 'msgpack')
+        self.assertEqual(decode_msgpack(payload),
+                         loads(payload, content_type, content_encoding,
+                               accept=prepare_accept_content(['msgpack'])))
+        self.assertEqual(decode_msgpack(payload), body)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, 'SpecialFinderMiner'))
+
+from attrdict import AttrDict
+from watchlist import WatchList, tokenize
+
+ENTRIES = [
+    (u'coffee beans', 'and'),
+    (u'ground coffee', 'and'),
+    (u'green tea', 'or'),
+    (u'  ', 'and'),  # No tokens, never matches
+]
+
+
+class WatchListTest(unittest.TestCase):
+
+    def setUp(self):
+        self.watchlist = WatchList(ENTRIES)
+
+    def test_tokenize(self):
+        self.assertEqual(tokenize(u"Acme Coffee-Beans 1.5kg, it's fresh!"),
+                         set([u'acme', u'coffee', u'beans', u'1.5kg',
+                              u"it's", u'fresh']))
+
+    def test_and_titles_indexed_under_their_rarest_token(self):
+        # "coffee" is watched twice, the other tokens once
+        self.assertEqual(dict(self.watchlist.all_index),
+                         {u'beans': [0], u'ground': [1]})
+        self.assertEqual(dict(self.watchlist.any_index),
+                         {u'green': [2], u'tea': [2]})
+        self.assertEqual(len(self.watchlist), 3)
+
+    def test_and_titles_need_all_their_tokens(self):
+        self.assertEqual(self.watchlist.match(u'Acme Coffee Beans 1kg'),
+                         [u'coffee beans'])
+        self.assertEqual(self.watchlist.match(u'Acme Beans'), [])
+        self.assertEqual(self.watchlist.match(u'Coffee cup'), [])
+
+    def test_or_titles_need_any_token(self):
+        self.assertEqual(self.watchlist.match(u'Earl grey tea bags'),
+                         [u'green tea'])
+        self.assertEqual(self.watchlist.match(u'Green curry paste'),
+                         [u'green tea'])
+
+    def test_matches_in_watch_list_order(self):
+        self.assertEqual(
+            self.watchlist.match(u'Ground coffee beans and green tea'),
+            [u'coffee beans', u'ground coffee', u'green tea'])
+
+    def test_from_config(self):
+        watchlist = WatchList.from_config([
+            AttrDict({'title': u'coffee beans'}),
+            AttrDict({'title': u'milk bread', 'operator': 'or'}),
+        ])
+        self.assertEqual(watchlist.match(u'Wholemeal bread'),
+                         [u'milk bread'])
+        self.assertEqual(len(WatchList.from_config(None)), 0)
+
+if __name__ == '__main__':
+    unittest.main()